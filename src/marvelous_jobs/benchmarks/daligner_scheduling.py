@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+
+"""Count the block reads of the daligner schedulers.
+
+All daligner jobs of a project are reserved, array by array, with the
+default scheduler (`--jobs-per-task`) and with the tiled scheduler for
+each tile size given with `-k` (`--tile-size`). Nothing is submitted.
+For each strategy, the following is counted:
+
+- loads: blocks loaded by the daligner calls, one for the source
+  block and one for each target block of every line of a
+  reservation. This is what is read from the shared file system if
+  nothing is cached.
+- distinct: the sum over the tasks of the number of distinct blocks
+  of each task. This is what is read if every task reads each of its
+  blocks once, e.g. from the page cache of the node.
+- max/task: the largest number of distinct blocks of a single task.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import marvelous_jobs as mj
+
+def count_reads(db, n_tasks, jobs_per_task, comparisons_per_job,
+                tile_size=None):
+    """Reserve all jobs and count the block reads of the tasks."""
+    tasks = 0
+    loads = 0
+    distinct = 0
+    max_distinct = 0
+    while True:
+        reservations = db.reserve_daligner_tasks(
+            ['bench_{0}'.format(i) for i in range(n_tasks)],
+            jobs_per_task=jobs_per_task,
+            comparisons_per_job=comparisons_per_job,
+            tile_size=tile_size)
+        reservations = [r for r in reservations if len(r) > 0]
+        if len(reservations) == 0:
+            break
+        for reservation in reservations:
+            blocks = set()
+            for d in reservation:
+                loads += 1 + len(d['target_blocks'])
+                blocks.add(d['source_block'])
+                blocks.update(d['target_blocks'])
+            tasks += 1
+            distinct += len(blocks)
+            max_distinct = max(max_distinct, len(blocks))
+    db.cancel_daligner_reservation()
+    return tasks, loads, distinct, max_distinct
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Count how many blocks '
+                                     'the daligner tasks read with each '
+                                     'scheduler.')
+    parser.add_argument('-b', '--blocks', help='number of blocks '
+                        '(default: 200)', type=int, default=200)
+    parser.add_argument('-j', '--jobs-per-task', help='jobs per task of the '
+                        'default scheduler (default: 100)', type=int,
+                        default=100)
+    parser.add_argument('-c', '--comparisons-per-job', help='comparisons '
+                        'per job (default: 4)', type=int, default=4)
+    parser.add_argument('-k', '--tile-size', help='tile sizes to count '
+                        '(default: 8 16 32)', type=int, nargs='+',
+                        default=[8, 16, 32])
+    parser.add_argument('-n', help='array size (default: 1000)', type=int,
+                        default=1000)
+    parser.add_argument('-d', '--directory', help='directory where the '
+                        'temporary project is created (default: system '
+                        'temporary directory)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=args.directory)
+    try:
+        db = mj.marvel_db(os.path.join(tmpdir, 'marveldb'), 'bench', 20)
+        db.add_blocks((i, 'bench.{0}'.format(i))
+                      for i in range(1, args.blocks + 1))
+        db.add_daligner_job_matrix(args.blocks, use_masking_server=False)
+        print('{0} blocks, {1} comparisons, {2} comparisons per job' \
+              .format(args.blocks, db.n_daligner_jobs(),
+                      args.comparisons_per_job))
+
+        strategies = [('priority', None)] + \
+                [('tile k={0}'.format(k), k) for k in args.tile_size]
+        print('{0:>12}  {1:>7}  {2:>9}  {3:>9}  {4:>8}  {5:>7}' \
+              .format('strategy', 'tasks', 'loads', 'distinct', 'max/task',
+                      'seconds'))
+        for name, tile_size in strategies:
+            start = time.time()
+            tasks, loads, distinct, max_distinct = count_reads(
+                db, args.n, args.jobs_per_task, args.comparisons_per_job,
+                tile_size)
+            print('{0:>12}  {1:>7}  {2:>9}  {3:>9}  {4:>8}  {5:>7.2f}' \
+                  .format(name, tasks, loads, distinct, max_distinct,
+                          time.time() - start))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+"""Time the reservation part of `marvelous_jobs daligner update`.
+
+For each array size given with `-n`, daligner jobs are reserved, the
+reservation files are written and the job array is created, exactly
+as `get_daligner_array` does when the queue is updated. Nothing is
+submitted, and all reservations are cancelled between the runs.
+"""
+
+import argparse
+import glob
+import os
+import shutil
+import tempfile
+import time
+
+import marvelous_jobs as mj
+from marvelous_jobs import __main__ as cli
+
+def create_project(directory, n_blocks, jobs_per_task, comparisons_per_job):
+    db_filename = os.path.join(directory, 'marveldb')
+    db = mj.marvel_db(db_filename, 'bench', 20)
+    jobs = []
+    current_job = 0
+    for i in range(1, n_blocks + 1):
+        db.add_block(i, 'bench.{0}'.format(i))
+        current_job += 1
+        jobs.append((current_job, i, i, 1, False))
+    for i in range(1, n_blocks + 1):
+        for j in range(i + 1, n_blocks + 1):
+            current_job += 1
+            jobs.append((current_job, i, j, i + 1, False))
+            if len(jobs) == 1000:
+                db.add_daligner_jobs(jobs)
+                jobs = []
+    if len(jobs) > 0:
+        db.add_daligner_jobs(jobs)
+
+    for d in ('scripts', 'logs', 'daligner_runs'):
+        os.mkdir(os.path.join(directory, d))
+
+    config = mj.marvelous_config(
+        filename=os.path.join(directory, 'config.ini'),
+        cdict={
+            'general': {
+                'account': 'bench',
+                'database': db_filename,
+                'directory': directory,
+                'script_directory': os.path.join(directory, 'scripts'),
+                'log_directory': os.path.join(directory, 'logs')
+            },
+            'daligner': {
+                'run_directory': os.path.join(directory, 'daligner_runs'),
+                'jobs_per_task': jobs_per_task,
+                'comparisons_per_job': comparisons_per_job,
+                'max_simultaneous_tasks': None,
+                'repeats': None,
+                'verbose': True,
+                'identity': True,
+                'tuple_suppression_frequency': 20,
+                'correlation_rate': 0.7,
+                'threads': 4,
+                'timelimit': '1-00:00:00'
+            },
+            'DMserver': {
+                'port': 12345
+            }
+        })
+
+    return db, config
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark how daligner '
+                                     'queue updates scale with the array '
+                                     'size.')
+    parser.add_argument('-n', help='array sizes to time (default: 1 10 100 '
+                        '1000)', type=int, nargs='+',
+                        default=[1, 10, 100, 1000])
+    parser.add_argument('-b', '--blocks', help='number of blocks '
+                        '(default: 1000)', type=int, default=1000)
+    parser.add_argument('-j', '--jobs-per-task', help='jobs per task '
+                        '(default: 100)', type=int, default=100)
+    parser.add_argument('-c', '--comparisons-per-job', help='comparisons '
+                        'per job (default: 1)', type=int, default=1)
+    parser.add_argument('-d', '--directory', help='directory where the '
+                        'temporary project is created (default: system '
+                        'temporary directory)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=args.directory)
+    try:
+        start = time.time()
+        db, config = create_project(tmpdir, args.blocks,
+                                    args.jobs_per_task,
+                                    args.comparisons_per_job)
+        print('created project with {0} blocks in {1:.2f} s' \
+              .format(args.blocks, time.time() - start))
+
+        print('{0:>6}  {1:>9}  {2:>9}'.format('n', 'jobs', 'seconds'))
+        for n in args.n:
+            start = time.time()
+            job_array, n_jobs, rowids = cli.get_daligner_array(n, config, db)
+            elapsed = time.time() - start
+            print('{0:>6}  {1:>9}  {2:>9.3f}'.format(n, n_jobs, elapsed))
+
+            db.cancel_daligner_reservation()
+            for fname in glob.glob(os.path.join(
+                    config.get('daligner', 'run_directory'), '*.txt')):
+                os.remove(fname)
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
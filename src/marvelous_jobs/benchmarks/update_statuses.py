@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""Compare per-row and bulk daligner status updates.
+
+A project with `n` blocks has n(n+1)/2 daligner jobs, so the default
+of 2000 blocks gives about 2M rows in the `daligner_job` table.
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import marvelous_jobs as mj
+from marvelous_jobs import slurm_utils
+
+def create_database(filename, n_blocks):
+    db = mj.marvel_db(filename, 'bench', 20)
+    jobs = []
+    current_job = 0
+    for i in range(1, n_blocks + 1):
+        db.add_block(i, 'bench.{0}'.format(i))
+        for j in range(i, n_blocks + 1):
+            current_job += 1
+            jobs.append((current_job, i, j, i + 1, False))
+            if len(jobs) == 1000:
+                db.add_daligner_jobs(jobs)
+                jobs = []
+    if len(jobs) > 0:
+        db.add_daligner_jobs(jobs)
+    return db, current_job
+
+def reset_statuses(db):
+    db._c.execute('UPDATE daligner_job SET status = ?',
+                  (slurm_utils.status.reserved,))
+    db._db.commit()
+
+def per_row_update(db, statuses):
+    query = '''UPDATE daligner_job SET
+        status = ?,
+        last_update = datetime("now", "localtime")
+    WHERE rowid = ?'''
+    for ri, status in statuses.items():
+        db._c.execute(query, (status, ri))
+    db._db.commit()
+
+def parse_args():
+    parser = argparse.ArgumentParser(description='Benchmark daligner job '
+                                     'status updates.')
+    parser.add_argument('-n', '--blocks', help='number of blocks '
+                        '(default: 2000)', type=int, default=2000)
+    parser.add_argument('-d', '--directory', help='directory where the '
+                        'temporary database is created (default: system '
+                        'temporary directory)')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+
+    tmpdir = tempfile.mkdtemp(dir=args.directory)
+    try:
+        start = time.time()
+        db, n_jobs = create_database(os.path.join(tmpdir, 'marveldb'),
+                                     args.blocks)
+        print('created {0} jobs in {1:.2f} s' \
+              .format(n_jobs, time.time() - start))
+
+        # A third of the jobs change to completed, a third to running
+        # and the rest stay reserved.
+        status_cycle = (slurm_utils.status.completed,
+                        slurm_utils.status.running,
+                        slurm_utils.status.reserved)
+        statuses = {ri: status_cycle[ri % 3] for ri in range(1, n_jobs + 1)}
+
+        reset_statuses(db)
+        start = time.time()
+        per_row_update(db, statuses)
+        print('per-row update: {0:.2f} s'.format(time.time() - start))
+
+        reset_statuses(db)
+        start = time.time()
+        n_changed = db.set_daligner_statuses(statuses)
+        print('bulk update: {0:.2f} s ({1} rows changed)' \
+              .format(time.time() - start, n_changed))
+
+        start = time.time()
+        n_changed = db.set_daligner_statuses(statuses)
+        print('bulk update, no changes: {0:.2f} s ({1} rows changed)' \
+              .format(time.time() - start, n_changed))
+    finally:
+        shutil.rmtree(tmpdir)
+
+if __name__ == '__main__':
+    main()
@@ -2,6 +2,7 @@ import pkg_resources
 
 from marvelous_jobs.database import marvel_db
 from marvelous_jobs.config import marvelous_config
+from marvelous_jobs.config import get_config
 from marvelous_jobs.job import daligner_job_array
 from marvelous_jobs.job import check_job
 from marvelous_jobs.job import merge_job_array
@@ -12,5 +13,11 @@ from marvelous_jobs.job import patch_job_array
 from marvelous_jobs.job import stats_job_array
 from marvelous_jobs.job import masking_server_job
 from marvelous_jobs.job import prepare_job
+from marvelous_jobs.job import start_jobs
+from marvelous_jobs.job import remove_scripts
+from marvelous_jobs.job import start_job_arrays
+from marvelous_jobs.job import split_array
+from marvelous_jobs.job import shard_simultaneous_tasks
+from marvelous_jobs.fs_utils import directory_snapshot
 
 __version__ = pkg_resources.require('marvelous_jobs')[0].version
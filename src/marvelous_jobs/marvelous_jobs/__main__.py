@@ -1,11 +1,14 @@
 #!/usr/bin/env python
 
 import argparse
+from array import array
 import collections
+import fcntl
 import hashlib
+import json
 import os
 import queue
-import re
+import signal
 import sqlite3
 from subprocess import Popen, PIPE
 import sys
@@ -13,7 +16,7 @@ import time
 
 import marvelous_jobs as mj
 from marvelous_jobs import __version__
-from marvelous_jobs import marvelous_config as mc
+from marvelous_jobs import get_config as mc
 from marvelous_jobs import daligner_job_array
 from marvelous_jobs import masking_server_job
 from marvelous_jobs import prepare_job
@@ -24,6 +27,9 @@ from marvelous_jobs import annotation_merge_job
 from marvelous_jobs import repeat_annotation_array
 from marvelous_jobs import patch_job_array
 from marvelous_jobs import stats_job_array
+from marvelous_jobs import client
+from marvelous_jobs import fs_utils
+from marvelous_jobs import server
 from marvelous_jobs import slurm_utils
 
 import marvel
@@ -32,11 +38,97 @@ def is_project(directory='.'):
     db_name = os.path.abspath(os.path.join(directory, 'marveldb'))
     return os.path.exists(db_name)
 
-def get_database():
+# Database that is held open by a long-running command, returned by
+# get_database instead of opening a new connection
+_database = None
+
+def get_database(read_only=False):
+    """Open the project database.
+
+    Connection settings are read from the `database` section of
+    the config, if present. If a long-running command holds the
+    database open, that connection is returned instead.
+
+    Parameters
+    ----------
+    read_only : bool
+        Open the database in read-only mode. Use this for
+        commands that only read from the database.
+    """
+    if _database is not None:
+        return _database
     db_name = os.path.join('.', 'marveldb')
-    db = mj.marvel_db.from_file(db_name)
+    db = mj.marvel_db.from_file(db_name, read_only=read_only,
+                                **get_database_settings())
+    if db.block_stage_created:
+        if read_only:
+            writable_db = mj.marvel_db.from_file(db_name)
+            import_block_stages(writable_db)
+            writable_db._db.close()
+            db.block_stage_created = False
+        else:
+            import_block_stages(db)
     return db
 
+def get_database_settings():
+    """Get the database connection settings from the config."""
+    config = mc()
+    settings = {}
+    for key in ('journal_mode', 'synchronous', 'cache_size', 'mmap_size'):
+        try:
+            settings[key] = config.get('database', key)
+        except KeyError:
+            pass
+    return settings
+
+def get_coordinator_address(config):
+    """Get the address file of the running coordinator, or None if
+    there is no coordinator."""
+    filename = os.path.join(config.get('general', 'directory'),
+                            server.address_filename)
+    if os.path.isfile(filename):
+        return filename
+    return None
+
+def serve(host='', port=0, advertise=None):
+    """Run the coordinator until interrupted.
+
+    Parameters
+    ----------
+    host : str
+        Interface to listen on. Listens on all interfaces by default.
+    port : int
+        Port to listen on. A free port is picked by default.
+    advertise : str, optional
+        Host name that the job scripts should connect to. Defaults
+        to the name of this host.
+    """
+    config = mc()
+    address_file = os.path.join(config.get('general', 'directory'),
+                                server.address_filename)
+    if os.path.isfile(address_file):
+        try:
+            client.request(address_file, 'ping', retries=0)
+            print('error: a coordinator is already running, see {0}' \
+                  .format(address_file), file=sys.stderr)
+            sys.exit(1)
+        except RuntimeError:
+            os.remove(address_file)
+
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    with server.coordinator(os.path.join('.', 'marveldb'), (host, port),
+                            **get_database_settings()) as c:
+        c.write_address(address_file, advertise)
+        address = c.address(advertise)
+        print('Coordinator listening on {0}:{1}' \
+              .format(address['host'], address['port']))
+        try:
+            c.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(address_file)
+
 def init(name, coverage, account=None, directory='.', force=False,
          n_jobs=1000):
     if is_project(directory) and not force:
@@ -70,6 +162,14 @@ def init(name, coverage, account=None, directory='.', force=False,
             'threads': 4,
             'port': 12345,
             'timelimit': '10-00:00:00'
+        },
+        'database': {
+            'journal_mode': 'DELETE',
+            'synchronous': 'NORMAL',
+            'cache_size': -65536,
+            'mmap_size': 268435456,
+            'integrity_check': 'full',
+            'backup_interval': 3600
         }
     })
 
@@ -119,7 +219,8 @@ def prepare(fasta, blocksize, script_directory, log_directory, force=False,
 
 def start_daligner(jobs_per_task=100, max_simultaneous_tasks=None,
                    force=False, no_masking=False, repeats=None,
-                   comparisons_per_job=1, threads=None, timelimit=None):
+                   comparisons_per_job=1, threads=None, timelimit=None,
+                   pull=False, jobs_per_claim=1, tile_size=None):
     config = mc()
     db = get_database()
     update_statuses()
@@ -161,6 +262,9 @@ def start_daligner(jobs_per_task=100, max_simultaneous_tasks=None,
     config.update('daligner', 'max_simultaneous_tasks', max_simultaneous_tasks)
     config.update('daligner', 'comparisons_per_job', comparisons_per_job)
     config.update('daligner', 'repeats', repeats)
+    config.update('daligner', 'pull', pull)
+    config.update('daligner', 'jobs_per_claim', jobs_per_claim)
+    config.set('daligner', 'tile_size', tile_size)
 
     projname = db.get_project_name()
 
@@ -176,147 +280,307 @@ def start_daligner(jobs_per_task=100, max_simultaneous_tasks=None,
         db.remove_blocks()
         stop_daligner()
         db.remove_daligner_jobs()
-        daligner_script = os.path.join(
-            config.get('general', 'script_directory'),
-            daligner_job_array.filename)
-        if os.path.exists(daligner_script):
-            os.remove(daligner_script)
+        for filename in (daligner_job_array.filename,
+                         daligner_job_array.pull_filename):
+            mj.remove_scripts(os.path.join(
+                config.get('general', 'script_directory'), filename))
 
-    print('Adding daligner jobs to database: ', end='')
-
-    total_n_jobs = int(n_blocks + ((n_blocks - 1) * n_blocks) / 2)
-    current_job = 0
-
-    n_jobs = 5000
-    jobchunk = []
+    try:
+        db.add_blocks((i, '{0}.{1}'.format(projname, i))
+                      for i in range(1, n_blocks + 1))
+    except RuntimeError as rte:
+        print('error: {0}, use --force to override'.format(rte),
+              file=sys.stderr)
+        exit(1)
 
-    for i in range(1, n_blocks + 1):
-        block_name = '{0}.{1}'.format(projname, i)
-        try:
-            db.add_block(i, block_name)
-        except RuntimeError as rte:
-            print('error: {0}, use --force to override'.format(rte),
-                  file=sys.stderr)
-            exit(1)
-        current_job += 1
-        jobchunk.append((current_job, i, i, 1, not no_masking))
-        if current_job % n_jobs == 0:
-            db.add_daligner_jobs(jobchunk)
-            jobchunk = []
-            print('\rAdding daligner jobs to database: {0}/{1}' \
-                  .format(current_job, total_n_jobs), end='')
-
-    for i in range(1, n_blocks + 1):
-        for j in range(i + 1, n_blocks + 1):
-            current_job += 1
-            jobchunk.append((current_job, i, j, i + 1, not no_masking))
-            if current_job % n_jobs == 0:
-                db.add_daligner_jobs(jobchunk)
-                jobchunk = []
-                print('\rAdding daligner jobs to database: {0}/{1}' \
-                      .format(current_job, total_n_jobs), end='')
-
-    if len(jobchunk) > 0:
-        db.add_daligner_jobs(jobchunk)
+    def progress(n_added, n_total):
         print('\rAdding daligner jobs to database: {0}/{1}' \
-              .format(current_job, total_n_jobs), end='')
+              .format(n_added, n_total), end='')
 
+    db.add_daligner_job_matrix(n_blocks,
+                               use_masking_server=not no_masking,
+                               progress=progress)
     print()
 
-def get_daligner_array(ntasks, config, db, masking_jobid=None):
+def get_daligner_array(ntasks, config, db, masking_jobid=None,
+                       reservation_token=None, max_simultaneous_tasks=None):
+    """Reserve daligner jobs and create the job array that runs them.
+
+    In pull mode, set by `daligner start --pull`, no jobs are
+    reserved, since the tasks claim their jobs while running. If a
+    coordinator is running, see `serve`, the tasks go through it
+    instead of accessing the database.
+
+    Parameters
+    ----------
+    ntasks : int
+        Number of tasks in the job array.
+    config : marvelous_config
+        Project config.
+    db : marvel_db
+        Project database.
+    masking_jobid : int, optional
+        Job ID of the masking server.
+    reservation_token : str, optional
+        Token to reserve the jobs with. A new token is generated
+        if not given.
+    max_simultaneous_tasks : int, optional
+        Maximum number of tasks running at the same time. Taken
+        from the config if not given.
+
+    Returns
+    -------
+    tuple
+        The job array, the number of reserved jobs, and an
+        `array('q')` with the row IDs of the reserved jobs.
+    """
+    if reservation_token is None:
+        reservation_token = get_reservation_token()
+    if max_simultaneous_tasks is None:
+        max_simultaneous_tasks = config.getint('daligner',
+                                               'max_simultaneous_tasks')
+    pull = config.getboolean('daligner', 'pull', False)
+    tile_size = get_tile_size(config)
+
     # Reserve jobs
-    reservation_token = hashlib.md5(
-        str(time.time()).encode('utf-8')).hexdigest()
-    n_jobs = 0
-    rowids = []
-    for i in range(1, ntasks + 1):
-        reservation = db.reserve_daligner_jobs(
-            token='{0}_{1}'.format(reservation_token, i),
-            max_jobs=config.getint('daligner', 'jobs_per_task'),
-            comparisons_per_job=config.getint(
-                'daligner', 'comparisons_per_job'))
+    if pull:
+        reservations = []
+    else:
+        reservations = db.reserve_daligner_tasks(
+            ['{0}_{1}'.format(reservation_token, i)
+             for i in range(1, ntasks + 1)],
+            jobs_per_task=config.getint('daligner', 'jobs_per_task'),
+            comparisons_per_job=config.getint('daligner',
+                                              'comparisons_per_job'),
+            tile_size=tile_size)
+
+    n_jobs = sum(len(d['rowids']) for r in reservations for d in r)
+    rowids = array('q', bytes(8 * n_jobs))
+    ri = 0
+    run_directory = config.get('daligner', 'run_directory')
+    for i, reservation in enumerate(reservations, start=1):
         reservation_filename = os.path.join(
-            config.get('daligner', 'run_directory'),
+            run_directory,
             'daligner_task_{0}_{1}.txt'.format(reservation_token, i))
-        with open(reservation_filename, 'w') as f:
+        with open(reservation_filename, 'w', buffering=1 << 16) as f:
             for d in reservation:
-                rowids += d['rowids']
-                n_jobs += len(d['rowids'])
+                rowids[ri:(ri + len(d['rowids']))] = array('q', d['rowids'])
+                ri += len(d['rowids'])
                 f.write('\t'.join(map(str, [d['source_block']] + \
                                             d['rowids'] + \
                                             d['target_blocks'])) + '\n')
-                job_array = daligner_job_array(
-                    ntasks,
-                    config.get('general', 'database'),
-                    reservation_token = reservation_token,
-                    run_directory = config.get('daligner', 'run_directory'),
-                    script_directory=config.get('general', 'script_directory'),
-                    log_directory=config.get('general', 'log_directory'),
-                    jobs_per_task=config.get('daligner', 'jobs_per_task'),
-                    max_simultaneous_tasks=config.getint(
-                        'daligner', 'max_simultaneous_tasks'),
-                    masking_jobid=masking_jobid,
-                    masking_port=config.getint('DMserver', 'port'),
-                    repeat_annotations=config.get('daligner', 'repeats'),
-                    account=config.get('general', 'account'),
-                    timelimit=config.get('daligner', 'timelimit'),
-                    verbose=config.getboolean('daligner', 'verbose'),
-                    identity=config.getboolean('daligner', 'identity'),
-                    tuple_suppression_frequency=config.getint(
-                        'daligner', 'tuple_suppression_frequency'),
-                    correlation_rate=config.getfloat(
-                        'daligner', 'correlation_rate'),
-                    threads=config.getint('daligner', 'threads'))
+
+    job_array = daligner_job_array(
+        ntasks,
+        config.get('general', 'database'),
+        reservation_token = reservation_token,
+        run_directory = run_directory,
+        script_directory=config.get('general', 'script_directory'),
+        log_directory=config.get('general', 'log_directory'),
+        jobs_per_task=config.get('daligner', 'jobs_per_task'),
+        max_simultaneous_tasks=max_simultaneous_tasks,
+        masking_jobid=masking_jobid,
+        masking_port=config.getint('DMserver', 'port'),
+        repeat_annotations=config.get('daligner', 'repeats'),
+        account=config.get('general', 'account'),
+        timelimit=config.get('daligner', 'timelimit'),
+        verbose=config.getboolean('daligner', 'verbose'),
+        identity=config.getboolean('daligner', 'identity'),
+        tuple_suppression_frequency=config.getint(
+            'daligner', 'tuple_suppression_frequency'),
+        correlation_rate=config.getfloat(
+            'daligner', 'correlation_rate'),
+        threads=config.getint('daligner', 'threads'),
+        pull=pull,
+        jobs_per_claim=config.getint('daligner', 'jobs_per_claim') \
+                if pull else 1,
+        comparisons_per_job=config.getint('daligner', 'comparisons_per_job'),
+        coordinator=get_coordinator_address(config))
 
     return job_array, n_jobs, rowids
 
-def submit_daligner_jobs(ntasks, config, db, masking_jobid=None):
+def get_tile_size(config):
+    """Get the tile size of the daligner scheduler, or None if the
+    jobs are reserved in order of priority."""
+    try:
+        return config.getint('daligner', 'tile_size')
+    except KeyError:
+        return None
+
+def submit_daligner_jobs(ntasks, config, db, masking_jobid=None,
+                         chain=False):
+    """Reserve daligner jobs and submit the job arrays that run them.
+
+    If more tasks are requested than fit in one job array, the tasks
+    are split into several arrays. The job ID of each submitted array
+    is recorded in the database, and the jobs of arrays whose
+    submission failed are released.
+
+    Parameters
+    ----------
+    ntasks : int
+        Total number of tasks.
+    config : marvelous_config
+        Project config.
+    db : marvel_db
+        Project database.
+    masking_jobid : int, optional
+        Job ID of the masking server.
+    chain : bool
+        Start each array only after the previous one has finished.
+
+    Returns
+    -------
+    list of tuple
+        The job ID, the number of reserved jobs, and the row IDs of
+        the reserved jobs, for each submitted array.
+
+    Raises
+    ------
+    RuntimeError
+        If the submission of any array failed.
+    """
     if ntasks == 0:
-        return
-    job_array, n_jobs, rowids = get_daligner_array(
-        ntasks, config, db, masking_jobid)
-    return job_array.start(), n_jobs, rowids
+        return []
+    reservation_token = get_reservation_token()
+    shards = mj.split_array(range(ntasks),
+                            slurm_utils.get_max_array_size() - 1)
+    max_simultaneous_tasks, chain = mj.shard_simultaneous_tasks(
+        config.getint('daligner', 'max_simultaneous_tasks'),
+        len(shards), chain)
+
+    arrays = []
+    for i, shard in enumerate(shards, start=1):
+        arrays.append(get_daligner_array(
+            len(shard), config, db, masking_jobid,
+            reservation_token=reservation_token if len(shards) == 1 \
+                    else '{0}-{1}'.format(reservation_token, i),
+            max_simultaneous_tasks=max_simultaneous_tasks))
 
-def backup_database():
+    try:
+        mj.start_job_arrays([a[0] for a in arrays], chain=chain)
+    finally:
+        # Record the arrays that were submitted, and release the jobs
+        # of the others
+        for job_array, _, rowids in arrays:
+            if job_array.jobid is None:
+                db.set_daligner_statuses(dict.fromkeys(
+                    rowids, slurm_utils.status.notstarted))
+                continue
+            db.set_daligner_jobids(rowids, job_array.jobid)
+            if job_array.pull:
+                db.add_daligner_array(job_array.jobid,
+                                      job_array.reservation_token,
+                                      job_array.n_tasks)
+    return [(job_array.jobid, n_jobs, rowids)
+            for job_array, n_jobs, rowids in arrays]
+
+def backup_database(db=None, min_interval=None, quick_check=None):
+    """Check the integrity of the database and back it up.
+
+    Parameters
+    ----------
+    db : marvel_db
+        The database to back up. If None, the project database is
+        opened.
+    min_interval : float
+        If not None, skip the backup if the existing backup is younger
+        than this many seconds, or if the database has not changed
+        since.
+    quick_check : bool
+        Use the quick integrity check instead of the full one. If None,
+        this is read from the `integrity_check` key in the `database`
+        section of the config.
+    """
     config = mc()
-    db = get_database()
-    print('Checking database integrity...')
-    if not db.integrity_check():
-        print('error: database corrupted, manual cleanup required',
-              file=sys.stderr)
-        sys.exit(1)
-    print('Backing up database...')
-    db.backup('{0}.backup'.format(config.get('general', 'database')))
+    if db is None:
+        db = get_database()
+    if quick_check is None:
+        try:
+            quick_check = config.get('database', 'integrity_check') == 'quick'
+        except KeyError:
+            quick_check = False
+    backup_filename = '{0}.backup'.format(config.get('general', 'database'))
+    if min_interval is not None \
+            and db.backup_is_current(backup_filename, min_interval):
+        print('Backup is up to date')
+        return
 
-def update_daligner_queue(n_tasks):
-    config = mc()
-    db = get_database()
     print('Checking database integrity...')
-    if not db.integrity_check():
+    if not db.integrity_check(quick=quick_check):
         print('error: database corrupted, manual cleanup required',
               file=sys.stderr)
         sys.exit(1)
-    print('Backing up database...')
-    db.backup('{0}.backup'.format(config.get('general', 'database')))
-    update_statuses()
 
+    def progress(status, remaining, total):
+        print('\rBacking up database: {0}/{1} pages'
+              .format(total - remaining, total), end='', flush=True)
+
+    db.backup(backup_filename, progress=progress)
+    print()
+
+def get_queued_daligner_tasks(db):
+    """Get the number of daligner tasks that take up a place in the
+    SLURM queue, counting the masking server as one."""
+    # Tasks in pull mode only have jobs once they are running
+    queued_tasks = db.get_n_running_tasks() + \
+        sum(len(x) for x in get_pull_tasks(db).values())
+
+    if db.any_using_masking():
+        queued_tasks += 1
+    return queued_tasks
+
+def queue_daligner_tasks(db, config, n_tasks=None, chain=False):
+    """Fill up the SLURM queue with daligner tasks.
+
+    At most `max_number_of_jobs` tasks are queued or running when
+    this returns.
+
+    Parameters
+    ----------
+    db : marvel_db
+        Project database.
+    config : marvelous_config
+        Project config.
+    n_tasks : int, optional
+        Maximum number of tasks to queue. Defaults to
+        `max_number_of_jobs`.
+    chain : bool
+        If the tasks do not fit in one job array, start each array
+        after the previous one has finished.
+
+    Returns
+    -------
+    int
+        The number of daligner jobs that were queued.
+
+    Raises
+    ------
+    RuntimeError
+        If the submission failed.
+    """
     jobs_not_started = db.n_daligner_jobs(slurm_utils.status.notstarted)
     if jobs_not_started == 0:
-        print('error: no jobs left to queue', file=sys.stderr)
-        sys.exit(1)
+        return 0
 
     max_slurm_jobs = config.getint('general', 'max_number_of_jobs')
     if n_tasks is None:
         n_tasks = max_slurm_jobs
 
-    jobs_per_task = config.getint('daligner', 'jobs_per_task') * \
-        config.getint('daligner', 'comparisons_per_job')
-    max_tasks = min(jobs_not_started // jobs_per_task,
-                    n_tasks)
-    queued_tasks = db.get_n_running_tasks()
-
-    if db.any_using_masking():
-        queued_tasks += 1
+    pull = config.getboolean('daligner', 'pull', False)
+    tile_size = get_tile_size(config)
+    if not pull and tile_size is not None:
+        # Each task runs one tile
+        max_tasks = min(db.n_daligner_tiles(tile_size), n_tasks)
+    else:
+        if pull:
+            jobs_per_task = config.getint('daligner', 'jobs_per_claim')
+        else:
+            jobs_per_task = config.getint('daligner', 'jobs_per_task')
+        jobs_per_task *= config.getint('daligner', 'comparisons_per_job')
+        max_tasks = min(jobs_not_started // jobs_per_task,
+                        n_tasks)
+    queued_tasks = get_queued_daligner_tasks(db)
 
     if max_tasks == 0:
         tasks_to_queue = 1
@@ -325,21 +589,34 @@ def update_daligner_queue(n_tasks):
     else:
         tasks_to_queue = max_tasks
 
-    if tasks_to_queue == 0:
+    if tasks_to_queue <= 0:
         print('Queueing no jobs...')
-        return
+        return 0
 
     print('Queueing jobs...')
 
+    return sum(n for _, n, _ in submit_daligner_jobs(
+        tasks_to_queue, config, db, db.get_masking_jobid(), chain))
+
+def update_daligner_queue(n_tasks, chain=False):
+    config = mc()
+    db = get_database()
+    backup_database(db, min_interval=config.getfloat(
+        'database', 'backup_interval', 3600))
+    update_statuses(reconcile=True)
+
+    if db.n_daligner_jobs(slurm_utils.status.notstarted) == 0:
+        print('error: no jobs left to queue', file=sys.stderr)
+        sys.exit(1)
+
     try:
-        jobid, n_jobs, rowids = submit_daligner_jobs(
-            tasks_to_queue, config, db, db.get_masking_jobid())
-        db.set_daligner_jobids(rowids, jobid)
+        n_jobs = queue_daligner_tasks(db, config, n_tasks, chain)
     except RuntimeError as rte:
         print('error: job submission failed\n{0}'.format(rte), file=sys.stderr)
         sys.exit(1)
 
-    print('Queued {0} jobs'.format(n_jobs))
+    if n_jobs > 0:
+        print('Queued {0} jobs'.format(n_jobs))
 
 def stop_daligner(status=(slurm_utils.status.running,
                           slurm_utils.status.pending)):
@@ -355,6 +632,9 @@ def stop_daligner(status=(slurm_utils.status.running,
 
     print('Stopping daligner jobs...')
 
+    unique_tasks.update(jobid for jobid, tasks in get_pull_tasks(
+        db, slurm_utils.live_states).items() if len(tasks) > 0)
+
     if len(unique_tasks) > 0:
         slurm_utils.cancel_jobs(unique_tasks)
     # Also cancel any reservations. If jobs have been reserved,
@@ -364,9 +644,295 @@ def stop_daligner(status=(slurm_utils.status.running,
 
     update_statuses()
 
+def get_pull_tasks(db, states=(slurm_utils.status.pending,)):
+    """Get the tasks of daligner arrays in pull mode that are in the
+    given states.
+
+    Arrays without any tasks left in the queue are forgotten.
+
+    Parameters
+    ----------
+    db : marvel_db
+        Project database.
+    states : tuple of str
+        SLURM job states of the tasks to get.
+
+    Returns
+    -------
+    dict
+        Task IDs on the form <job_id>_<task_id>, keyed by the job ID
+        of the array.
+    """
+    arrays = db.get_daligner_arrays()
+    if len(arrays) == 0:
+        return {}
+    snapshot = slurm_utils.get_snapshot(arrays)
+    tasks = {}
+    finished = []
+    for jobid in arrays:
+        array_tasks = snapshot.array_tasks(jobid)
+        if not any(t['job_state'] in slurm_utils.live_states
+                   for t in array_tasks.values()):
+            finished.append(jobid)
+        tasks[jobid] = [task_id for task_id, t in array_tasks.items()
+                        if t['job_state'] in states]
+    db.remove_daligner_arrays(finished)
+    return tasks
+
+def claim_daligner_jobs(token, jobid, n_jobs, comparisons_per_job=1,
+                        completed=(), failed=()):
+    """Claim daligner jobs for a task in pull mode and print them in
+    the same format as the reservation files."""
+    db = get_database()
+    claimed = db.claim_daligner_jobs(token, jobid, n_jobs,
+                                     comparisons_per_job,
+                                     completed=completed, failed=failed)
+    for d in claimed:
+        print('\t'.join(map(str, [d['source_block']] + d['rowids'] + \
+                                  d['target_blocks'])))
+
 def get_reservation_token():
     return hashlib.md5(str(time.time()).encode('utf-8')).hexdigest()
 
+# Output files of each block stage, relative to the project directory.
+# A block has completed a stage if all files of any of the
+# alternatives exist and are non-empty. They are only used to import
+# the progress of projects that were started before the stages were
+# tracked in the database.
+block_stage_files = {
+    'merge': [['{project}.{block}.las']],
+    'annotate': [['.{project}.{block}.q.a2', '.{project}.{block}.trim.a2']],
+    'patch': [[patch_job_array.out_filename.format(db='{project}',
+                                                    block='{block}',
+                                                    trim=trim)]
+              for trim in ('', '.trimmed')],
+    'repeats': [['.{project}.{block}.repeats.a2']],
+    'stats': [[os.path.join('stats', '{project}.{block}.stats.txt')]],
+    'tkmerge': [['.{project}.q.a2', '.{project}.trim.a2',
+                 '.{project}.repeats.a2']]
+}
+
+def import_block_stages(db):
+    """Mark the blocks whose stage output files already exist as
+    completed."""
+    config = mc()
+    directory = config.get('general', 'directory')
+    project = db.get_project_name()
+
+    snapshot = fs_utils.directory_snapshot(
+        [directory, os.path.join(directory, 'stats')],
+        match=lambda name: project in name)
+
+    blocks = db.get_blocks()
+    db.begin_exclusive()
+    for stage, alternatives in block_stage_files.items():
+        completed = {}
+        for b in blocks:
+            if any(all(snapshot.size(os.path.join(
+                           directory, f.format(project=project, block=b))) > 0
+                       for f in files)
+                   for files in alternatives):
+                completed[b] = slurm_utils.status.completed
+        db.set_block_stage_statuses(stage, completed, commit=False)
+    db.stop_exclusive()
+    db.block_stage_created = False
+
+def reserve_blocks(db, stage, blocks, n, force=False):
+    """Reserve blocks for a stage.
+
+    Parameters
+    ----------
+    db : marvel_db
+        The project database.
+    stage : str
+        Name of the stage.
+    blocks : list of int
+        Candidate blocks, in the order they should be reserved.
+    n : int
+        Maximum number of blocks to reserve.
+    force : bool
+        Also reserve blocks that have already completed the stage.
+
+    Returns
+    -------
+    tuple
+        The reservation token and the list of reserved blocks.
+    """
+    reservation_token = get_reservation_token()
+    blocks = db.reserve_block_stage(stage, blocks, reservation_token, n,
+                                    force)
+    return reservation_token, blocks
+
+def group_dependent_blocks(blocks, dependencies):
+    """Group blocks by the job arrays they depend on.
+
+    Within a group, the blocks are ordered by the array tasks they
+    depend on, so that when a stage is submitted with the same layout
+    as its input, the tasks of both arrays line up and can be
+    connected with an aftercorr dependency, see `get_shard_dependency`.
+
+    Parameters
+    ----------
+    blocks : list of int
+        Blocks to group.
+    dependencies : dict
+        SLURM job IDs that each block depends on, keyed by block.
+        Array tasks are given as `<jobid>_<task_id>`.
+
+    Returns
+    -------
+    list of list of int
+        The groups, in the order of their first block.
+    """
+    def array_tasks(b):
+        return sorted(tuple(int(x) for x in str(jobid).split('_'))
+                      for jobid in dependencies.get(b, ())
+                      if '_' in str(jobid))
+
+    groups = collections.OrderedDict()
+    for b in blocks:
+        key = tuple(jobid for jobid, _ in array_tasks(b))
+        groups.setdefault(key, []).append(b)
+    return [sorted(group, key=array_tasks) for group in groups.values()]
+
+def get_shard_dependency(shard, dependencies):
+    """Get the SLURM dependency of the job array of a shard.
+
+    If task `i` of the shard depends on task `i` of another job array
+    for all its blocks, and on no other task of that array, it only
+    waits for its own task with `aftercorr`. The shard waits for all
+    other jobs with `afterok`.
+
+    Parameters
+    ----------
+    shard : list of list of int
+        The blocks of each task of the shard.
+    dependencies : dict
+        SLURM job IDs that each block depends on, keyed by block.
+
+    Returns
+    -------
+    str or None
+        The dependency, or None if the shard does not depend on
+        anything.
+    """
+    after = set(str(x) for t in shard for b in t
+                for x in dependencies.get(b, ()))
+    array_tasks = {}
+    for task_id, task_blocks in enumerate(shard, start=1):
+        for b in task_blocks:
+            for x in dependencies.get(b, ()):
+                jobid, _, array_task_id = str(x).partition('_')
+                if len(array_task_id) > 0:
+                    array_tasks.setdefault(jobid, set()).add(
+                        (task_id, int(array_task_id)))
+    corr = sorted(jobid for jobid, tasks in array_tasks.items()
+                  if all(i == j for i, j in tasks)
+                  and len(tasks) == len(shard))
+    after.difference_update('{0}_{1}'.format(jobid, i)
+                            for jobid in corr
+                            for i in range(1, len(shard) + 1))
+    dependency = ['aftercorr:{0}'.format(jobid) for jobid in corr]
+    if len(after) > 0:
+        dependency.append('afterok:{0}'.format(':'.join(sorted(after))))
+    return ','.join(dependency) if len(dependency) > 0 else None
+
+def submit_block_arrays(db, stage, reservation_token, blocks,
+                        reservation_file, make_job,
+                        max_simultaneous_tasks=None, chain=False,
+                        blocks_per_task=1, dependencies=None):
+    """Submit the job arrays that process reserved blocks.
+
+    The blocks are split into as many job arrays as needed to stay
+    within the cluster's MaxArraySize. Each array gets its own
+    reservation token, so the job scripts do not have to know about
+    the split. The array task of each block is recorded in the
+    database, and the blocks of shards whose submission failed are
+    released.
+
+    Parameters
+    ----------
+    db : marvel_db
+        The project database.
+    stage : str
+        Name of the stage.
+    reservation_token : str
+        Token the blocks were reserved with, see `reserve_blocks`.
+    blocks : list of int
+        Blocks to process.
+    reservation_file : str
+        Template for the reservation files, formatted with the
+        reservation token and the task ID.
+    make_job : callable
+        Called as `make_job(blocks, reservation_token,
+        max_simultaneous_tasks)` to create the job array of each shard.
+    max_simultaneous_tasks : int, optional
+        Maximum number of tasks running at the same time, for all
+        shards together.
+    chain : bool
+        Start each shard only after the previous one has finished.
+    blocks_per_task : int
+        Number of blocks that each array task processes.
+    dependencies : dict, optional
+        SLURM job IDs that must complete successfully before a block
+        can be processed, keyed by block. The blocks are grouped by
+        the job arrays they depend on, see `group_dependent_blocks`,
+        and each array is cancelled if any of its dependencies fails.
+
+    Returns
+    -------
+    list of int
+        The job IDs of the submitted arrays.
+    """
+    max_array_size = slurm_utils.get_max_array_size() - 1
+    if dependencies is None:
+        groups = [blocks]
+    else:
+        groups = group_dependent_blocks(blocks, dependencies)
+    shards = [shard for group in groups
+              for shard in mj.split_array(
+                  mj.split_array(group, blocks_per_task), max_array_size)]
+    shard_max_tasks, chain = mj.shard_simultaneous_tasks(
+        max_simultaneous_tasks, len(shards), chain)
+
+    jobs = []
+    shard_tokens = []
+    try:
+        for i, shard in enumerate(shards, start=1):
+            shard_token = reservation_token if len(shards) == 1 \
+                    else '{0}-{1}'.format(reservation_token, i)
+            for task_id, task_blocks in enumerate(shard, start=1):
+                with open(reservation_file.format(shard_token, task_id),
+                          'w') as f:
+                    for b in task_blocks:
+                        f.write('{}\n'.format(b))
+            job = make_job([b for t in shard for b in t], shard_token,
+                           shard_max_tasks)
+            if dependencies is not None:
+                dependency = get_shard_dependency(shard, dependencies)
+                if dependency is not None:
+                    job.sbatch_args['dependency'] = dependency
+                    job.sbatch_args['kill_on_invalid_dep'] = True
+            jobs.append(job)
+            shard_tokens.append(shard_token)
+
+        mj.start_job_arrays(jobs, chain=chain)
+    finally:
+        # Record the shards that were submitted, and release the
+        # blocks of the others
+        db.set_block_stage_tasks(stage, (
+            (b, shard_token, job.jobid, task_id, job.logfile)
+            for shard, shard_token, job in zip(shards, shard_tokens, jobs)
+            if job.jobid is not None
+            for task_id, task_blocks in enumerate(shard, start=1)
+            for b in task_blocks))
+        db.release_block_stage(stage, reservation_token)
+
+    jobids = [job.jobid for job in jobs]
+    print('Jobs submitted in job array{0} {1}'.format(
+        's' if len(jobids) > 1 else '', ', '.join(map(str, jobids))))
+    return jobids
+
 def cancel_daligner_reservation():
     config = mc()
     db = get_database()
@@ -381,55 +947,18 @@ def list_blocks():
     config = mc()
     db = get_database()
 
-    directory = config.get('general', 'directory')
-    stat_directory = os.path.join(directory, 'stats')
-    project = db.get_project_name()
-    blocks = db.get_blocks()
-    completed_blocks = db.get_completed_blocks()
-
-    block_stats = {}
-
-    def stage_completed(fname):
-        """Check if a certain marvel stage has completed.
-
-        This is done by checking if the file exists, has
-        a non-zero size, and was modified at least 5 minutes
-        ago. The last rule is to prevent classifying a stage
-        as completed if it is currently running.
-
-        Returns
-        -------
-        bool
-            True if the stage associated with `fname` has
-            finished, otherwise False.
-        """
-        if not os.path.exists(fname):
-            return False
-        s = os.stat(fname)
-        return s.st_size > 0 and (time.time() - s.st_mtime) > 60 * 5
-
-    for b in blocks:
-        block_file = os.path.join(directory, '{}.{}.las'.format(project, b))
-        q_file = os.path.join(directory, '.{}.{}.q.a2'.format(project, b))
-        trim_file = os.path.join(directory,
-                                 '.{}.{}.trim.a2'.format(project, b))
-        stat_file = os.path.join(stat_directory,
-                                 '{}.{}.stats.txt'.format(project, b))
-        block_stats[b] = {
-            'aligned': b in completed_blocks,
-            'merged': stage_completed(block_file),
-            'quality_annotated': stage_completed(q_file),
-            'trim_annotated': stage_completed(trim_file),
-            'stats': stage_completed(stat_file)
-        }
+    db.update_block_stages()
+    counts = db.block_stage_counts()
 
-    stat_summary = collections.defaultdict(int)
-    for b, stats in block_stats.items():
-        stat_summary['Aligned'] += int(stats['aligned'])
-        stat_summary['Merged'] += int(stats['merged'])
-        stat_summary['Quality annotated'] += int(stats['quality_annotated'])
-        stat_summary['Trim annotated'] += int(stats['trim_annotated'])
-        stat_summary['Stats generated'] += int(stats['stats'])
+    stat_summary = collections.OrderedDict()
+    stat_summary['Aligned'] = len(db.get_completed_blocks())
+    for stage, label in [('merge', 'Merged'),
+                         ('annotate', 'Annotated'),
+                         ('repeats', 'Repeat annotated'),
+                         ('patch', 'Patched'),
+                         ('stats', 'Stats generated')]:
+        stat_summary[label] = counts.get(stage, {}) \
+                .get(slurm_utils.status.completed, 0)
 
     widest = max(map(len, stat_summary.keys()))
     for k, v in stat_summary.items():
@@ -437,7 +966,7 @@ def list_blocks():
 
 def list_completed_blocks():
     config = mc()
-    db = get_database()
+    db = get_database(read_only=True)
 
     blocks = db.get_completed_blocks()
 
@@ -445,7 +974,7 @@ def list_completed_blocks():
 
 def check_block(block, run):
     config = mc()
-    db = get_database()
+    db = get_database(read_only=True)
 
     directory = config.get('general', 'directory')
     project = db.get_project_name()
@@ -473,44 +1002,26 @@ def check_block(block, run):
 
     print('Job {} submitted'.format(jobid))
 
-def merge_blocks(n, n_files, max_simultaneous_tasks=None):
+def merge_blocks(n, n_files, max_simultaneous_tasks=None, chain=False,
+                 blocks_per_task=1, cores=None, blocks=None):
     config = mc()
     db = get_database()
 
     project = db.get_project_name()
-    print('Fetching completed blocks...')
-    blocks = db.get_completed_blocks()
-
-    merged_filename = os.path.join(config.get('general', 'directory'),
-                                   '{}.{{}}.las'.format(project))
+    if blocks is None:
+        print('Fetching completed blocks...')
+        blocks = db.get_completed_blocks()
 
     run_directory = os.path.join(config.get('general', 'directory'),
                                  'merge_runs')
     if not os.path.isdir(run_directory):
         os.mkdir(run_directory)
 
-    reservation_token = get_reservation_token()
-    reservation_file = os.path.join(run_directory, 'merge_task_{}_{{}}.txt' \
-                                    .format(reservation_token))
+    reservation_file = os.path.join(run_directory, 'merge_task_{}_{}.txt')
 
-    blocks_to_merge = []
-    task_id = 0
     print('Reserving blocks...')
-    for b in blocks:
-        if len(blocks_to_merge) == n:
-            break
-
-        fname = merged_filename.format(b)
-        if os.path.exists(fname):
-            # print('{} already exists'.format(os.path.basename(fname)))
-            continue
-
-        open(fname, 'a').close()
-        blocks_to_merge.append(b)
-        task_id += 1
-        with open(reservation_file.format(task_id), 'w') as f:
-            f.write('{}\n'.format(b))
-
+    reservation_token, blocks_to_merge = reserve_blocks(db, 'merge',
+                                                        blocks, n)
 
     if len(blocks_to_merge) == 0:
         print('No blocks to merge')
@@ -518,29 +1029,36 @@ def merge_blocks(n, n_files, max_simultaneous_tasks=None):
 
     print('Reserved {} blocks'.format(len(blocks_to_merge)))
 
-    merge_job = merge_job_array(blocks_to_merge,
-                                project,
-                                n_files=n_files,
-                                max_simultaneous_tasks=max_simultaneous_tasks,
-                                script_directory=config.get(
-                                    'general', 'script_directory'),
-                                log_directory=config.get('general',
-                                                         'log_directory'),
-                                reservation_token=reservation_token,
-                                run_directory=run_directory,
-                                account=config.get('general', 'account'),
-                                verbose=False)
-
-    jobid = merge_job.start()
-
-    print('Jobs submitted in job array {}'.format(jobid))
-
-def get_merged_blocks():
+    def make_job(blocks, reservation_token, max_simultaneous_tasks):
+        return merge_job_array(blocks,
+                               project,
+                               n_files=n_files,
+                               max_simultaneous_tasks=max_simultaneous_tasks,
+                               script_directory=config.get(
+                                   'general', 'script_directory'),
+                               log_directory=config.get('general',
+                                                        'log_directory'),
+                               reservation_token=reservation_token,
+                               run_directory=run_directory,
+                               account=config.get('general', 'account'),
+                               verbose=False,
+                               blocks_per_task=blocks_per_task,
+                               cores=cores)
+
+    submit_block_arrays(db, 'merge', reservation_token, blocks_to_merge,
+                        reservation_file, make_job,
+                        max_simultaneous_tasks, chain, blocks_per_task)
+
+def get_merged_blocks(db):
     """Get a list of merged blocks.
 
-    A block is considered merged if the merged file exists,
-    has a size larger than 0, and the latest modification of
-    it happened at least five minutes ago.
+    The status of the merge jobs is updated first, so that blocks
+    that have just been merged are included.
+
+    Parameters
+    ----------
+    db : marvel_db
+        The project database.
 
     Returns
     -------
@@ -548,112 +1066,95 @@ def get_merged_blocks():
         A list of integers corresponding to the IDs of
         merged blocks.
     """
-    config = mc()
-    db = get_database()
+    db.update_block_stages()
+    return db.get_block_stage('merge')
 
-    directory = config.get('general', 'directory')
-    project = db.get_project_name()
-
-    las_regex = re.compile(r'^{}\.(\d+)\.las$'.format(project))
-
-    merged_blocks = []
-    for fname in os.listdir(directory):
-        if las_regex.match(fname):
-            fs = os.stat(os.path.join(directory, fname))
-            if fs.st_size > 0 and \
-                    time.time() - fs.st_mtime > 5*60:
-                merged_blocks.append(int(las_regex.match(fname).group(1)))
-
-    return sorted(merged_blocks)
-
-def annotate_blocks(n, max_simultaneous_tasks, force=False):
+def annotate_blocks(n, max_simultaneous_tasks, force=False, chain=False,
+                    blocks_per_task=1, cores=None, blocks=None,
+                    dependencies=None):
     config = mc()
     db = get_database()
 
     project = db.get_project_name()
     directory = config.get('general', 'directory')
-    print('Fetching merged blocks...')
-    blocks = get_merged_blocks()
-    print('{} merged blocks found'.format(len(blocks)))
+    if blocks is None:
+        print('Fetching merged blocks...')
+        blocks = get_merged_blocks(db)
+        print('{} merged blocks found'.format(len(blocks)))
 
     run_directory = os.path.join(directory, 'annotate_runs')
     if not os.path.exists(run_directory):
         os.mkdir(run_directory)
-    reservation_token = get_reservation_token()
-    reservation_file = os.path.join(run_directory,
-                                    'annotate_task_{}_{{}}.txt' \
-                                        .format(reservation_token))
-
-    q_file = os.path.join(directory, '.{}.{{}}.q.a2'.format(project))
-    trim_file = os.path.join(directory, '.{}.{{}}.trim.a2'.format(project))
+    reservation_file = os.path.join(run_directory, 'annotate_task_{}_{}.txt')
 
     print('Reserving maximum {} blocks...'.format(n))
-    blocks_to_annotate = []
-    task_id = 0
-    for b in blocks:
-        if not force \
-           and os.path.exists(q_file.format(b)) \
-           and os.path.exists(trim_file.format(b)):
-            continue
-
-        if len(blocks_to_annotate) == n:
-            break
-
-        open(trim_file.format(b), 'a').close()
-        open(q_file.format(b), 'a').close()
-        blocks_to_annotate.append(b)
-
-        task_id += 1
-        with open(reservation_file.format(task_id), 'w') as f:
-            f.write('{}\n'.format(b))
+    reservation_token, blocks_to_annotate = reserve_blocks(
+        db, 'annotate', blocks, n, force)
     print('Reserved {} blocks'.format(len(blocks_to_annotate)))
     if len(blocks_to_annotate) == 0:
         print('No blocks to annotate')
         return
 
-    job = annotate_job_array(blocks_to_annotate,
-                             project,
-                             max_simultaneous_tasks,
-                             script_directory=config.get('general',
-                                                         'script_directory'),
-                             log_directory=config.get('general',
-                                                      'log_directory'),
-                             reservation_token=reservation_token,
-                             run_directory=run_directory,
-                             account=config.get('general', 'account'))
-
-    jobid = job.start()
-
-    print('Jobs submitted in job array {}'.format(jobid))
-
-def merge_annotations(timelimit=None):
+    def make_job(blocks, reservation_token, max_simultaneous_tasks):
+        return annotate_job_array(blocks,
+                                  project,
+                                  max_simultaneous_tasks,
+                                  script_directory=config.get(
+                                      'general', 'script_directory'),
+                                  log_directory=config.get('general',
+                                                           'log_directory'),
+                                  reservation_token=reservation_token,
+                                  run_directory=run_directory,
+                                  account=config.get('general', 'account'),
+                                  blocks_per_task=blocks_per_task,
+                                  cores=cores)
+
+    submit_block_arrays(db, 'annotate', reservation_token,
+                        blocks_to_annotate, reservation_file, make_job,
+                        max_simultaneous_tasks, chain, blocks_per_task,
+                        dependencies)
+
+def merge_annotations(timelimit=None, dependencies=None):
     config = mc()
     db = get_database()
 
-    # Check that all annotation files exist
-    print('Looking for annotation files...')
-    project = config.get('general', 'name')
-    proj_dir = config.get('general', 'directory')
-    n_blocks = db.get_n_blocks()
-
-    for b in range(1, n_blocks + 1):
-        files = map(lambda x: x.format(project, b),
-                    ['.{}.{}.q.a2', '.{}.{}.q.d2',
-                     '.{}.{}.trim.a2', '.{}.{}.trim.d2',
-                     '.{}.{}.repeats.a2', '.{}.{}.repeats.d2'])
-        for f in files:
-            if not os.path.isfile(os.path.join(proj_dir, f)) \
-               or os.stat(os.path.join(proj_dir, f)).st_size == 0:
+    blocks = db.get_blocks()
+    if dependencies is None:
+        # Check that all blocks have been annotated
+        print('Checking block annotations...')
+        db.update_block_stages()
+        for stage in ('annotate', 'repeats'):
+            if len(db.get_block_stage(stage)) < len(blocks):
                 print('error: not all annotation files exist, '
                       'make sure to annotate all blocks',
-                      file=os.stderr)
-                exit(1)
+                      file=sys.stderr)
+                sys.exit(1)
 
     config.update('merge_annotations', 'timelimit',
                   timelimit, '1-00:00:00')
 
+    # TKmerge is a single job for all blocks
+    reservation_token, reserved = reserve_blocks(db, 'tkmerge', blocks,
+                                                 len(blocks), force=True)
+    if len(reserved) < len(blocks):
+        db.release_block_stage('tkmerge', reservation_token)
+        print('error: annotation tracks are already being merged',
+              file=sys.stderr)
+        sys.exit(1)
+
     merge_job = annotation_merge_job(config)
-    jobid = merge_job.start()
+    if dependencies is not None and len(dependencies) > 0:
+        merge_job.sbatch_args['dependency'] = 'afterok:{0}'.format(
+            ':'.join(sorted(dependencies)))
+        merge_job.sbatch_args['kill_on_invalid_dep'] = True
+    try:
+        jobid = merge_job.start()
+    except Exception:
+        db.release_block_stage('tkmerge', reservation_token)
+        raise
+    db.set_block_stage_tasks('tkmerge', (
+        (b, reservation_token, jobid, None, merge_job.logfile)
+        for b in blocks))
 
     print('Job submitted: {}'.format(jobid))
 
@@ -663,34 +1164,31 @@ def patch_blocks(n,
                  trim=False,
                  min_read_length=None,
                  force=False,
-                 timelimit=None):
+                 timelimit=None,
+                 chain=False,
+                 blocks_per_task=1,
+                 cores=None,
+                 blocks=None,
+                 dependencies=None):
     config = mc()
     db = get_database()
 
     project = db.get_project_name()
     directory = config.get('general', 'directory')
 
-    # Check if the merged annotation files are available
+    # Check if the merged annotation files are available, unless the
+    # pipeline has already checked that TKmerge has been queued
     q_files = [os.path.join(directory, '.{}.q.{}2'.format(project, x)) \
               for x in ['a', 'd']]
     trim_files = [os.path.join(directory, '.{}.trim.{}2'.format(project, x)) \
                   for x in ['a', 'd']]
-    block_annot_file = os.path.join(
-        directory, '.{}.{{}}.{{}}.{{}}2'.format(project))
-    if not all(os.path.exists(x) for x in q_files) \
-       or not all(os.path.exists(y) for y in trim_files):
+    if blocks is None and (not all(os.path.exists(x) for x in q_files) \
+                           or not all(os.path.exists(y) for y in trim_files)):
         print('Merged annotation files not found, '
               'looking for block annotations.')
-        # Are all block-specific files present?
-        missing_annot = False
-        for b in range(1, db.get_n_blocks()+1):
-            if not os.path.exists(block_annot_file.format(b, 'q', 'a')) \
-               or not os.path.exists(block_annot_file.format(b, 'q', 'd')) \
-               or not os.path.exists(block_annot_file.format(b, 'trim', 'a')) \
-               or not os.path.exists(block_annot_file.format(b, 'trim', 'd')):
-                missing_annot = True
-                break
-        if missing_annot:
+        # Have all blocks been annotated?
+        db.update_block_stages()
+        if len(db.get_block_stage('annotate')) < db.get_n_blocks():
             print('Some block annotations are missing.\n'
                   'Run marvelous_jobs blocks annotate to generate these.',
                   file=sys.stderr)
@@ -700,9 +1198,10 @@ def patch_blocks(n,
                   'patching can start')
         sys.exit(1)
 
-    print('Fetching merged blocks...')
-    blocks = get_merged_blocks()
-    print('{} merged blocks found'.format(len(blocks)))
+    if blocks is None:
+        print('Fetching merged blocks...')
+        blocks = get_merged_blocks(db)
+        print('{} merged blocks found'.format(len(blocks)))
 
     run_directory = os.path.join(directory, 'patch_runs')
 
@@ -713,60 +1212,46 @@ def patch_blocks(n,
 
     if not os.path.exists(run_directory):
         os.mkdir(run_directory)
-    reservation_token = get_reservation_token()
-    reservation_file = os.path.join(run_directory,
-                                    'patch_task_{}_{{}}.txt' \
-                                    .format(reservation_token))
+    reservation_file = os.path.join(run_directory, 'patch_task_{}_{}.txt')
 
     print('Reserving maximum {} blocks...'.format(n))
-    blocks_to_patch = []
-    task_id = 0
-    for b in blocks:
-        fasta_file = os.path.join(
-            directory, patch_job_array.out_filename \
-            .format(db=project, block=b,
-                    trim='.trimmed' \
-                        if config.getboolean('patch_blocks', 'trim') \
-                        else ''))
-
-        if not force \
-           and os.path.exists(fasta_file):
-            continue
-
-        if len(blocks_to_patch) == n:
-            break
-
-        open(fasta_file, 'a').close()
-        blocks_to_patch.append(b)
-
-        task_id += 1
-        with open(reservation_file.format(task_id), 'w') as f:
-            f.write('{}\n'.format(b))
+    reservation_token, blocks_to_patch = reserve_blocks(db, 'patch', blocks,
+                                                        n, force)
 
     print('Reserved {} blocks'.format(len(blocks_to_patch)))
     if len(blocks_to_patch) == 0:
         print('No blocks available to patch')
         return
 
-    job = patch_job_array(blocks_to_patch,
-                          max_simultaneous_tasks,
-                          update_repeat_annotations,
-                          config,
-                          reservation_token=reservation_token)
-
-    jobid = job.start()
+    def make_job(blocks, reservation_token, max_simultaneous_tasks):
+        return patch_job_array(blocks,
+                               max_simultaneous_tasks,
+                               update_repeat_annotations,
+                               config,
+                               reservation_token=reservation_token,
+                               blocks_per_task=blocks_per_task,
+                               cores=cores)
 
-    print('Jobs submitted in job array {}'.format(jobid))
+    submit_block_arrays(db, 'patch', reservation_token, blocks_to_patch,
+                        reservation_file, make_job,
+                        max_simultaneous_tasks, chain, blocks_per_task,
+                        dependencies)
 
 def repeat_annotate(n,
                     max_simultaneous_tasks=None,
-                    timelimit=None):
+                    timelimit=None,
+                    chain=False,
+                    blocks_per_task=1,
+                    cores=None,
+                    blocks=None,
+                    dependencies=None):
     config = mc()
     db = get_database()
 
-    print('Fetching merged blocks...')
-    blocks = get_merged_blocks()
-    print('{} merged blocks found'.format(len(blocks)))
+    if blocks is None:
+        print('Fetching merged blocks...')
+        blocks = get_merged_blocks(db)
+        print('{} merged blocks found'.format(len(blocks)))
 
     directory = config.get('general', 'directory')
     project = config.get('general', 'name')
@@ -777,64 +1262,49 @@ def repeat_annotate(n,
 
     if not os.path.exists(run_directory):
         os.mkdir(run_directory)
-    reservation_token = get_reservation_token()
     reservation_file = os.path.join(run_directory,
-                                    'annotate_repeats_{}_{{}}.txt' \
-                                    .format(reservation_token))
+                                    'annotate_repeats_{}_{}.txt')
 
     print('Reserving maximum {} blocks...'.format(n))
-    blocks_to_annotate = []
-    task_id = 0
-    for b in blocks:
-        repeat_file = os.path.join(
-            directory, '.{db}.{block}.repeats.a2' \
-            .format(db=project, block=b))
-
-        if os.path.exists(repeat_file):
-            continue
-
-        if len(blocks_to_annotate) == n:
-            break
-
-        open(repeat_file, 'a').close()
-        blocks_to_annotate.append(b)
-
-        task_id += 1
-        with open(reservation_file.format(task_id), 'w') as f:
-            f.write('{}\n'.format(b))
+    reservation_token, blocks_to_annotate = reserve_blocks(db, 'repeats',
+                                                           blocks, n)
 
     print('Reserved {} blocks'.format(len(blocks_to_annotate)))
     if len(blocks_to_annotate) == 0:
         print('No blocks available to annotate')
         return
 
-    job = repeat_annotation_array(blocks_to_annotate,
-                                  max_simultaneous_tasks,
-                                  config,
-                                  reservation_token=reservation_token)
-
-    jobid = job.start()
-
-    print('Jobs submitted in job array {}'.format(jobid))
-
-def block_stats(n, max_simultaneous_tasks=None, force=False):
+    def make_job(blocks, reservation_token, max_simultaneous_tasks):
+        return repeat_annotation_array(blocks,
+                                       max_simultaneous_tasks,
+                                       config,
+                                       reservation_token=reservation_token,
+                                       blocks_per_task=blocks_per_task,
+                                       cores=cores)
+
+    submit_block_arrays(db, 'repeats', reservation_token,
+                        blocks_to_annotate, reservation_file, make_job,
+                        max_simultaneous_tasks, chain, blocks_per_task,
+                        dependencies)
+
+def block_stats(n, max_simultaneous_tasks=None, force=False, chain=False,
+                blocks_per_task=1, cores=None, blocks=None,
+                dependencies=None):
     config = mc()
     db = get_database()
 
     project = db.get_project_name()
     directory = config.get('general', 'directory')
 
-    print('Fetching merged blocks...')
-    blocks = get_merged_blocks()
-    print('{} merged blocks found'.format(len(blocks)))
+    if blocks is None:
+        print('Fetching merged blocks...')
+        blocks = get_merged_blocks(db)
+        print('{} merged blocks found'.format(len(blocks)))
 
     run_directory = os.path.join(directory, 'stats_runs')
     if not os.path.exists(run_directory):
         os.mkdir(run_directory)
-    reservation_token = get_reservation_token()
-    reservation_file = os.path.join(run_directory,
-                                    'stats_task_{}_{{}}.txt' \
-                                        .format(reservation_token))
+    reservation_file = os.path.join(run_directory, 'stats_task_{}_{}.txt')
 
     output_dir = os.path.join(directory, 'stats')
     if not os.path.exists(output_dir):
@@ -842,41 +1312,180 @@ def block_stats(n, max_simultaneous_tasks=None, force=False):
     stats_file_template = os.path.join(output_dir, '{}.{}.stats.txt')
 
     print('Reserving maximum {} blocks...'.format(n))
-    blocks_to_do = []
-    task_id = 0
-    for b in blocks:
-        if len(blocks_to_do) == n:
-            break
-
-        stats_file = stats_file_template.format(project, b)
-        if not force and os.path.exists(stats_file):
-            continue
-
-        open(stats_file, 'a').close()
-
-        blocks_to_do.append(b)
-        task_id += 1
-        with open(reservation_file.format(task_id), 'w') as f:
-            f.write('{}\n'.format(b))
+    reservation_token, blocks_to_do = reserve_blocks(db, 'stats', blocks, n,
+                                                     force)
     print('Reserved {} blocks'.format(len(blocks_to_do)))
     if len(blocks_to_do) == 0:
         print('No blocks to process')
         return
 
-    job = stats_job_array(blocks_to_do,
-                          project,
-                          stats_file_template,
-                          max_simultaneous_tasks=max_simultaneous_tasks,
-                          script_directory=config.get('general',
-                                                      'script_directory'),
-                          log_directory=config.get('general', 'log_directory'),
-                          reservation_token=reservation_token,
-                          run_directory=run_directory,
-                          account=config.get('general', 'account'))
+    def make_job(blocks, reservation_token, max_simultaneous_tasks):
+        return stats_job_array(blocks,
+                               project,
+                               stats_file_template,
+                               max_simultaneous_tasks=max_simultaneous_tasks,
+                               script_directory=config.get(
+                                   'general', 'script_directory'),
+                               log_directory=config.get('general',
+                                                        'log_directory'),
+                               reservation_token=reservation_token,
+                               run_directory=run_directory,
+                               account=config.get('general', 'account'),
+                               blocks_per_task=blocks_per_task,
+                               cores=cores)
+
+    submit_block_arrays(db, 'stats', reservation_token, blocks_to_do,
+                        reservation_file, make_job,
+                        max_simultaneous_tasks, chain, blocks_per_task,
+                        dependencies)
+
+# Stages of the block pipeline and the stages whose output they need,
+# in the order they are submitted. Merging requires the block to be
+# aligned against all other blocks. tkmerge merges the annotation
+# tracks of all blocks in a single job.
+pipeline_stages = collections.OrderedDict([
+    ('merge', []),
+    ('annotate', ['merge']),
+    ('repeats', ['merge']),
+    ('stats', ['merge']),
+    ('tkmerge', ['annotate', 'repeats']),
+    ('patch', ['merge', 'tkmerge'])
+])
+
+def get_pipeline_inputs(db, stage, blocks):
+    """Find the blocks whose inputs to a pipeline stage are ready.
+
+    Parameters
+    ----------
+    db : marvel_db
+        The project database.
+    stage : str
+        Name of the stage.
+    blocks : list of int
+        Blocks to consider.
 
-    jobid = job.start()
+    Returns
+    -------
+    tuple
+        The blocks whose input stages have all completed or are
+        queued or running, and a dictionary with the SLURM job IDs
+        that each of these blocks has to wait for. Blocks that have
+        completed the stage, or are already queued for it, are left
+        out.
+    """
+    input_tasks = [db.get_block_stage_tasks(s)
+                   for s in pipeline_stages[stage]]
+    stage_tasks = db.get_block_stage_tasks(stage)
+    ready = []
+    dependencies = {}
+    for b in blocks:
+        if stage_tasks.get(b, (None,))[0] in (slurm_utils.status.reserved,
+                                              slurm_utils.status.pending,
+                                              slurm_utils.status.running,
+                                              slurm_utils.status.completed):
+            continue
+        after = []
+        for tasks in input_tasks:
+            status, jobid, task_id = tasks.get(b, (None, None, None))
+            if status == slurm_utils.status.completed:
+                continue
+            if status not in (slurm_utils.status.pending,
+                              slurm_utils.status.running) \
+                    or jobid is None:
+                break
+            after.append(jobid if task_id is None
+                         else '{0}_{1}'.format(jobid, task_id))
+        else:
+            ready.append(b)
+            if len(after) > 0:
+                dependencies[b] = after
+    return ready, dependencies
+
+def parse_budget(s):
+    """Parse a stage budget given as STAGE=N on the command line."""
+    stage, _, n = s.partition('=')
+    if stage not in pipeline_stages or stage == 'tkmerge' \
+            or not n.isdigit():
+        raise argparse.ArgumentTypeError(
+            'invalid budget: {0}, expected STAGE=N where STAGE is one of '
+            '{1}'.format(s, ', '.join(x for x in pipeline_stages
+                                      if x != 'tkmerge')))
+    return stage, int(n)
+
+def pipeline_run(budgets=None, merge_files=None, trim=None):
+    """Submit the next stages of all blocks whose inputs are ready.
+
+    A stage is submitted as soon as the stages it depends on have been
+    submitted, with a dependency on the jobs that have not finished
+    yet, so a block can go through all stages from a single run. Where
+    the tasks of a stage line up with the tasks of its input, each
+    task only waits for its own input task. Blocks whose stage failed
+    are submitted again on the next run.
+
+    Parameters
+    ----------
+    budgets : dict, optional
+        Maximum number of blocks of each stage that may be reserved,
+        queued or running at the same time, keyed by stage. The
+        budgets are saved in the config, and stages without a budget
+        get 100.
+    merge_files : int, optional
+        Number of files to merge at a time, see `merge_blocks`. Saved
+        in the config, default 32.
+    trim : bool, optional
+        Trim the reads when patching, see `patch_blocks`. Saved in the
+        config, default False.
+    """
+    config = mc()
+    db = get_database()
+
+    if budgets is None:
+        budgets = {}
+    for stage in pipeline_stages:
+        if stage != 'tkmerge':
+            config.update('pipeline', stage, budgets.get(stage), 100)
+    config.update('pipeline', 'merge_files', merge_files, 32)
+    config.update('pipeline', 'trim', trim, False)
+
+    db.update_block_stages()
+    aligned = db.get_completed_blocks()
+    all_blocks = db.get_blocks()
+
+    for stage in pipeline_stages:
+        ready, dependencies = get_pipeline_inputs(db, stage, aligned)
+
+        if stage == 'tkmerge':
+            # TKmerge can only run once all blocks are ready, and runs
+            # again only if it failed
+            if len(ready) < len(all_blocks):
+                continue
+            print('Stage tkmerge:')
+            merge_annotations(dependencies=set(
+                x.split('_')[0] for after in dependencies.values()
+                for x in after))
+            continue
 
-    print('Jobs submitted in job array {}'.format(jobid))
+        counts = db.block_stage_counts().get(stage, {})
+        n = config.getint('pipeline', stage) \
+                - sum(counts.get(s, 0) for s in (slurm_utils.status.reserved,
+                                                 slurm_utils.status.pending,
+                                                 slurm_utils.status.running))
+        if n <= 0 or len(ready) == 0:
+            continue
+
+        print('Stage {0}:'.format(stage))
+        if stage == 'merge':
+            merge_blocks(n, config.getint('pipeline', 'merge_files'),
+                         blocks=ready)
+        elif stage == 'annotate':
+            annotate_blocks(n, None, blocks=ready, dependencies=dependencies)
+        elif stage == 'repeats':
+            repeat_annotate(n, blocks=ready, dependencies=dependencies)
+        elif stage == 'stats':
+            block_stats(n, blocks=ready, dependencies=dependencies)
+        elif stage == 'patch':
+            patch_blocks(n, trim=config.getboolean('pipeline', 'trim'),
+                         blocks=ready, dependencies=dependencies)
 
 def list_reservations():
     config = mc()
@@ -962,6 +1571,7 @@ def stop_mask():
                              log_directory=config.get('general',
                                                       'log_directory'),
                              jobid=masking_status[0],
+                             ip=db.get_masking_ip(),
                              port=config.getint('DMserver', 'port'),
                              threads=config.getint('DMserver', 'threads'),
                              constraint=config.get('DMserver', 'constraint'),
@@ -987,8 +1597,7 @@ def stop_mask():
         sys.exit(1)
 
 def mask_status():
-    db_name = os.path.join('.', 'marveldb')
-    db = mj.marvel_db.from_file(db_name)
+    db = get_database()
     db.update_masking_job_status()
     masking_status = db.masking_status()
     if masking_status is None:
@@ -996,7 +1605,7 @@ def mask_status():
     else:
         print('Job {0}: {1}, last update on {2}'.format(*masking_status))
 
-def info():
+def info(as_json=False):
     if not is_project():
         print('error: no project found in current directory, '
               'did you run init?', file=sys.stderr)
@@ -1004,16 +1613,34 @@ def info():
     db = get_database()
     update_statuses()
     project_info = db.info()
+    if as_json:
+        project_info['daligner jobs by status'] = \
+                db.daligner_status_counts()
+        json.dump(project_info, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return
     print('MARVEL project started on {0}'.format(project_info['started on']))
-    widest = max(map(len, db.info().keys()))
-    for k, v in db.info().items():
+    widest = max(map(len, project_info.keys()))
+    for k, v in project_info.items():
         print('{0:>{widest}}: {1}'.format(k, v, widest=widest))
 
 def update_and_restart():
     config = mc()
     db = get_database()
-    update_statuses()
-
+    update_statuses(reconcile=True)
+    restart_failed(db, config)
+
+def restart_failed(db, config):
+    """Restart the masking server if it is down, and reset failed or
+    cancelled daligner jobs so that they are queued again.
+
+    Parameters
+    ----------
+    db : marvel_db
+        Project database.
+    config : marvelous_config
+        Project config.
+    """
     old_masking_ip = db.get_masking_ip()
     masking_status = db.masking_status()
 
@@ -1038,25 +1665,36 @@ def update_and_restart():
     if masking_ip_changed:
         print('Masking server IP changed, also resetting pending jobs...')
 
-    failed_jobs = db.get_daligner_jobs(status=(slurm_utils.status.failed,
-                                               slurm_utils.status.cancelled,
-                                               slurm_utils.status.timeout))
+    failed_jobs = db.get_daligner_jobs(status=slurm_utils.failed_states)
 
     if len(failed_jobs) > 0:
         db.reset_daligner_jobs(failed_jobs)
 
-    # Remove the daligner script to avoid having old dependencies lying around
-    daligner_script = os.path.join(config.get('general', 'script_directory'),
-                                   daligner_job_array.filename)
-    if os.path.exists(daligner_script):
-        os.remove(daligner_script)
+    # Remove the daligner scripts to avoid having old dependencies lying
+    # around
+    for filename in (daligner_job_array.filename,
+                     daligner_job_array.pull_filename):
+        mj.remove_scripts(os.path.join(
+            config.get('general', 'script_directory'), filename))
 
     update_statuses()
 
-def update_statuses():
+def update_statuses(reconcile=False):
+    """Update the status of all jobs in the database.
+
+    Parameters
+    ----------
+    reconcile : bool
+        Also check reserved and running daligner jobs against the
+        SLURM accounting database, to catch array tasks that failed
+        without leaving anything in their log files.
+    """
     config = mc()
     db = get_database()
 
+    # Fetch the state of all SLURM jobs at once, the status updates
+    # below then look them up in the snapshot.
+    slurm_utils.get_snapshot(db.get_slurm_jobids())
     try:
         db.update_masking_job_status()
     except ValueError as ve:
@@ -1072,16 +1710,155 @@ def update_statuses():
     # Update status of jobs that have a status of RESERVED or RUNNING.
     # At the moment these are the only two statuses that a daligner job
     # can have.
-    start = time.time()
     djs = db.get_daligner_jobs(status=(slurm_utils.status.running,
                                        slurm_utils.status.reserved))
-    print('fetched jobs in {0}'.format(time.time() - start))
     try:
         db.update_daligner_jobs(djs, log_directory=config.get('general',
                                                               'log_directory'))
     except KeyError as ke:
         pass
 
+    if reconcile:
+        n_failed = db.reconcile_daligner_jobs()
+        if n_failed > 0:
+            print('{0} daligner jobs failed according to SLURM'
+                  .format(n_failed))
+
+def next_poll_interval(interval, completion_rate, headroom, min_interval,
+                       max_interval):
+    """Get the time until the next iteration of the daemon.
+
+    Parameters
+    ----------
+    interval : float
+        Current interval in seconds.
+    completion_rate : float
+        Number of queued daligner tasks that finish per second.
+    headroom : int
+        Number of queued tasks above the low watermark.
+    min_interval, max_interval : float
+        Bounds of the interval in seconds.
+
+    Returns
+    -------
+    float
+        The interval in seconds. While tasks are finishing, this is
+        about the time until the queue has drained to the low
+        watermark. Otherwise the current interval is doubled.
+    """
+    if completion_rate > 0:
+        interval = max(headroom, 1) / completion_rate
+    else:
+        interval *= 2
+    return min(max(interval, min_interval), max_interval)
+
+def daemon(low_watermark=None, min_interval=None, max_interval=None,
+           chain=False, max_iterations=None):
+    """Keep the daligner queue filled until all jobs have completed.
+
+    This does the work of running `fix` and `daligner update`
+    regularly, but the database and config stay open between
+    iterations, and the SLURM accounting database is only checked
+    every `reconcile_interval` seconds (`daemon` section of the
+    config, default: 3600).
+
+    Parameters
+    ----------
+    low_watermark : int, optional
+        Queue new tasks when fewer than this many tasks are queued
+        or running. Defaults to half of `max_number_of_jobs`.
+    min_interval, max_interval : float, optional
+        Bounds of the time between iterations in seconds. Defaults
+        to 60 and 900. The time is chosen from the rate at which
+        tasks finish, see `next_poll_interval`.
+    chain : bool
+        If the tasks do not fit in one job array, start each array
+        after the previous one has finished.
+    max_iterations : int, optional
+        Stop after this many iterations.
+    """
+    global _database
+    config = mc()
+    config.update('daemon', 'low_watermark', low_watermark,
+                  config.getint('general', 'max_number_of_jobs') // 2)
+    config.update('daemon', 'min_interval', min_interval, 60)
+    config.update('daemon', 'max_interval', max_interval, 900)
+    low_watermark = config.getint('daemon', 'low_watermark')
+    min_interval = config.getfloat('daemon', 'min_interval')
+    max_interval = config.getfloat('daemon', 'max_interval')
+    reconcile_interval = config.getfloat('daemon', 'reconcile_interval', 3600)
+    backup_interval = config.getfloat('database', 'backup_interval', 3600)
+
+    lock_file = open(os.path.join(config.get('general', 'directory'),
+                                  'daemon.lock'), 'a')
+    try:
+        fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        lock_file.close()
+        print('error: a daemon is already running for this project',
+              file=sys.stderr)
+        sys.exit(1)
+
+    _database = db = get_database()
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+
+    interval = min_interval
+    completion_rate = 0.0
+    last_queued = None
+    last_update = None
+    last_reconcile = None
+    iteration = 0
+    try:
+        while True:
+            iteration += 1
+            now = time.time()
+            slurm_utils.clear_snapshot()
+            reconcile = last_reconcile is None \
+                    or now - last_reconcile >= reconcile_interval
+            update_statuses(reconcile=reconcile)
+            if reconcile:
+                last_reconcile = now
+            restart_failed(db, config)
+            backup_database(db, min_interval=backup_interval)
+
+            if db.n_daligner_jobs(slurm_utils.status.completed) \
+                    == db.n_daligner_jobs():
+                print('All daligner jobs have completed')
+                break
+
+            # Tasks only leave the queue by finishing, so the drop
+            # since the last iteration is the number of finished tasks
+            queued = get_queued_daligner_tasks(db)
+            if last_queued is not None:
+                rate = max(last_queued - queued, 0) / (now - last_update)
+                completion_rate = (completion_rate + rate) / 2
+
+            if queued < low_watermark:
+                try:
+                    n_jobs = queue_daligner_tasks(db, config, chain=chain)
+                    if n_jobs > 0:
+                        print('Queued {0} jobs'.format(n_jobs))
+                except RuntimeError as rte:
+                    print('warning: job submission failed, retrying in the '
+                          'next iteration\n{0}'.format(rte), file=sys.stderr)
+                queued = get_queued_daligner_tasks(db)
+            last_queued, last_update = queued, now
+
+            if max_iterations is not None and iteration >= max_iterations:
+                break
+            if iteration > 1:
+                interval = next_poll_interval(
+                    interval, completion_rate, queued - low_watermark,
+                    min_interval, max_interval)
+            print('{0} tasks queued, next update in {1:.0f} seconds' \
+                  .format(queued, interval), flush=True)
+            time.sleep(interval)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        _database = None
+        lock_file.close()
+
 # Helper functions for the argument parsing
 def directory_exists(s):
     return os.path.exists(s) and os.path.isdir(s)
@@ -1129,13 +1906,33 @@ def parse_args():
     init_parser.add_argument('-f', '--force', help='force overwrite of '
                              'existing database', action='store_true')
 
+    # Coordinator
+    serve_parser = subparsers.add_parser(
+        'serve', help='Run the coordinator',
+        description='Run a coordinator that owns the project database. '
+        'Job scripts that are submitted while it is running look up the '
+        'project and claim jobs through it, instead of accessing the '
+        'database over the shared file system.')
+    serve_parser.add_argument('--host', help='interface to listen on '
+                              '(default: all)', default='')
+    serve_parser.add_argument('--port', help='port to listen on (default: '
+                              'any free port)', type=int, default=0)
+    serve_parser.add_argument('--advertise', help='host name the jobs '
+                              'should connect to (default: this host)',
+                              metavar='HOST')
+
     # Info
     info_parser = subparsers.add_parser('info', help='Show project info',
         description='Show project information.')
+    info_parser.add_argument('--json', help='print the information as '
+                             'JSON', action='store_true')
 
     # Backup
     backup_parser = subparsers.add_parser('backup', help='Backup the database',
         description='Make a backup of the marvelous_jobs database.')
+    backup_parser.add_argument('--quick-check', help='use the quick '
+                               'integrity check instead of the full one',
+                               action='store_true', default=None)
 
     # DBprepare
     prep_parser = subparsers.add_parser('prepare', help='Prepare data files',
@@ -1221,6 +2018,17 @@ def parse_args():
     block_merge.add_argument('-m', help='number of files to process '
                              'simultaneously (default: 32)', type=int,
                              default=32)
+    block_merge.add_argument('--chain', help='if the blocks do not fit in '
+                             'one job array, start each array after the '
+                             'previous one has finished',
+                             action='store_true')
+    block_merge.add_argument('--blocks-per-task', help='number of blocks '
+                             'that each array task processes (default: 1)',
+                             type=int, default=1)
+    block_merge.add_argument('--cores', help='number of cores for each '
+                             'array task, blocks are processed in parallel '
+                             'if there are enough cores for more than one',
+                             type=int)
 
     # blocks annotate
     block_annotate = block_subparsers.add_parser('annotate',
@@ -1242,6 +2050,17 @@ def parse_args():
                                 help='start annotation even if '
                                 'annotation files already exist',
                                 action='store_true')
+    block_annotate.add_argument('--chain', help='if the blocks do not fit in '
+                                'one job array, start each array after the '
+                                'previous one has finished',
+                                action='store_true')
+    block_annotate.add_argument('--blocks-per-task', help='number of blocks '
+                                'that each array task processes (default: 1)',
+                                type=int, default=1)
+    block_annotate.add_argument('--cores', help='number of cores for each '
+                                'array task, blocks are processed in parallel '
+                                'if there are enough cores for more than one',
+                                type=int)
 
     # blocks patch
     block_patch = block_subparsers.add_parser(
@@ -1263,6 +2082,17 @@ def parse_args():
     block_patch.add_argument('-f', '--force', help='start patching even if '
                              'the corresponding fasta file already exists',
                              action='store_true')
+    block_patch.add_argument('--chain', help='if the blocks do not fit in '
+                             'one job array, start each array after the '
+                             'previous one has finished',
+                             action='store_true')
+    block_patch.add_argument('--blocks-per-task', help='number of blocks '
+                             'that each array task processes (default: 1)',
+                             type=int, default=1)
+    block_patch.add_argument('--cores', help='number of cores for each '
+                             'array task, blocks are processed in parallel '
+                             'if there are enough cores for more than one',
+                             type=int)
 
     # blocks repeat
     block_repeat = block_subparsers.add_parser(
@@ -1274,6 +2104,17 @@ def parse_args():
     block_repeat.add_argument('--max-simultaneous-tasks', help='maximum number '
                               'of tasks allowed to run simultaneously '
                               '(default: N)', type=int)
+    block_repeat.add_argument('--chain', help='if the blocks do not fit in '
+                              'one job array, start each array after the '
+                              'previous one has finished',
+                              action='store_true')
+    block_repeat.add_argument('--blocks-per-task', help='number of blocks '
+                              'that each array task processes (default: 1)',
+                              type=int, default=1)
+    block_repeat.add_argument('--cores', help='number of cores for each '
+                              'array task, blocks are processed in parallel '
+                              'if there are enough cores for more than one',
+                              type=int)
 
     # blocks stats
     block_stats = block_subparsers.add_parser('stats',
@@ -1289,6 +2130,51 @@ def parse_args():
     block_stats.add_argument('-f', '--force', help='start patching even if '
                              'the corresponding fasta file already exists',
                              action='store_true')
+    block_stats.add_argument('--chain', help='if the blocks do not fit in '
+                             'one job array, start each array after the '
+                             'previous one has finished',
+                             action='store_true')
+    block_stats.add_argument('--blocks-per-task', help='number of blocks '
+                             'that each array task processes (default: 1)',
+                             type=int, default=1)
+    block_stats.add_argument('--cores', help='number of cores for each '
+                             'array task, blocks are processed in parallel '
+                             'if there are enough cores for more than one',
+                             type=int)
+
+    # pipeline
+    pipeline_parser = subparsers.add_parser(
+        'pipeline', help='Run the block stages',
+        description='Run the stages that follow the alignment of each '
+        'block.')
+    pipeline_subparsers = pipeline_parser.add_subparsers(
+        dest='subsubcommand', metavar='pipeline-command')
+    pipeline_subparsers.required = True
+
+    # pipeline run
+    pipeline_run_parser = pipeline_subparsers.add_parser(
+        'run', help='submit the next stage of each block',
+        description='Submit the next stage of every block whose inputs '
+        'are ready: merge, then annotate, repeats and stats, then TKmerge '
+        'once all blocks are annotated, and finally patch. Stages whose '
+        'inputs are queued or running are submitted with a dependency on '
+        'them. Run this regularly to resubmit failed blocks and to stay '
+        'within the budgets.')
+    pipeline_run_parser.add_argument('-b', '--budget', help='maximum number '
+                                     'of blocks of a stage that are queued '
+                                     'or running at the same time, e.g. '
+                                     'merge=50 (default: 100)',
+                                     metavar='STAGE=N', type=parse_budget,
+                                     action='append', default=[])
+    pipeline_run_parser.add_argument('-m', '--merge-files', help='number of '
+                                     'files to merge simultaneously '
+                                     '(default: 32)', type=int)
+    pipeline_run_parser.add_argument('--trim', help='trim reads based on the '
+                                     'trim track when patching',
+                                     action='store_true', default=None)
+    pipeline_run_parser.add_argument('--no-trim', help='do not trim reads '
+                                     'when patching (default)',
+                                     action='store_false', dest='trim')
 
     # daligner
     dalign_parser = subparsers.add_parser('daligner', help='Run daligner',
@@ -1322,6 +2208,18 @@ def parse_args():
                               action='store_true')
     dalign_start.add_argument('--no-masking', help='do not use the masking '
                               'server', action='store_true')
+    dalign_start.add_argument('--pull', help='let the array tasks claim '
+                              'jobs from the database while running, '
+                              'instead of reserving them when they are '
+                              'submitted', action='store_true')
+    dalign_start.add_argument('--jobs-per-claim', help='number of jobs a '
+                              'task claims at a time with --pull '
+                              '(default: 1)', type=int, default=1)
+    dalign_start.add_argument('--tile-size', help='give each array task a '
+                              'tile of K by K blocks of the comparison '
+                              'matrix instead of --jobs-per-task jobs, so '
+                              'the task reads at most 2K distinct blocks',
+                              metavar='K', type=int)
 
     # daligner update
     dalign_update = dalign_subparsers.add_parser(
@@ -1331,6 +2229,10 @@ def parse_args():
         'jobs that are allowed according to the config.ini file')
     dalign_update.add_argument('-n', help='size of job array to queue',
                                type=int)
+    dalign_update.add_argument('--chain', help='if the tasks do not fit in '
+                               'one job array, start each array after the '
+                               'previous one has finished',
+                               action='store_true')
 
     # daligner stop
     dalign_stop = dalign_subparsers.add_parser(
@@ -1346,6 +2248,46 @@ def parse_args():
     dalign_reserve.add_argument('--cancel', help='cancel all active '
                                 'reservations', action='store_true')
 
+    # daligner claim, run by the array tasks in pull mode
+    dalign_claim = dalign_subparsers.add_parser(
+        'claim', help='claim daligner jobs for an array task',
+        description='Record the outcome of the jobs an array task has run, '
+        'and claim new jobs for it. Used by the array tasks in pull mode.')
+    dalign_claim.add_argument('token', help='reservation token of the task')
+    dalign_claim.add_argument('jobid', help='SLURM job ID of the array')
+    dalign_claim.add_argument('-n', help='number of jobs to claim '
+                              '(default: 1)', type=int, default=1)
+    dalign_claim.add_argument('-c', '--comparisons-per-job', help='number '
+                              'of block comparisons per job (default: 1)',
+                              type=int, default=1)
+    dalign_claim.add_argument('--completed', help='row IDs of completed '
+                              'jobs', metavar='ROWIDS', default='')
+    dalign_claim.add_argument('--failed', help='row IDs of failed jobs',
+                              metavar='ROWIDS', default='')
+
+    # Keep the daligner queue filled
+    daemon_parser = subparsers.add_parser(
+        'daemon', help='Keep the daligner queue filled',
+        description='Run until all daligner jobs have completed. Failed '
+        'jobs are reset and the masking server is restarted as with fix, '
+        'and new tasks are queued as with daligner update whenever the '
+        'number of queued tasks drops below the low watermark. The time '
+        'between updates follows the rate at which tasks finish.')
+    daemon_parser.add_argument('-w', '--low-watermark', help='queue new '
+                               'tasks when fewer than this many are queued '
+                               '(default: half the maximum number of jobs)',
+                               type=int)
+    daemon_parser.add_argument('--min-interval', help='minimum number of '
+                               'seconds between updates (default: 60)',
+                               type=float)
+    daemon_parser.add_argument('--max-interval', help='maximum number of '
+                               'seconds between updates (default: 900)',
+                               type=float)
+    daemon_parser.add_argument('--chain', help='if the tasks do not fit in '
+                               'one job array, start each array after the '
+                               'previous one has finished',
+                               action='store_true')
+
     # Update status and restart jobs if necessary
     fix_parser = subparsers.add_parser(
         'fix', help='Update and reset jobs',
@@ -1391,6 +2333,13 @@ def parse_args():
         if not positive_integer(args.comparisons_per_job):
             parser.error('comparisons per job must be a '
                          'positive non-zero integer')
+        if not positive_integer(args.jobs_per_claim):
+            parser.error('jobs per claim must be a positive non-zero integer')
+        if args.tile_size is not None:
+            if not positive_integer(args.tile_size):
+                parser.error('tile size must be a positive non-zero integer')
+            elif args.pull:
+                parser.error('--tile-size cannot be used with --pull')
     if args.subcommand == 'daligner' and args.subsubcommand == 'update':
         if args.n is not None and not positive_integer(args.n):
             parser.error('n must be a positive non-zero integer')
@@ -1409,6 +2358,10 @@ def parse_args():
     if args.subcommand == 'blocks' and args.subsubcommand == 'merge':
         if not positive_integer(args.m):
             parser.error('m must be a positive non-zero integer')
+    if args.subcommand == 'pipeline' and args.subsubcommand == 'run':
+        if args.merge_files is not None \
+           and not positive_integer(args.merge_files):
+            parser.error('merge-files must be a positive non-zero integer')
     if args.subcommand == 'blocks' and args.subsubcommand == 'check':
         if not positive_integer(args.block):
             parser.error('block must be a positive non-zero integer')
@@ -1431,8 +2384,10 @@ def main():
     elif not is_project():
         print('error: no project found, have you run init?', file=sys.stderr)
         sys.exit(1)
+    if args.subcommand == 'serve':
+        serve(host=args.host, port=args.port, advertise=args.advertise)
     if args.subcommand == 'backup':
-        backup_database()
+        backup_database(quick_check=args.quick_check)
     if args.subcommand == 'prepare':
         prepare(fasta=args.fasta,
                 blocksize=args.blocksize,
@@ -1454,7 +2409,10 @@ def main():
                        max_simultaneous_tasks=args.max_simultaneous_tasks,
                        comparisons_per_job=args.comparisons_per_job,
                        threads=args.threads,
-                       timelimit=args.timelimit)
+                       timelimit=args.timelimit,
+                       pull=args.pull,
+                       jobs_per_claim=args.jobs_per_claim,
+                       tile_size=args.tile_size)
 
     if args.subcommand == 'blocks' and args.subsubcommand is None:
         if args.list:
@@ -1465,14 +2423,20 @@ def main():
         check_block(block=args.block, run=args.run)
     if args.subcommand == 'blocks' and args.subsubcommand == 'merge':
         merge_blocks(n=args.n, n_files=args.m,
-                     max_simultaneous_tasks=args.max_simultaneous_tasks)
+                     max_simultaneous_tasks=args.max_simultaneous_tasks,
+                     chain=args.chain,
+                     blocks_per_task=args.blocks_per_task,
+                     cores=args.cores)
     if args.subcommand == 'blocks' and args.subsubcommand == 'annotate':
         if args.merge:
             merge_annotations()
         else:
             annotate_blocks(n=args.n,
                             max_simultaneous_tasks=args.max_simultaneous_tasks,
-                            force=args.force)
+                            force=args.force,
+                            chain=args.chain,
+                            blocks_per_task=args.blocks_per_task,
+                            cores=args.cores)
     if args.subcommand == 'blocks' and args.subsubcommand == 'patch':
         patch_blocks(n=args.n,
                      max_simultaneous_tasks=args.max_simultaneous_tasks,
@@ -1480,29 +2444,53 @@ def main():
                      trim=args.trim,
                      min_read_length=args.x,
                      force=args.force,
-                     timelimit=args.timelimit)
+                     timelimit=args.timelimit,
+                     chain=args.chain,
+                     blocks_per_task=args.blocks_per_task,
+                     cores=args.cores)
     if args.subcommand == 'blocks' and args.subsubcommand == 'repeat':
         repeat_annotate(n=args.n,
                         max_simultaneous_tasks=args.max_simultaneous_tasks,
-                        timelimit=args.timelimit)
+                        timelimit=args.timelimit,
+                        chain=args.chain,
+                        blocks_per_task=args.blocks_per_task,
+                        cores=args.cores)
     if args.subcommand == 'blocks' and args.subsubcommand == 'stats':
         block_stats(n=args.n,
                     max_simultaneous_tasks=args.max_simultaneous_tasks,
-                    force=args.force)
+                    force=args.force,
+                    chain=args.chain,
+                    blocks_per_task=args.blocks_per_task,
+                    cores=args.cores)
+
+    if args.subcommand == 'pipeline' and args.subsubcommand == 'run':
+        pipeline_run(budgets=dict(args.budget),
+                     merge_files=args.merge_files,
+                     trim=args.trim)
 
     if args.subcommand == 'daligner' and args.subsubcommand == 'update':
-        update_daligner_queue(n_tasks=args.n)
+        update_daligner_queue(n_tasks=args.n, chain=args.chain)
     if args.subcommand == 'daligner' and args.subsubcommand == 'stop':
         stop_daligner()
+    if args.subcommand == 'daligner' and args.subsubcommand == 'claim':
+        claim_daligner_jobs(args.token, args.jobid, args.n,
+                            args.comparisons_per_job,
+                            completed=[int(x) for x in args.completed.split()],
+                            failed=[int(x) for x in args.failed.split()])
     if args.subcommand == 'daligner' and args.subsubcommand == 'reservation':
         if not args.cancel:
             list_reservations()
         else:
             cancel_daligner_reservation()
+    if args.subcommand == 'daemon':
+        daemon(low_watermark=args.low_watermark,
+               min_interval=args.min_interval,
+               max_interval=args.max_interval,
+               chain=args.chain)
     if args.subcommand == 'fix':
         update_and_restart()
     if args.subcommand == 'info':
-        info()
+        info(as_json=args.json)
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,149 @@
+"""Client for the marvelous_jobs coordinator.
+
+Job scripts call this module instead of accessing the project database
+directly, e.g.
+
+    python -m marvelous_jobs.client <address file> project name
+"""
+
+import argparse
+import json
+import socket
+import sys
+import time
+
+def read_address(filename):
+    """Read the address of a coordinator from its address file.
+
+    Parameters
+    ----------
+    filename : str
+        Path to the address file written by `marvelous_jobs serve`.
+
+    Returns
+    -------
+    dict
+        Dictionary with the keys `host`, `port` and `key`.
+    """
+    with open(filename) as f:
+        return json.load(f)
+
+def request(address, method, retries=5, backoff=1.0, timeout=60.0,
+            **params):
+    """Send a request to the coordinator.
+
+    Parameters
+    ----------
+    address : dict or str
+        Address of the coordinator, or the path to its address file.
+    method : str
+        Name of the method to call.
+    retries : int
+        Number of times to retry if the coordinator cannot be reached.
+    backoff : float
+        Seconds to wait before the first retry, doubled for each retry.
+    timeout : float
+        Seconds to wait for a response.
+    **params
+        Parameters of the method.
+
+    Returns
+    -------
+    object
+        The result of the method.
+
+    Raises
+    ------
+    RuntimeError
+        If the coordinator cannot be reached or the request fails.
+        Only connection attempts are retried.
+    """
+    # Only connecting is retried, since a request that has been sent may
+    # already have been carried out, e.g. jobs may have been claimed.
+    for attempt in range(retries + 1):
+        try:
+            if type(address) is str:
+                addr = read_address(address)
+            else:
+                addr = address
+            s = socket.create_connection((addr['host'], addr['port']),
+                                         timeout=timeout)
+            break
+        except OSError as ose:
+            if attempt == retries:
+                raise RuntimeError('could not reach coordinator: {0}' \
+                                   .format(ose))
+            time.sleep(backoff * 2 ** attempt)
+
+    try:
+        with s, s.makefile('rwb') as f:
+            f.write(json.dumps({'key': addr['key'],
+                                'method': method,
+                                'params': params}).encode('utf8') + b'\n')
+            f.flush()
+            response = f.readline()
+    except OSError as ose:
+        raise RuntimeError('request to coordinator failed: {0}'.format(ose))
+    if len(response) == 0:
+        raise RuntimeError('connection closed by coordinator')
+
+    response = json.loads(response.decode('utf8'))
+    if not response['ok']:
+        raise RuntimeError(response['error'])
+    return response['result']
+
+def parse_rowids(s):
+    return [int(x) for x in s.split()]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog='python -m marvelous_jobs.client',
+        description='Talk to the marvelous_jobs coordinator.')
+    parser.add_argument('address_file', help='address file written by '
+                        '`marvelous_jobs serve`')
+    subparsers = parser.add_subparsers(dest='method', metavar='method')
+    subparsers.required = True
+
+    project_parser = subparsers.add_parser('project',
+                                           help='print project information')
+    project_parser.add_argument('key', choices=('name', 'masking_ip'))
+
+    claim_parser = subparsers.add_parser('claim', help='claim daligner jobs')
+    claim_parser.add_argument('token')
+    claim_parser.add_argument('jobid')
+    claim_parser.add_argument('-n', type=int, default=1)
+    claim_parser.add_argument('-c', '--comparisons-per-job', type=int,
+                              default=1)
+    claim_parser.add_argument('--completed', type=parse_rowids, default=[])
+    claim_parser.add_argument('--failed', type=parse_rowids, default=[])
+
+    for method in ('complete', 'fail'):
+        p = subparsers.add_parser(method, help='mark daligner jobs as '
+                                  '{0}'.format('completed' \
+                                               if method == 'complete' \
+                                               else 'failed'))
+        p.add_argument('rowids', type=int, nargs='+')
+
+    args = parser.parse_args(argv)
+
+    try:
+        if args.method == 'project':
+            value = request(args.address_file, 'project')[args.key]
+            print(value if value is not None else '')
+        elif args.method == 'claim':
+            jobs = request(args.address_file, 'claim',
+                           token=args.token, jobid=args.jobid,
+                           n=args.n,
+                           comparisons_per_job=args.comparisons_per_job,
+                           completed=args.completed, failed=args.failed)
+            for d in jobs:
+                print('\t'.join(map(str, [d['source_block']] + d['rowids'] + \
+                                          d['target_blocks'])))
+        else:
+            request(args.address_file, args.method, rowids=args.rowids)
+    except RuntimeError as rte:
+        print('error: {0}'.format(rte), file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,25 +1,95 @@
+import atexit
 from configparser import SafeConfigParser
+from contextlib import contextmanager
+import fcntl
 import os
+import tempfile
+import weakref
+
+# Config objects with changes that have not been written yet
+_configs = weakref.WeakSet()
+# Shared config objects, keyed by absolute file name
+_shared_configs = {}
+
+def get_config(filename=None, cdict=None):
+    """Get the shared config object of a config file.
+
+    All callers in the same process get the same object, so the file
+    is only read once, and all changes are written together when the
+    process exits.
+
+    Parameters
+    ----------
+    filename : str, optional
+        Path to the config file. Defaults to `config.ini` in the
+        current directory.
+    cdict : dict, optional
+        Values to set, see `marvelous_config.set_dict`.
+
+    Returns
+    -------
+    marvelous_config
+        The shared config object.
+    """
+    if filename is None:
+        filename = os.path.join('.', 'config.ini')
+    key = os.path.abspath(filename)
+    config = _shared_configs.get(key)
+    if config is None:
+        config = marvelous_config(filename, cdict)
+        _shared_configs[key] = config
+    elif cdict is not None:
+        config.set_dict(cdict)
+    return config
+
+@atexit.register
+def save_configs():
+    """Write all config objects with unsaved changes to file."""
+    for config in list(_configs):
+        if config.dirty:
+            config.save()
 
 class marvelous_config:
 
     def __init__(self, filename=None, cdict=None):
+        """Read a config file.
+
+        Changes are kept in memory and written to the file by
+        `save`, which is called automatically when the process exits.
+
+        Parameters
+        ----------
+        filename : str, optional
+            Path to the config file. Defaults to `config.ini` in the
+            current directory. The file is created if it does not
+            exist.
+        cdict : dict, optional
+            Values to set, see `set_dict`.
+        """
         self.config = SafeConfigParser()
         if filename is not None:
             self.filename = filename
         else:
             self.filename = os.path.join('.', 'config.ini')
+        self._changes = {}
 
         if os.path.isfile(self.filename):
             self.config.read(self.filename)
+            self._is_new = False
         else:
             self.config.add_section('general')
             self.config.add_section('daligner')
+            self._is_new = True
 
         if cdict is not None:
             self.set_dict(cdict)
 
-        self.save()
+        _configs.add(self)
+
+    @property
+    def dirty(self):
+        """Whether there are changes that have not been saved."""
+        return self._is_new or len(self._changes) > 0
 
     def get(self, section, key, default=None):
         if not self.config.has_option(section, key):
@@ -42,15 +112,14 @@ class marvelous_config:
 
     def set_dict(self, cdict):
         for section, c in cdict.items():
-            if section not in self.config.sections():
-                self.config.add_section(section)
             for key, value in c.items():
-                self.config.set(section, key, str(value))
+                self.set(section, key, value)
 
     def set(self, section, key, value):
         """Set a config value.
 
-        If `section` does not yet exist, it is created.
+        If `section` does not yet exist, it is created. The
+        change is not written to file until `save` is called.
 
         Parameters
         ----------
@@ -65,7 +134,7 @@ class marvelous_config:
         if not self.config.has_section(section):
             self.config.add_section(section)
         self.config.set(section, key, str(value))
-        self.save()
+        self._changes[(section, key)] = str(value)
 
     def update(self, section, key, value, default=None):
         """Update a config value.
@@ -100,10 +169,47 @@ class marvelous_config:
         if value is None and self.get(section, key) is None:
             self.set(section, key, default)
         elif value is not None:
-            if self.get(section, key) != value:
+            if self.get(section, key) != str(value):
                 self.set(section, key, value)
 
+    @contextmanager
+    def _lock(self):
+        with open('{}.lock'.format(self.filename), 'a') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
     def save(self):
-        """Save the config to file."""
-        with open(self.filename, 'w') as f:
-            self.config.write(f)
+        """Save the config to file.
+
+        The file is locked while saving, and the changes made
+        through this object are applied on top of what is currently
+        in the file, so that concurrent commands do not overwrite
+        each other's changes. The new file is written to a temporary
+        file that then replaces the config file.
+        """
+        with self._lock():
+            config = SafeConfigParser()
+            config.read(self.filename)
+            for section in self.config.sections():
+                if not config.has_section(section):
+                    config.add_section(section)
+            for (section, key), value in self._changes.items():
+                config.set(section, key, value)
+
+            directory = os.path.dirname(os.path.abspath(self.filename))
+            fd, tmp_filename = tempfile.mkstemp(dir=directory,
+                                                prefix='.config.',
+                                                suffix='.tmp')
+            umask = os.umask(0)
+            os.umask(umask)
+            os.fchmod(fd, 0o666 & ~umask)
+            with os.fdopen(fd, 'w') as f:
+                config.write(f)
+            os.replace(tmp_filename, self.filename)
+
+            self.config = config
+            self._changes = {}
+            self._is_new = False
@@ -1,22 +1,91 @@
 from functools import reduce
+import itertools
 import os
 import re
 import sqlite3
-import subprocess
 import time
+from urllib.request import pathname2url
 
 from marvelous_jobs import slurm_utils
 
 class marvel_db:
 
-    def __init__(self, filename, name, coverage, force=False):
+    # Version of the schema created by _migrate. Increase it when
+    # _migrate changes.
+    schema_version = 1
+
+    def __init__(self, filename, name, coverage, force=False,
+                 read_only=False, journal_mode=None, synchronous='NORMAL',
+                 cache_size=-65536, mmap_size=268435456):
+        """Open, and if necessary create, a project database.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the database.
+        name : str
+            Name of the project. Only used if the database is created.
+        coverage : int
+            Sequencing coverage. Only used if the database is created.
+        force : bool
+            If True, drop all existing tables and start over.
+        read_only : bool
+            If True, open the database in read-only mode. Read-only
+            connections never take write locks, and in WAL mode
+            they never block, or are blocked by, the writer.
+        journal_mode : str, optional
+            SQLite journal mode. If None, the mode of the database is
+            left as it is, which is DELETE for a new database. WAL
+            lets readers and a writer work concurrently, but requires
+            all processes to run on the same host, so only use it if
+            the array tasks do not open the database themselves, i.e.
+            if they go through the coordinator.
+        synchronous : str
+            Value of the SQLite `synchronous` pragma.
+        cache_size : int
+            Value of the SQLite `cache_size` pragma. Negative values
+            are in KiB, positive values in pages.
+        mmap_size : int
+            Value of the SQLite `mmap_size` pragma, in bytes.
+        """
         is_new = not os.path.exists(filename)
         self.filename = filename
-        self._db = sqlite3.connect(filename, timeout=60.0)
+        self.read_only = read_only
+        self.block_stage_created = False
+        if read_only and not is_new \
+                and marvel_db._schema_version(filename) \
+                    < marvel_db.schema_version:
+            # A read-only connection cannot add the tables that are
+            # missing in databases created by earlier versions
+            db = marvel_db(filename, name, coverage,
+                           journal_mode=journal_mode)
+            self.block_stage_created = db.block_stage_created
+            db._db.close()
+        if read_only:
+            self._db = sqlite3.connect(
+                'file:{0}?mode=ro'.format(pathname2url(
+                    os.path.abspath(filename))),
+                uri=True, timeout=60.0)
+        else:
+            self._db = sqlite3.connect(filename, timeout=60.0)
         if is_new:
             os.chmod(self.filename, 0o664)
         self._db.row_factory = sqlite3.Row
         self._c = self._db.cursor()
+        self._status_counts = None
+        self._status_counts_version = None
+
+        if not read_only and journal_mode is not None:
+            self._c.execute('PRAGMA journal_mode = {0}'.format(journal_mode))
+        if synchronous is not None:
+            self._c.execute('PRAGMA synchronous = {0}'.format(synchronous))
+        if cache_size is not None:
+            self._c.execute('PRAGMA cache_size = {0:d}'.format(int(cache_size)))
+        if mmap_size is not None:
+            self._c.execute('PRAGMA mmap_size = {0:d}'.format(int(mmap_size)))
+
+        if read_only:
+            return
 
         if force:
             self._c.execute('DROP TABLE IF EXISTS prepare_job')
@@ -24,6 +93,12 @@ class marvel_db:
             self._c.execute('DROP TABLE IF EXISTS masking_job')
             self._c.execute('DROP TABLE IF EXISTS block')
             self._c.execute('DROP TABLE IF EXISTS project')
+            self._c.execute('DROP TABLE IF EXISTS daligner_log')
+            self._c.execute('DROP TABLE IF EXISTS daligner_log_job')
+            self._c.execute('DROP TABLE IF EXISTS block_progress')
+            self._c.execute('DROP TABLE IF EXISTS node_ip')
+            self._c.execute('DROP TABLE IF EXISTS daligner_array')
+            self._c.execute('DROP TABLE IF EXISTS block_stage')
 
         if is_new or force:
             self._c.execute('''CREATE TABLE project (
@@ -66,26 +141,255 @@ class marvel_db:
                                 VALUES (?, ?, datetime('now', 'localtime'))''', (name, coverage))
             self._db.commit()
 
+        self._migrate()
+
+    @staticmethod
+    def _schema_version(filename):
+        """Get the schema version of a database, see `_migrate`."""
+        db = sqlite3.connect('file:{0}?mode=ro' \
+                             .format(pathname2url(os.path.abspath(filename))),
+                             uri=True, timeout=60.0)
+        version = db.execute('PRAGMA user_version').fetchone()[0]
+        db.close()
+        return version
+
+    def _migrate(self):
+        """Add tables that are missing in databases created by
+        earlier versions.
+
+        The schema version is saved as the SQLite `user_version`, so
+        read-only connections can tell whether they have to migrate
+        the database first.
+        """
+        # Read position and parse state of each daligner log file, so
+        # that log files only have to be parsed from where the last
+        # update stopped.
+        self._c.execute('''CREATE TABLE IF NOT EXISTS daligner_log
+                            (filename TEXT PRIMARY KEY NOT NULL,
+                             inode INT,
+                             offset INT NOT NULL DEFAULT 0,
+                             status TEXT NOT NULL DEFAULT 'RUNNING',
+                             last_start TEXT,
+                             last_update TEXT)''')
+        # What the log files say about the individual daligner jobs.
+        self._c.execute('''CREATE TABLE IF NOT EXISTS daligner_log_job
+                            (filename TEXT NOT NULL,
+                             job_rowid INT NOT NULL,
+                             started INT NOT NULL DEFAULT 0,
+                             completed INT NOT NULL DEFAULT 0,
+                             failed INT NOT NULL DEFAULT 0,
+                             PRIMARY KEY(filename, job_rowid),
+                             FOREIGN KEY(filename)
+                                REFERENCES daligner_log(filename))''')
+        self._c.execute('''CREATE INDEX IF NOT EXISTS daligner_log_job_rowid
+                            ON daligner_log_job (job_rowid)''')
+        # Indexes for the daligner job queries that filter on status
+        # or reservation. The row ID is implicitly the last column of
+        # every index, so e.g. the status/priority index also gives a
+        # deterministic order within the same priority.
+        self._c.execute('''CREATE INDEX IF NOT EXISTS
+                            daligner_job_status_priority
+                            ON daligner_job (status, priority)''')
+        self._c.execute('''CREATE INDEX IF NOT EXISTS
+                            daligner_job_status_block
+                            ON daligner_job (status, block_id1)''')
+        self._c.execute('''CREATE INDEX IF NOT EXISTS
+                            daligner_job_reservation_token
+                            ON daligner_job (reservation_token)''')
+        # Completed comparisons per block, kept up to date by triggers
+        # on daligner_job so that finding fully aligned blocks does not
+        # have to aggregate over all daligner jobs.
+        self._c.execute('''SELECT COUNT(*) FROM sqlite_master
+                           WHERE type = 'table'
+                             AND name = 'block_progress' ''')
+        has_progress = self._c.fetchone()[0] > 0
+        self._c.execute('''CREATE TABLE IF NOT EXISTS block_progress
+                            (block_id INT PRIMARY KEY NOT NULL,
+                             n_completed INT NOT NULL DEFAULT 0)''')
+        self._c.execute('''CREATE INDEX IF NOT EXISTS
+                            block_progress_completed
+                            ON block_progress (n_completed)''')
+        completed = slurm_utils.status.completed
+        for name, event, condition, row, delta in [
+                ('daligner_job_completed', 'UPDATE OF status',
+                 'NEW.status = {0} AND OLD.status != {0}', 'NEW', '+ 1'),
+                ('daligner_job_uncompleted', 'UPDATE OF status',
+                 'OLD.status = {0} AND NEW.status != {0}', 'OLD', '- 1'),
+                ('daligner_job_inserted', 'INSERT',
+                 'NEW.status = {0}', 'NEW', '+ 1'),
+                ('daligner_job_deleted', 'DELETE',
+                 'OLD.status = {0}', 'OLD', '- 1')]:
+            self._c.execute('''CREATE TRIGGER IF NOT EXISTS {name}
+                AFTER {event} ON daligner_job
+                WHEN {condition}
+                BEGIN
+                    INSERT OR IGNORE INTO block_progress (block_id)
+                        VALUES ({row}.block_id1), ({row}.block_id2);
+                    UPDATE block_progress
+                        SET n_completed = n_completed {delta}
+                        WHERE block_id = {row}.block_id1;
+                    UPDATE block_progress
+                        SET n_completed = n_completed {delta}
+                        WHERE block_id = {row}.block_id2
+                          AND {row}.block_id1 != {row}.block_id2;
+                END'''.format(name=name, event=event, row=row,
+                              delta=delta,
+                              condition=condition.format(
+                                  "'{0}'".format(completed))))
+        if not has_progress:
+            self.recompute_block_progress(commit=False)
+        # Resolved IP addresses of compute nodes, so that DNS does not
+        # have to be queried by every command.
+        self._c.execute('''CREATE TABLE IF NOT EXISTS node_ip
+                            (node TEXT PRIMARY KEY NOT NULL,
+                             ip TEXT NOT NULL,
+                             resolved_on REAL NOT NULL)''')
+        # daligner arrays whose tasks claim their jobs from the
+        # database while running. Their pending tasks have no jobs
+        # yet, so they have to be tracked separately.
+        self._c.execute('''CREATE TABLE IF NOT EXISTS daligner_array
+                            (jobid TEXT PRIMARY KEY NOT NULL,
+                             reservation_token TEXT NOT NULL,
+                             n_tasks INT NOT NULL,
+                             submitted_on TEXT)''')
+        # Progress of the per-block stages that follow the alignment,
+        # e.g. merging and annotation. The array task of each block is
+        # kept so that its log file can be found without listing the
+        # log directory.
+        self._c.execute('''SELECT COUNT(*) FROM sqlite_master
+                           WHERE type = 'table'
+                             AND name = 'block_stage' ''')
+        self.block_stage_created = self._c.fetchone()[0] == 0
+        self._c.execute('''CREATE TABLE IF NOT EXISTS block_stage
+                            (block_id INT NOT NULL,
+                             stage TEXT NOT NULL,
+                             status TEXT NOT NULL DEFAULT 'RESERVED',
+                             jobid TEXT,
+                             task_id INT,
+                             reservation_token TEXT,
+                             log_filename TEXT,
+                             reserved_on TEXT,
+                             last_update TEXT,
+                             PRIMARY KEY(block_id, stage),
+                             FOREIGN KEY(block_id) REFERENCES block(id))''')
+        self._c.execute('''CREATE INDEX IF NOT EXISTS
+                            block_stage_status
+                            ON block_stage (stage, status)''')
+        self._c.execute('PRAGMA user_version = {0:d}' \
+                        .format(marvel_db.schema_version))
+        self._db.commit()
+
     @classmethod
-    def from_file(cls, filename):
-        db = sqlite3.connect(filename, timeout=60.0)
+    def from_file(cls, filename, **kwargs):
+        """Open an existing project database.
+
+        Parameters
+        ----------
+        filename : str
+            Path to the database.
+        **kwargs
+            Additional arguments passed on to the constructor,
+            e.g. `read_only` or the pragma settings.
+        """
+        db = sqlite3.connect('file:{0}?mode=ro' \
+                             .format(pathname2url(os.path.abspath(filename))),
+                             uri=True, timeout=60.0)
         c = db.cursor()
         c.execute('SELECT name, coverage FROM project')
         name, coverage = c.fetchone()
         db.close()
-        return cls(filename, name, coverage, False)
-
-    def backup(self, filename):
-        p = subprocess.Popen([
-            'sqlite3', self.filename,
-            '.backup {0}'.format(filename)
-        ], shell=False, stderr=subprocess.PIPE)
-        output = p.communicate()
-        if len(output[1].strip()) > 0:
-            raise RuntimeError(output[1].strip().decode('utf-8'))
-
-    def integrity_check(self):
-        self._c.execute('PRAGMA integrity_check')
+        return cls(filename, name, coverage, False, **kwargs)
+
+    def backup_is_current(self, filename, min_interval=0):
+        """Check whether a backup is recent enough to be kept.
+
+        Parameters
+        ----------
+        filename : str
+            Path of the backup.
+        min_interval : float
+            Backups younger than this many seconds are always
+            considered current.
+
+        Returns
+        -------
+        bool
+            True if the backup exists and is either younger than
+            `min_interval`, or the database has not changed since the
+            backup was made.
+        """
+        try:
+            backup_mtime = os.stat(filename).st_mtime
+        except FileNotFoundError:
+            return False
+        if time.time() - backup_mtime < min_interval:
+            return True
+        db_mtime = 0
+        for f in (self.filename, '{0}-wal'.format(self.filename)):
+            try:
+                db_mtime = max(db_mtime, os.stat(f).st_mtime)
+            except FileNotFoundError:
+                pass
+        return db_mtime <= backup_mtime
+
+    def backup(self, filename, min_interval=None, pages=4096,
+               progress=None):
+        """Make an online backup of the database.
+
+        The database is copied a number of pages at a time, so that
+        other connections can keep using the database during the
+        backup. The copy is written to a temporary file which then
+        replaces `filename`, so an existing backup is never left
+        half-written.
+
+        Parameters
+        ----------
+        filename : str
+            Path of the backup.
+        min_interval : float
+            If not None, skip the backup if an existing backup is
+            younger than this many seconds, or if the database has not
+            changed since the existing backup was made.
+        pages : int
+            Number of pages to copy at a time.
+        progress : callable
+            Called as `progress(status, remaining, total)` after each
+            step of the backup.
+
+        Returns
+        -------
+        bool
+            True if a backup was made, False if it was skipped.
+        """
+        if min_interval is not None \
+                and self.backup_is_current(filename, min_interval):
+            return False
+        tmp_filename = '{0}.tmp'.format(filename)
+        target = sqlite3.connect(tmp_filename)
+        try:
+            self._db.backup(target, pages=pages, progress=progress)
+        except sqlite3.Error as e:
+            target.close()
+            os.remove(tmp_filename)
+            raise RuntimeError(str(e))
+        target.close()
+        os.replace(tmp_filename, filename)
+        return True
+
+    def integrity_check(self, quick=False):
+        """Check the integrity of the database.
+
+        Parameters
+        ----------
+        quick : bool
+            Run `PRAGMA quick_check` rather than the full
+            `PRAGMA integrity_check`. The quick check does not verify
+            that indexes match their tables, but is much faster.
+        """
+        if quick:
+            self._c.execute('PRAGMA quick_check')
+        else:
+            self._c.execute('PRAGMA integrity_check')
         return self._c.fetchone()[0] == 'ok'
 
     def begin_exclusive(self):
@@ -111,6 +415,29 @@ class marvel_db:
             raise RuntimeError('block already exists')
         self._db.commit()
 
+    def add_blocks(self, blocks):
+        """Add several blocks in a single transaction.
+
+        Parameters
+        ----------
+        blocks : iterable of tuple
+            Blocks as (id, name) tuples.
+
+        Raises
+        ------
+        RuntimeError
+            If any of the blocks already exists. In this case,
+            none of the blocks are added.
+        """
+        try:
+            self._c.executemany('''INSERT INTO block
+                                (id, name)
+                                VALUES (?, ?)''', blocks)
+        except sqlite3.IntegrityError:
+            self._db.rollback()
+            raise RuntimeError('block already exists')
+        self._db.commit()
+
     def get_n_blocks(self):
         query = 'SELECT COUNT(*) FROM block'
         self._c.execute(query)
@@ -121,7 +448,9 @@ class marvel_db:
         self._c.execute(query)
         return [x[0] for x in self._c.fetchall()]
 
-    def get_completed_blocks(self):
+    def _count_completed_comparisons(self):
+        """Count the completed comparisons of every block directly
+        from the daligner jobs."""
         query1 = '''SELECT block_id1 AS block_id, COUNT(*)
             FROM daligner_job
             WHERE status = "COMPLETED"
@@ -139,18 +468,72 @@ class marvel_db:
 
         self._c.execute(query2)
         for block, count in self._c.fetchall():
-            if block not in block_counts:
-                continue
-            block_counts[block] += count
+            block_counts[block] = block_counts.get(block, 0) + count
+
+        return block_counts
+
+    def recompute_block_progress(self, commit=True):
+        """Rebuild the block progress table from scratch.
+
+        The table is normally maintained incrementally by triggers on
+        the daligner job table, so this is only needed for databases
+        created by earlier versions, or to repair the table.
+
+        Parameters
+        ----------
+        commit : bool
+            Whether to commit the transaction.
+        """
+        block_counts = self._count_completed_comparisons()
+        self._c.execute('DELETE FROM block_progress')
+        self._c.executemany('''INSERT INTO block_progress
+                                (block_id, n_completed)
+                               VALUES (?, ?)''', block_counts.items())
+        if commit:
+            self._db.commit()
 
+    def get_block_progress(self):
+        """Get the number of completed comparisons of each block, as
+        maintained in the block progress table.
+
+        Returns
+        -------
+        dict
+            Number of completed comparisons keyed by block ID. Blocks
+            without completed comparisons may be missing.
+        """
+        self._c.execute('''SELECT block_id, n_completed
+                           FROM block_progress
+                           WHERE n_completed > 0''')
+        return dict(self._c.fetchall())
+
+    def get_completed_blocks(self, recompute=False):
+        """Get the blocks that have been aligned against all blocks.
+
+        Parameters
+        ----------
+        recompute : bool
+            If True, count the completed comparisons directly from the
+            daligner jobs instead of using the block progress table.
+            This is slow for large projects, and mainly useful for
+            verifying the block progress table.
+
+        Returns
+        -------
+        list
+            The IDs of the completed blocks, in ascending order.
+        """
         n_blocks = self.get_n_blocks()
 
-        completed_blocks = []
-        for block, count in block_counts.items():
-            if count == n_blocks:
-                completed_blocks.append(block)
+        if recompute:
+            block_counts = self._count_completed_comparisons()
+            return sorted(block for block, count in block_counts.items()
+                          if count == n_blocks)
 
-        return completed_blocks
+        self._c.execute('''SELECT block_id FROM block_progress
+                           WHERE n_completed = ?
+                           ORDER BY block_id''', (n_blocks,))
+        return [x[0] for x in self._c.fetchall()]
 
     def add_daligner_job(self, rowid, id1, id2, priority, use_masking_server=True):
         self._c.execute('''INSERT INTO daligner_job
@@ -160,20 +543,69 @@ class marvel_db:
         self._db.commit()
 
     def add_daligner_jobs(self, jobs):
-        query = '''INSERT INTO daligner_job
+        self._c.executemany('''INSERT INTO daligner_job
                 (rowid, block_id1, block_id2, priority, use_masking, last_update)
-                VALUES '''
-
-        for jtuple in jobs:
-            query += '(?, ?, ?, ?, ?, datetime("now", "localtime")),'
+                VALUES (?, ?, ?, ?, ?, datetime("now", "localtime"))''',
+                            jobs)
+        self._db.commit()
 
-        query = query.rstrip(',')
+    def add_daligner_job_matrix(self, n_blocks, use_masking_server=True,
+                                progress=None):
+        """Add the daligner jobs for all pairs of blocks.
+
+        The jobs are generated by SQLite, one statement for the
+        diagonal and one for each row of the upper triangle of the
+        comparison matrix, and everything is added in a single
+        transaction. Diagonal jobs get row IDs 1 to `n_blocks` and
+        priority 1, and the remaining jobs are numbered row by row
+        and get the priority `block_id1 + 1`.
+
+        Parameters
+        ----------
+        n_blocks : int
+            Number of blocks.
+        use_masking_server : bool
+            Whether the jobs should use the masking server.
+        progress : callable, optional
+            Called as `progress(n_added, n_total)` after each
+            statement.
+        """
+        n_total = n_blocks + n_blocks * (n_blocks - 1) // 2
+        use_masking = 1 if use_masking_server else 0
+        self._c.execute("SELECT datetime('now', 'localtime')")
+        now = self._c.fetchone()[0]
+
+        self._c.execute('''WITH RECURSIVE source(i) AS
+                            (SELECT 1 UNION ALL
+                             SELECT i + 1 FROM source WHERE i < ?)
+                        INSERT INTO daligner_job
+                            (rowid, block_id1, block_id2, priority,
+                             use_masking, last_update)
+                        SELECT i, i, i, 1, ?, ? FROM source''',
+                        (n_blocks, use_masking, now))
+        n_added = n_blocks
+        if progress is not None:
+            progress(n_added, n_total)
+
+        for i in range(1, n_blocks):
+            self._c.execute('''WITH RECURSIVE target(j) AS
+                                (SELECT ? UNION ALL
+                                 SELECT j + 1 FROM target WHERE j < ?)
+                            INSERT INTO daligner_job
+                                (rowid, block_id1, block_id2, priority,
+                                 use_masking, last_update)
+                            SELECT ? + j, ?, j, ?, ?, ? FROM target''',
+                            (i + 1, n_blocks, n_added - i, i, i + 1,
+                             use_masking, now))
+            n_added += n_blocks - i
+            if progress is not None:
+                progress(n_added, n_total)
 
-        self._c.execute(query, tuple(y for x in jobs for y in x))
         self._db.commit()
 
     def any_using_masking(self):
-        self._c.execute('SELECT COUNT(*) FROM daligner_job WHERE use_masking = 1')
+        self._c.execute('''SELECT EXISTS
+                        (SELECT 1 FROM daligner_job WHERE use_masking = 1)''')
         return self._c.fetchone()[0] > 0
 
     def get_daligner_jobids(self, rowids):
@@ -195,7 +627,115 @@ class marvel_db:
                 tokens[ri] = token
         return tokens
 
+    def _parse_daligner_log(self, fname, full_fname, inode, size, cursor):
+        """Parse the part of a daligner log that has not been parsed yet.
+
+        Parameters
+        ----------
+        fname : str
+            Name of the log file, used as key in the database.
+        full_fname : str
+            Path to the log file.
+        inode : int
+            Current inode of the log file.
+        size : int
+            Current size of the log file.
+        cursor : sqlite3.Row or None
+            The stored parse state of the log file, or None if the
+            file has not been seen before.
+        """
+        started_regex = re.compile(r'Starting job\(s\) ((\d+ ?)+)')
+        completed_regex = re.compile(r'Finished job\(s\) ((\d+ ?)+)')
+        failed_regex = re.compile(r'Failed job\(s\) ((\d+ ?)+)')
+        slurm_fail_regex = re.compile(r'slurmstepd: error: \*\*\*')
+        task_done_regex = re.compile(r'Finished task')
+
+        if cursor is None or cursor['inode'] != inode \
+                or cursor['offset'] > size:
+            # New or rewritten file, start from the beginning.
+            self._c.execute('DELETE FROM daligner_log_job WHERE filename = ?',
+                            (fname,))
+            offset = 0
+            task_status = slurm_utils.status.running
+            last_start = []
+        else:
+            offset = cursor['offset']
+            task_status = cursor['status']
+            last_start = [int(x) for x in (cursor['last_start'] or '').split()]
+
+        with open(full_fname, 'rb') as f:
+            f.seek(offset)
+            data = f.read(size - offset)
+        # Leave incomplete lines for the next update.
+        data = data[:data.rfind(b'\n') + 1]
+        offset += len(data)
+
+        statuses = {}
+        def job_status(ri):
+            if ri not in statuses:
+                statuses[ri] = {'started': False,
+                                'completed': False,
+                                'failed': False}
+            return statuses[ri]
+
+        for line in data.decode('utf-8', errors='replace').splitlines():
+            start_match = started_regex.search(line)
+            if start_match:
+                last_start = list(map(int, start_match.group(1).split()))
+                for ri in last_start:
+                    job_status(ri)['started'] = True
+
+            end_match = completed_regex.search(line)
+            if end_match:
+                for ri in map(int, end_match.group(1).split()):
+                    job_status(ri)['completed'] = True
+
+            fail_match = failed_regex.search(line)
+            if fail_match:
+                for ri in map(int, fail_match.group(1).split()):
+                    job_status(ri)['failed'] = True
+
+            if slurm_fail_regex.match(line):
+                task_status = slurm_utils.status.failed
+                # Since we don't directly know what jobs failed
+                # when SLURM fails, we set the last started jobs
+                # as failed instead.
+                for ri in last_start:
+                    job_status(ri)['failed'] = True
+            elif task_done_regex.search(line):
+                task_status = slurm_utils.status.completed
+
+        self._c.execute('''INSERT OR REPLACE INTO daligner_log
+                        (filename, inode, offset, status, last_start,
+                         last_update)
+                        VALUES (?, ?, ?, ?, ?, datetime('now', 'localtime'))''',
+                        (fname, inode, offset, task_status,
+                         ' '.join(map(str, last_start))))
+        self._c.executemany('''INSERT OR IGNORE INTO daligner_log_job
+                            (filename, job_rowid) VALUES (?, ?)''',
+                            ((fname, ri) for ri in statuses))
+        self._c.executemany('''UPDATE daligner_log_job SET
+                            started = MAX(started, ?),
+                            completed = MAX(completed, ?),
+                            failed = MAX(failed, ?)
+                            WHERE filename = ? AND job_rowid = ?''',
+                            ((s['started'], s['completed'], s['failed'],
+                              fname, ri) for ri, s in statuses.items()))
+
     def update_daligner_jobs(self, rowids, log_directory):
+        """Update daligner job statuses from the daligner log files.
+
+        Only the parts of the log files that have been written since
+        the previous update are parsed, and log files of tasks that
+        have finished are not read at all.
+
+        Parameters
+        ----------
+        rowids : int or list of int
+            Row IDs of the jobs to update.
+        log_directory : str
+            Directory where the daligner log files are.
+        """
         if type(rowids) is not list:
             rowids = [rowids]
 
@@ -210,73 +750,52 @@ class marvel_db:
 
         token_regex = re.compile('|'.join(unique_tokens))
         jobid_regex = re.compile(r'_(\d+_\d+)\.log$')
-        started_regex = re.compile(r'Starting job\(s\) ((\d+ ?)+)')
-        completed_regex = re.compile(r'Finished job\(s\) ((\d+ ?)+)')
-        failed_regex = re.compile(r'Failed job\(s\) ((\d+ ?)+)')
-        slurm_fail_regex = re.compile(r'slurmstepd: error: \*\*\*')
 
-        start = time.time()
+        self._c.execute('SELECT * FROM daligner_log')
+        cursors = {x['filename']: x for x in self._c.fetchall()}
+
+        log_files = []
+        with os.scandir(log_directory) as it:
+            for entry in it:
+                if not token_regex.search(entry.name):
+                    continue
+                if not entry.is_file():
+                    continue
+                if not jobid_regex.search(entry.name):
+                    raise ValueError('no job id found in logfile')
+                log_files.append(entry.name)
+
+                cursor = cursors.get(entry.name)
+                if cursor is not None and cursor['status'] in \
+                        (slurm_utils.status.completed,
+                         slurm_utils.status.failed):
+                    continue
+                s = entry.stat()
+                if cursor is not None and cursor['inode'] == s.st_ino \
+                        and cursor['offset'] == s.st_size:
+                    continue
+                self._parse_daligner_log(entry.name, entry.path,
+                                         s.st_ino, s.st_size, cursor)
 
         statuses = {ri: {'started': False,
                          'completed': False,
                          'failed': False} for ri in rowids}
 
-        for fname in os.listdir(log_directory):
-            full_fname = os.path.join(log_directory, fname)
-            if not os.path.isfile(full_fname):
+        self._fill_temp_table('update_log', log_files, 'TEXT')
+        self._c.execute('''SELECT job_rowid,
+                                MAX(started), MAX(completed), MAX(failed)
+                        FROM daligner_log_job
+                        JOIN temp.update_log ON filename = value
+                        GROUP BY job_rowid''')
+        for ri, started, completed, failed in self._c:
+            if ri not in statuses:
                 continue
-            if not token_regex.search(full_fname):
-                continue
-            jobid_match = jobid_regex.search(full_fname)
-            if not jobid_match:
-                raise ValueError('no job id found in logfile')
-            jobid = jobid_match.group(1)
-
-            last_start = None
-            with open(full_fname) as f:
-                for line in f:
-                    start_match = started_regex.search(line)
-                    if start_match:
-                        rowid = map(int, start_match.group(1).split())
-                        last_start = []
-                        for ri in rowid:
-                            if ri not in rowids:
-                                continue
-                            last_start.append(ri)
-                            statuses[ri]['started'] = True
-
-                    end_match = completed_regex.search(line)
-                    if end_match:
-                        rowid = map(int, end_match.group(1).split())
-                        for ri in rowid:
-                            if ri not in rowids:
-                                continue
-                            statuses[ri]['completed'] = True
+            statuses[ri]['started'] = bool(started)
+            statuses[ri]['completed'] = bool(completed)
+            statuses[ri]['failed'] = bool(failed)
+        self._c.execute('DROP TABLE temp.update_log')
 
-                    fail_match = failed_regex.search(line)
-                    if fail_match:
-                        rowid = map(int, fail_match.group(1).split())
-                        for ri in rowid:
-                            if ri not in rowids:
-                                continue
-                            statuses[ri]['failed'] = True
-
-                    slurm_fail_match = slurm_fail_regex.match(line)
-                    if slurm_fail_match and len(last_start) > 0:
-                        # Since we don't directly know what jobs failed
-                        # when SLURM fails, we set the last started jobs
-                        # as failed instead.
-                        for ri in last_start:
-                            statuses[ri]['failed'] = True
-
-        print('fetched status in {0}'.format(time.time() - start))
-
-        query = '''UPDATE daligner_job SET
-            status = ?,
-            last_update = datetime("now", "localtime")
-        WHERE rowid = ?'''
-
-        start = time.time()
+        textstatuses = {}
         for ri, status in statuses.items():
             textstatus = slurm_utils.status.reserved
             if status['completed']:
@@ -285,23 +804,121 @@ class marvel_db:
                 textstatus = slurm_utils.status.failed
             elif status['started']:
                 textstatus = slurm_utils.status.running
-            self._c.execute(query, (textstatus, ri))
-        self._db.commit()
-        print('updated database in {0}'.format(time.time() - start))
+            textstatuses[ri] = textstatus
+        self.set_daligner_statuses(textstatuses)
+
+    def _fill_temp_table(self, name, values, column_type='INTEGER'):
+        """Create a temporary table with a single column, `value`.
+
+        Any existing temporary table with the same name is replaced.
+        This is used instead of long `IN (?, ?, ...)` lists, which are
+        both slow and limited in the number of parameters.
+
+        Parameters
+        ----------
+        name : str
+            Name of the temporary table.
+        values : iterable
+            Values to insert into the table.
+        column_type : str
+            SQLite type of the column.
+        """
+        self._c.execute('DROP TABLE IF EXISTS temp.{0}'.format(name))
+        self._c.execute('CREATE TEMP TABLE {0} (value {1} PRIMARY KEY)' \
+                        .format(name, column_type))
+        self._c.executemany('INSERT OR IGNORE INTO temp.{0} VALUES (?)' \
+                            .format(name), zip(values))
+
+    def set_daligner_statuses(self, statuses, commit=True):
+        """Set the status of multiple daligner jobs.
+
+        Jobs are grouped by their new status, and each group is
+        updated with a single statement. Jobs that already have
+        the new status are left untouched, so `last_update` only
+        changes when the status does.
+
+        Parameters
+        ----------
+        statuses : dict
+            New statuses, keyed by row ID.
+        commit : bool
+            Commit the changes. Set to False to make the update part
+            of a larger transaction.
+
+        Returns
+        -------
+        int
+            The number of jobs that changed status.
+        """
+        groups = {}
+        for ri, status in statuses.items():
+            groups.setdefault(status, []).append(ri)
+
+        n_changed = 0
+        for status, rowids in groups.items():
+            self._fill_temp_table('status_rowid', rowids)
+            self._c.execute('''UPDATE daligner_job SET
+                status = ?,
+                last_update = datetime("now", "localtime")
+            WHERE rowid IN temp.status_rowid AND status != ?''',
+                            (status, status))
+            n_changed += self._c.rowcount
+        self._c.execute('DROP TABLE IF EXISTS temp.status_rowid')
+        if commit:
+            self._db.commit()
+
+        return n_changed
 
     def set_daligner_jobids(self, rowids, jobid):
-        query = '''UPDATE daligner_job SET jobid = ? WHERE rowid IN ({0})''' \
-                .format(','.join('?' for x in rowids))
-        self._c.execute(query, (jobid,) + tuple(rowids))
+        self._fill_temp_table('jobid_rowid', rowids)
+        self._c.execute('''UPDATE daligner_job SET jobid = ?
+                        WHERE rowid IN temp.jobid_rowid''', (jobid,))
+        self._c.execute('DROP TABLE temp.jobid_rowid')
         self._db.commit()
 
+    def reconcile_daligner_jobs(self):
+        """Update the status of unfinished daligner jobs from the SLURM
+        accounting database.
+
+        Jobs are normally updated by parsing the log files, but array
+        tasks that are killed before they write anything, e.g. because
+        they ran out of memory or their node failed, never show up
+        there. This looks up the state of all array tasks of reserved
+        and running jobs with a single `sacct` call, and marks the jobs
+        whose task ended in one of `slurm_utils.failed_states`.
+
+        Returns
+        -------
+        int
+            The number of daligner jobs whose status was changed.
+        """
+        unfinished = (slurm_utils.status.reserved,
+                      slurm_utils.status.running)
+        self._c.execute('''SELECT rowid, jobid, reservation_token
+                           FROM daligner_job
+                           WHERE status IN (?, ?)
+                             AND jobid IS NOT NULL
+                             AND reservation_token IS NOT NULL''',
+                        unfinished)
+        jobs = self._c.fetchall()
+        states = slurm_utils.get_accounting_states(
+            set(jobid for _, jobid, _ in jobs))
+
+        statuses = {}
+        for rowid, jobid, token in jobs:
+            task_id = token.rsplit('_', 1)[-1]
+            task = states.get('{0}_{1}'.format(jobid, task_id))
+            if task is not None \
+                    and task['job_state'] in slurm_utils.failed_states:
+                statuses[rowid] = task['job_state']
+
+        return self.set_daligner_statuses(statuses)
+
     def get_daligner_jobs(self, max_jobs=None, status=()):
         query = 'SELECT rowid FROM daligner_job'
         if type(status) is not str and len(status) > 0:
-            query += ' WHERE '
-            for i in range(len(status) - 1):
-                query += 'status = ? OR '
-            query += 'status = ?'
+            query += ' WHERE status IN ({0})' \
+                    .format(','.join('?' for x in status))
         elif type(status) is str:
             query += ' WHERE status = ?'
             status = (status,)
@@ -327,47 +944,572 @@ class marvel_db:
 
         return [(x[0], x[1]) for x in res]
 
-    def reserve_daligner_jobs(self, token, max_jobs=1, comparisons_per_job=1):
+    @staticmethod
+    def _group_daligner_jobs(jobs, n_groups, comparisons_per_job):
+        """Group daligner jobs into reservations.
+
+        Each group is formed from the first `comparisons_per_job`
+        jobs that have not yet been grouped, and contains the jobs
+        among these that have the same source block as the first
+        one.
+
+        Parameters
+        ----------
+        jobs : list of tuple
+            Jobs as (rowid, block_id1, block_id2) tuples, ordered
+            by priority.
+        n_groups : int
+            Maximum number of groups to form.
+        comparisons_per_job : int
+            Maximum number of jobs in a group.
+
+        Returns
+        -------
+        list of dict
+            Reservations with the keys `source_block`,
+            `target_blocks` and `rowids`.
+        """
+        grouped = [False] * len(jobs)
+        head = 0
+        groups = []
+        for gi in range(n_groups):
+            while head < len(jobs) and grouped[head]:
+                head += 1
+            if head == len(jobs):
+                break
+            source_block = jobs[head][1]
+            group = []
+            window = 0
+            ji = head
+            while ji < len(jobs) and window < comparisons_per_job:
+                if not grouped[ji]:
+                    window += 1
+                    if jobs[ji][1] == source_block:
+                        grouped[ji] = True
+                        group.append(jobs[ji])
+                ji += 1
+            groups.append({
+                'source_block': source_block,
+                'target_blocks': [x[2] for x in group],
+                'rowids': [x[0] for x in group]
+            })
+        return groups
+
+    @staticmethod
+    def _group_daligner_tile(jobs, comparisons_per_job):
+        """Group the daligner jobs of a tile into reservations.
+
+        Each group contains up to `comparisons_per_job` jobs with the
+        same source block.
+
+        Parameters
+        ----------
+        jobs : list of tuple
+            Jobs as (rowid, block_id1, block_id2) tuples, ordered
+            by source and target block.
+        comparisons_per_job : int
+            Maximum number of jobs in a group.
+
+        Returns
+        -------
+        list of dict
+            Reservations with the keys `source_block`,
+            `target_blocks` and `rowids`.
+        """
+        groups = []
+        for source_block, row in itertools.groupby(jobs, lambda x: x[1]):
+            row = list(row)
+            for i in range(0, len(row), comparisons_per_job):
+                group = row[i:(i + comparisons_per_job)]
+                groups.append({
+                    'source_block': source_block,
+                    'target_blocks': [x[2] for x in group],
+                    'rowids': [x[0] for x in group]
+                })
+        return groups
+
+    def _select_daligner_tiles(self, n_tiles, tile_size):
+        """Select the daligner jobs of the first tiles that have jobs
+        left.
+
+        The comparison matrix is cut into tiles of `tile_size` source
+        blocks by `tile_size` target blocks, so the jobs of a tile
+        involve at most `2 * tile_size` distinct blocks. Tiles are
+        taken row by row, and each row of tiles is read with one query
+        on the source block.
+
+        Parameters
+        ----------
+        n_tiles : int
+            Maximum number of tiles to select.
+        tile_size : int
+            Number of blocks along each side of a tile.
+
+        Returns
+        -------
+        list of list of tuple
+            The jobs that have not been started in each tile, as
+            (rowid, block_id1, block_id2) tuples ordered by source and
+            target block.
+        """
+        tiles = []
+        self._c.execute('''SELECT MIN(block_id1) FROM daligner_job
+                        WHERE status = ?''',
+                        (slurm_utils.status.notstarted,))
+        first = self._c.fetchone()[0]
+        while first is not None and len(tiles) < n_tiles:
+            lo = (first - 1) // tile_size * tile_size + 1
+            hi = lo + tile_size - 1
+            self._c.execute('''SELECT rowid, block_id1, block_id2
+                            FROM daligner_job
+                            WHERE status = ? AND block_id1 BETWEEN ? AND ?
+                            ORDER BY (block_id2 - 1) / ?,
+                                     block_id1, block_id2''',
+                            (slurm_utils.status.notstarted, lo, hi,
+                             tile_size))
+            jobs = [tuple(x) for x in self._c.fetchall()]
+            for _, tile in itertools.groupby(
+                    jobs, lambda x: (x[2] - 1) // tile_size):
+                tiles.append(list(tile))
+                if len(tiles) == n_tiles:
+                    break
+            self._c.execute('''SELECT MIN(block_id1) FROM daligner_job
+                            WHERE status = ? AND block_id1 > ?''',
+                            (slurm_utils.status.notstarted, hi))
+            first = self._c.fetchone()[0]
+        return tiles
+
+    def _reserve_daligner_tasks(self, tokens, jobs_per_task,
+                                comparisons_per_job, status, jobid=None,
+                                tile_size=None):
+        """Reserve daligner jobs for several array tasks without taking
+        a lock. See `reserve_daligner_tasks`."""
+        if tile_size is not None:
+            reservations = [
+                self._group_daligner_tile(tile, comparisons_per_job)
+                for tile in self._select_daligner_tiles(len(tokens),
+                                                        tile_size)]
+            reservations += [[]] * (len(tokens) - len(reservations))
+        else:
+            n_jobs = len(tokens) * jobs_per_task
+
+            self._c.execute('''SELECT rowid, block_id1, block_id2
+                            FROM daligner_job
+                            WHERE status = ?
+                            ORDER BY priority
+                            LIMIT ?''',
+                            (slurm_utils.status.notstarted,
+                             n_jobs * comparisons_per_job))
+            jobs = [tuple(x) for x in self._c.fetchall()]
+
+            groups = self._group_daligner_jobs(jobs, n_jobs,
+                                               comparisons_per_job)
+            reservations = [groups[i:(i + jobs_per_task)]
+                            for i in range(0, n_jobs, jobs_per_task)]
+
+        self._c.execute('DROP TABLE IF EXISTS temp.reservation')
+        self._c.execute('''CREATE TEMP TABLE reservation
+                        (value INTEGER PRIMARY KEY, token TEXT)''')
+        self._c.executemany('INSERT INTO temp.reservation VALUES (?, ?)',
+                            ((ri, token)
+                             for token, reservation in zip(tokens, reservations)
+                             for group in reservation
+                             for ri in group['rowids']))
+        self._c.execute('''UPDATE daligner_job
+            SET status = ?,
+            reservation_token = (SELECT token FROM temp.reservation
+                                 WHERE value = daligner_job.rowid),
+            jobid = COALESCE(?, jobid),
+            last_update = datetime('now', 'localtime')
+            WHERE rowid IN (SELECT value FROM temp.reservation)''',
+                        (status, jobid))
+        self._c.execute('DROP TABLE temp.reservation')
+
+        return reservations
+
+    def reserve_daligner_tasks(self, tokens, jobs_per_task=1,
+                               comparisons_per_job=1, tile_size=None):
+        """Reserve daligner jobs for several array tasks.
+
+        All jobs that may be needed are selected with a single
+        query, grouped in memory, and marked as reserved with a
+        single update, all while holding an exclusive lock. The
+        result is the same as calling `reserve_daligner_jobs`
+        once for each token.
+
+        With `tile_size`, each task instead gets the jobs of one tile
+        of the comparison matrix, see `_select_daligner_tiles`. A
+        task then reads each of its blocks many times, which makes
+        it worthwhile to stage the blocks on the node.
+
+        Parameters
+        ----------
+        tokens : list of str
+            Reservation tokens, one for each task.
+        jobs_per_task : int
+            Maximum number of jobs to reserve for each task.
+        comparisons_per_job : int
+            Maximum number of block comparisons in each job.
+        tile_size : int, optional
+            Reserve a tile of this many source by target blocks for
+            each task instead of `jobs_per_task` jobs in order of
+            priority.
+
+        Returns
+        -------
+        list of list of dict
+            The reservations of each task, in the same order as
+            `tokens`. See `reserve_daligner_jobs` for the format
+            of a reservation.
+        """
         self.begin_exclusive()
+        reservations = self._reserve_daligner_tasks(
+            tokens, jobs_per_task, comparisons_per_job,
+            slurm_utils.status.reserved, tile_size=tile_size)
+        self.stop_exclusive()
 
-        reservation = []
+        return reservations
+
+    def claim_daligner_jobs(self, token, jobid, max_jobs=1,
+                            comparisons_per_job=1, completed=(), failed=()):
+        """Claim daligner jobs from a running array task.
+
+        This is how array tasks in pull mode get their work. The
+        outcome of the task's previous jobs is recorded and the next
+        jobs are claimed in the same exclusive transaction, so no two
+        tasks can claim the same job, and a task only has to access
+        the database once per batch.
+
+        Parameters
+        ----------
+        token : str
+            Reservation token of the task.
+        jobid : str
+            SLURM job ID of the array.
+        max_jobs : int
+            Maximum number of jobs to claim. Use 0 to only record the
+            outcome of previous jobs.
+        comparisons_per_job : int
+            Maximum number of block comparisons in each job.
+        completed : iterable of int
+            Row IDs of jobs the task has completed.
+        failed : iterable of int
+            Row IDs of jobs that failed in the task.
+
+        Returns
+        -------
+        list of dict
+            The claimed jobs, see `reserve_daligner_jobs`.
+        """
+        statuses = {ri: slurm_utils.status.completed for ri in completed}
+        statuses.update((ri, slurm_utils.status.failed) for ri in failed)
 
-        for ji in range(max_jobs):
-            rowids = self.get_daligner_jobs(max_jobs=comparisons_per_job,
-                                            status=slurm_utils.status.notstarted)
-            if len(rowids) == 0:
-                break
-            source_query = 'SELECT block_id1 FROM daligner_job WHERE rowid = ?'
-            self._c.execute(source_query, (rowids[0],))
-            source_block = self._c.fetchone()[0]
+        self.begin_exclusive()
+        self.set_daligner_statuses(statuses, commit=False)
+        claimed = []
+        if max_jobs > 0:
+            claimed = self._reserve_daligner_tasks(
+                [token], max_jobs, comparisons_per_job,
+                slurm_utils.status.running, jobid)[0]
+        self.stop_exclusive()
 
-            query = '''SELECT rowid, block_id1, block_id2
-                FROM daligner_job
-                WHERE block_id1 = ? AND rowid IN ({0})''' \
-                        .format(','.join('?' for ri in rowids))
-            self._c.execute(query, (source_block,) + tuple(rowids))
-            jobs = self._c.fetchall()
+        return claimed
 
-            assert(len(set(x[1] for x in jobs)) == 1)
+    def add_daligner_array(self, jobid, token, n_tasks):
+        """Register a daligner array that runs in pull mode."""
+        self._c.execute('''INSERT OR REPLACE INTO daligner_array
+                        (jobid, reservation_token, n_tasks, submitted_on)
+                        VALUES (?, ?, ?, datetime('now', 'localtime'))''',
+                        (str(jobid), token, n_tasks))
+        self._db.commit()
 
-            reservation.append({
-                'source_block': source_block,
-                'target_blocks': [x[2] for x in jobs],
-                'rowids': [x[0] for x in jobs]
-            })
+    def get_daligner_arrays(self):
+        """Get the job IDs of all daligner arrays that run in pull
+        mode."""
+        self._c.execute('SELECT jobid FROM daligner_array ORDER BY rowid')
+        return [x[0] for x in self._c.fetchall()]
+
+    def remove_daligner_arrays(self, jobids):
+        """Forget daligner arrays in pull mode that have finished."""
+        self._c.executemany('DELETE FROM daligner_array WHERE jobid = ?',
+                            ((str(x),) for x in jobids))
+        self._db.commit()
+
+    def reserve_block_stage(self, stage, blocks, token, max_blocks=None,
+                            force=False):
+        """Reserve blocks for a stage.
+
+        Blocks that have not been reserved for the stage before, or
+        whose last attempt failed, are reserved in a single
+        transaction, so concurrent commands never reserve the same
+        block.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage, e.g. `merge`.
+        blocks : list of int
+            Candidate blocks, in the order they should be reserved.
+        token : str
+            Reservation token.
+        max_blocks : int, optional
+            Maximum number of blocks to reserve.
+        force : bool
+            Also reserve blocks that have already completed the stage.
+            Blocks that are reserved, queued or running are never
+            reserved twice.
+
+        Returns
+        -------
+        list of int
+            The reserved blocks.
+        """
+        busy = (slurm_utils.status.reserved,
+                slurm_utils.status.pending,
+                slurm_utils.status.running)
+        if not force:
+            busy += (slurm_utils.status.completed,)
+
+        self.begin_exclusive()
+        self._c.execute('''SELECT block_id FROM block_stage
+                           WHERE stage = ? AND status IN ({0})''' \
+                        .format(','.join('?' for x in busy)),
+                        (stage,) + busy)
+        taken = set(x[0] for x in self._c.fetchall())
+        reserved = [b for b in blocks if b not in taken]
+        if max_blocks is not None:
+            reserved = reserved[:max_blocks]
+        self._c.executemany('''INSERT OR REPLACE INTO block_stage
+                            (block_id, stage, status, reservation_token,
+                             reserved_on, last_update)
+                            VALUES (?, ?, ?, ?,
+                                    datetime('now', 'localtime'),
+                                    datetime('now', 'localtime'))''',
+                            ((b, stage, slurm_utils.status.reserved, token)
+                             for b in reserved))
+        self.stop_exclusive()
+
+        return reserved
+
+    def release_block_stage(self, stage, token):
+        """Remove reservations of blocks that were never submitted."""
+        self._c.execute('''DELETE FROM block_stage
+                           WHERE stage = ? AND reservation_token = ?
+                             AND status = ?''',
+                        (stage, token, slurm_utils.status.reserved))
+        self._db.commit()
+
+    def set_block_stage_tasks(self, stage, tasks):
+        """Record the array tasks that process reserved blocks.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        tasks : iterable of tuple
+            Tuples (block, token, jobid, task_id, log_filename), where
+            `log_filename` is the log file name of the job array, with
+            `%A` and `%a` in place of the job and task IDs.
+        """
+        self._c.executemany('''UPDATE block_stage SET
+                            status = ?,
+                            reservation_token = ?,
+                            jobid = ?,
+                            task_id = ?,
+                            log_filename = ?,
+                            last_update = datetime('now', 'localtime')
+                            WHERE block_id = ? AND stage = ?''',
+                            ((slurm_utils.status.pending, token, str(jobid),
+                              task_id, log_filename, block, stage)
+                             for block, token, jobid, task_id, log_filename
+                             in tasks))
+        self._db.commit()
+
+    def set_block_stage_statuses(self, stage, statuses, commit=True):
+        """Set the status of blocks in a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        statuses : dict
+            New statuses, keyed by block ID. Blocks that have no
+            status in the stage yet are added.
+        commit : bool
+            Commit the changes. Set to False to make the update part
+            of a larger transaction.
+        """
+        self._c.executemany('''INSERT OR IGNORE INTO block_stage
+                            (block_id, stage) VALUES (?, ?)''',
+                            ((b, stage) for b in statuses))
+        self._c.executemany('''UPDATE block_stage SET
+                            status = ?,
+                            last_update = datetime('now', 'localtime')
+                            WHERE block_id = ? AND stage = ?
+                              AND status != ?''',
+                            ((status, b, stage, status)
+                             for b, status in statuses.items()))
+        if commit:
+            self._db.commit()
+
+    def update_block_stages(self):
+        """Update the status of submitted blocks from the log files and
+        the state of their array tasks.
+
+        Only the log files of tasks with queued or running blocks are
+        read. Blocks that a task did not report as finished or failed
+        before it left the queue are set as failed. Jobs that are not
+        array tasks, e.g. TKmerge, process all their blocks at once and
+        do not report individual blocks, so their blocks get the state
+        of the job instead.
+        """
+        self._c.execute('''SELECT block_id, stage, jobid, task_id,
+                                  log_filename
+                           FROM block_stage
+                           WHERE status IN (?, ?)
+                             AND jobid IS NOT NULL''',
+                        (slurm_utils.status.pending,
+                         slurm_utils.status.running))
+        tasks = {}
+        for row in self._c.fetchall():
+            key = (row['stage'], row['jobid'], row['task_id'],
+                   row['log_filename'])
+            tasks.setdefault(key, []).append(row['block_id'])
+
+        if len(tasks) == 0:
+            return
 
-            reserve_query = '''UPDATE daligner_job
-                SET status = "{0}",
-                reservation_token = "{1}",
-                last_update = datetime('now', 'localtime')
-                WHERE rowid IN ({2})''' \
-                        .format(slurm_utils.status.reserved, token,
-                                ','.join('?' for ri in range(len(jobs))))
-            self._c.execute(reserve_query, reservation[-1]['rowids'])
+        def slurm_jobid(jobid, task_id):
+            if task_id is None:
+                return jobid
+            return '{0}_{1}'.format(jobid, task_id)
+
+        block_regex = re.compile(r'\] (Finished|Failed) block (\d+)$')
+        snapshot = slurm_utils.get_snapshot(
+            slurm_jobid(jobid, task_id)
+            for stage, jobid, task_id, log_filename in tasks)
+
+        statuses = {}
+        for (stage, jobid, task_id, log_filename), blocks in tasks.items():
+            reported = {}
+            if log_filename is not None:
+                fname = log_filename.replace('%A', str(jobid)) \
+                        .replace('%a', str(task_id))
+                try:
+                    with open(fname, errors='replace') as f:
+                        for line in f:
+                            m = block_regex.search(line.rstrip())
+                            if m is None:
+                                continue
+                            reported[int(m.group(2))] = \
+                                    slurm_utils.status.completed \
+                                    if m.group(1) == 'Finished' \
+                                    else slurm_utils.status.failed
+                except FileNotFoundError:
+                    # The task has not started yet
+                    pass
+
+            job = snapshot.get(slurm_jobid(jobid, task_id))
+            if job is None:
+                task_status = None
+            elif job['job_state'] == slurm_utils.status.pending:
+                task_status = slurm_utils.status.pending
+            elif job['job_state'] in slurm_utils.live_states:
+                task_status = slurm_utils.status.running
+            elif task_id is None \
+                    and job['job_state'] == slurm_utils.status.completed:
+                task_status = slurm_utils.status.completed
+            else:
+                task_status = slurm_utils.status.failed
+
+            stage_statuses = statuses.setdefault(stage, {})
+            for b in blocks:
+                if b in reported:
+                    stage_statuses[b] = reported[b]
+                elif task_status is not None:
+                    stage_statuses[b] = task_status
 
+        self.begin_exclusive()
+        for stage, stage_statuses in statuses.items():
+            self.set_block_stage_statuses(stage, stage_statuses,
+                                          commit=False)
         self.stop_exclusive()
 
-        return reservation
+    def get_block_stage(self, stage, status=slurm_utils.status.completed):
+        """Get the blocks that have a certain status in a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+        status : str
+            Status of the blocks.
+
+        Returns
+        -------
+        list of int
+            The block IDs, in ascending order.
+        """
+        self._c.execute('''SELECT block_id FROM block_stage
+                           WHERE stage = ? AND status = ?
+                           ORDER BY block_id''', (stage, status))
+        return [x[0] for x in self._c.fetchall()]
+
+    def get_block_stage_tasks(self, stage):
+        """Get the status and job of every block in a stage.
+
+        Parameters
+        ----------
+        stage : str
+            Name of the stage.
+
+        Returns
+        -------
+        dict
+            Tuples (status, jobid, task_id) keyed by block ID. Blocks
+            that have never been reserved for the stage are missing.
+        """
+        self._c.execute('''SELECT block_id, status, jobid, task_id
+                           FROM block_stage WHERE stage = ?''', (stage,))
+        return {x[0]: tuple(x[1:]) for x in self._c.fetchall()}
+
+    def block_stage_counts(self):
+        """Count the blocks of each status in each stage.
+
+        Returns
+        -------
+        dict
+            Dictionary keyed by stage, with the number of blocks keyed
+            by status as values.
+        """
+        self._c.execute('''SELECT stage, status, COUNT(*) FROM block_stage
+                           GROUP BY stage, status''')
+        counts = {}
+        for stage, status, n in self._c.fetchall():
+            counts.setdefault(stage, {})[status] = n
+        return counts
+
+    def reserve_daligner_jobs(self, token, max_jobs=1, comparisons_per_job=1):
+        """Reserve daligner jobs for a single array task.
+
+        Parameters
+        ----------
+        token : str
+            Reservation token.
+        max_jobs : int
+            Maximum number of jobs to reserve.
+        comparisons_per_job : int
+            Maximum number of block comparisons in each job. The
+            comparisons of a job all have the same source block.
+
+        Returns
+        -------
+        list of dict
+            One dict per job, with the keys `source_block`,
+            `target_blocks` and `rowids`.
+        """
+        return self.reserve_daligner_tasks([token], max_jobs,
+                                           comparisons_per_job)[0]
 
     def reset_daligner_jobs(self, rowids):
         query = 'UPDATE daligner_job SET status = ? WHERE rowid IN ({0})' \
@@ -397,6 +1539,15 @@ class marvel_db:
                         VALUES (datetime('now', 'localtime'))''')
         self._db.commit()
 
+    def get_slurm_jobids(self):
+        """Get the SLURM job IDs of the prepare and masking jobs."""
+        self._c.execute('''SELECT jobid FROM prepare_job
+                           WHERE jobid IS NOT NULL
+                           UNION
+                           SELECT jobid FROM masking_job
+                           WHERE jobid IS NOT NULL''')
+        return [x[0] for x in self._c.fetchall()]
+
     def update_prepare_job_id(self, jobid):
         self._c.execute('UPDATE prepare_job SET jobid = ?', (jobid,))
         self._db.commit()
@@ -448,27 +1599,61 @@ class marvel_db:
         self._db.commit()
         self.update_masking_job_status()
 
+    def get_node_ip(self, node, max_age=86400):
+        """Get the IP address of a node.
+
+        Resolved addresses are cached in the database, and only
+        resolved again once they are older than `max_age`.
+
+        Parameters
+        ----------
+        node : str
+            Host name of the node.
+        max_age : float
+            Maximum age of a cached address in seconds.
+
+        Returns
+        -------
+        str
+            The IP address of the node.
+        """
+        self._c.execute('''SELECT ip FROM node_ip
+                           WHERE node = ? AND resolved_on > ?''',
+                        (node, time.time() - max_age))
+        res = self._c.fetchone()
+        if res is not None:
+            return res[0]
+        ip = slurm_utils.get_node_ip(node)
+        self._c.execute('''INSERT OR REPLACE INTO node_ip
+                            (node, ip, resolved_on)
+                           VALUES (?, ?, ?)''', (node, ip, time.time()))
+        self._db.commit()
+        return ip
+
     def update_masking_job_status(self):
         if not self.has_masking_job():
             return
 
-        self._c.execute('SELECT jobid FROM masking_job')
-        res = self._c.fetchone()
-
-        jobid = res[0]
+        self._c.execute('SELECT jobid, node, ip FROM masking_job')
+        jobid, old_node, old_ip = self._c.fetchone()
 
         try:
             job_status = slurm_utils.get_job_status(jobid)
         except ValueError:
             raise
+        node = None
         node_ip = None
         if job_status == slurm_utils.status.running:
             node = slurm_utils.get_job_node(jobid)
-            node_ip = slurm_utils.get_node_ip(node)
+            # Only resolve the address if the server moved
+            if node == old_node and old_ip is not None:
+                node_ip = old_ip
+            else:
+                node_ip = self.get_node_ip(node)
         self._c.execute('''UPDATE masking_job
-                        SET ip = ?, status = ?, last_update = datetime('now',
-                        'localtime')''',
-                        (node_ip, job_status))
+                        SET node = ?, ip = ?, status = ?,
+                        last_update = datetime('now', 'localtime')''',
+                        (node, node_ip, job_status))
 
         self._db.commit()
 
@@ -513,19 +1698,27 @@ class marvel_db:
         return self._c.fetchone()[0]
 
     def n_daligner_jobs(self, *args):
-        query = 'SELECT COUNT(block_id1) FROM daligner_job'
+        query = 'SELECT COUNT(*) FROM daligner_job'
         if len(args) > 0:
-            query += ' WHERE '
-            if len(args) > 1:
-                for i in range(0, len(args) - 1):
-                    query += 'status = ? OR '
-            query += 'status = ?'
+            query += ' WHERE status IN ({0})' \
+                    .format(','.join('?' for x in args))
             self._c.execute(query, args)
         else:
             self._c.execute(query)
 
         return self._c.fetchone()[0]
 
+    def n_daligner_tiles(self, tile_size):
+        """Get the number of tiles of the comparison matrix that have
+        jobs that have not been started, see `_select_daligner_tiles`."""
+        self._c.execute('''SELECT COUNT(*) FROM
+                            (SELECT DISTINCT (block_id1 - 1) / ?,
+                                             (block_id2 - 1) / ?
+                             FROM daligner_job WHERE status = ?)''',
+                        (tile_size, tile_size,
+                         slurm_utils.status.notstarted))
+        return self._c.fetchone()[0]
+
     def get_project_name(self):
         self._c.execute('SELECT name FROM project')
         return self._c.fetchone()[0]
@@ -534,30 +1727,69 @@ class marvel_db:
         self._c.execute('SELECT coverage FROM project')
         return self._c.fetchone()[0]
 
+    def _data_version(self):
+        """Get a value that changes whenever the database is written,
+        by this connection or by any other."""
+        self._c.execute('PRAGMA data_version')
+        return self._db.total_changes, self._c.fetchone()[0]
+
+    def daligner_status_counts(self):
+        """Count the daligner jobs in each status.
+
+        The counts are cached, and only recomputed after the database
+        has been written to, either through this object or by another
+        connection.
+
+        Returns
+        -------
+        dict
+            Number of daligner jobs keyed by status. Statuses without
+            any jobs are missing.
+        """
+        version = self._data_version()
+        if self._status_counts is None \
+                or self._status_counts_version != version:
+            self._c.execute('''SELECT status, COUNT(*)
+                               FROM daligner_job
+                               GROUP BY status''')
+            self._status_counts = dict(self._c.fetchall())
+            self._status_counts_version = version
+        return dict(self._status_counts)
+
     def info(self, key=None):
         self._c.execute('''SELECT name, coverage, started_on, prepared_on FROM project''')
         res = self._c.fetchone()
         if key is None:
+            counts = self.daligner_status_counts()
+
+            def count(*states):
+                return sum(counts.get(x, 0) for x in states)
+
+            # Every status is counted on exactly one line, so the lines
+            # add up to the total
             return {'name': res[0],
                     'coverage': res[1],
                     'started on': res[2],
                     'prepared on': res[3] if res[3] is not None else 'Not prepared',
                     'blocks': self.n_blocks(),
-                    'daligner jobs': self.n_daligner_jobs(),
+                    'daligner jobs': sum(counts.values()),
                     'daligner jobs running':
-                        self.n_daligner_jobs(slurm_utils.status.running),
+                        count(slurm_utils.status.running,
+                              slurm_utils.status.completing),
                     'daligner jobs finished':
-                        self.n_daligner_jobs(slurm_utils.status.completed),
+                        count(slurm_utils.status.completed),
                     'daligner jobs pending':
-                        self.n_daligner_jobs(slurm_utils.status.pending),
+                        count(slurm_utils.status.pending,
+                              slurm_utils.status.configuring),
                     'daligner jobs reserved':
-                        self.n_daligner_jobs(slurm_utils.status.reserved),
+                        count(slurm_utils.status.reserved),
                     'daligner jobs cancelled':
-                        self.n_daligner_jobs(slurm_utils.status.cancelled),
+                        count(slurm_utils.status.cancelled),
                     'daligner jobs failed':
-                        self.n_daligner_jobs(slurm_utils.status.failed),
+                        count(*(x for x in slurm_utils.failed_states
+                                if x != slurm_utils.status.cancelled)),
                     'daligner jobs not started':
-                        self.n_daligner_jobs(slurm_utils.status.notstarted)}
+                        counts.get(slurm_utils.status.notstarted, 0)}
         else:
             if key not in res.keys():
                 raise KeyError('"{0}" not a valid key'.format(key))
@@ -0,0 +1,79 @@
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+def scan_directory(directory, match=None):
+    """Stat the files in a directory with a single `os.scandir` pass.
+
+    Parameters
+    ----------
+    directory : str
+        Directory to scan.
+    match : callable, optional
+        Called with the name of each entry. Only entries for which
+        it returns True are stat'ed, which saves a metadata lookup
+        per skipped file.
+
+    Returns
+    -------
+    dict
+        `os.stat_result` of each regular file, keyed by file name.
+        Empty if the directory does not exist.
+    """
+    stats = {}
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                if match is not None and not match(entry.name):
+                    continue
+                if entry.is_file():
+                    stats[entry.name] = entry.stat()
+    except FileNotFoundError:
+        pass
+    return stats
+
+class directory_snapshot:
+    """The files in a set of directories at one point in time.
+
+    Each directory is scanned once, and all lookups are then answered
+    from memory. Checking many files this way costs one directory
+    listing per directory instead of one or two metadata lookups per
+    file, which matters on parallel file systems.
+
+    Parameters
+    ----------
+    directories : iterable of str
+        Directories to scan.
+    match : callable, optional
+        Only files whose name it returns True for are included, see
+        `scan_directory`.
+    threads : int, optional
+        Scan the directories with this many threads. Useful when the
+        files are spread over many directories, since the file system
+        can then serve several listings at the same time.
+    """
+
+    def __init__(self, directories, match=None, threads=None):
+        directories = sorted(set(os.path.abspath(d) for d in directories))
+        if threads is not None and threads > 1 and len(directories) > 1:
+            with ThreadPoolExecutor(threads) as pool:
+                stats = pool.map(lambda d: scan_directory(d, match),
+                                 directories)
+                self.directories = dict(zip(directories, stats))
+        else:
+            self.directories = {d: scan_directory(d, match)
+                                for d in directories}
+
+    def stat(self, path):
+        """Get the `os.stat_result` of a file, or None if the file
+        does not exist or is not in any of the scanned directories."""
+        path = os.path.abspath(path)
+        files = self.directories.get(os.path.dirname(path), {})
+        return files.get(os.path.basename(path))
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def size(self, path):
+        """Get the size of a file, or 0 if it does not exist."""
+        s = self.stat(path)
+        return s.st_size if s is not None else 0
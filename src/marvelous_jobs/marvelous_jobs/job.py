@@ -1,8 +1,11 @@
+import asyncio
 import hashlib
 import itertools
 import os
 import re
-from subprocess import Popen, PIPE
+import shlex
+from subprocess import Popen
+import sys
 
 import marvel
 import marvelous_jobs as mj
@@ -13,6 +16,11 @@ class marvel_job:
     This class should most likely not be instantiated
     directly, but rather be the parent of a more specialised
     class.
+
+    Scripts are saved under a name that contains a hash of their
+    content, e.g. `daligner_array.<hash>.sh`, so jobs with different
+    settings never overwrite each other's scripts, and a script that
+    has already been saved never has to be written again.
     """
 
     def __init__(self, args, jobname, filename,
@@ -28,8 +36,8 @@ class marvel_job:
         jobname : str
             Name of the job as used by SLURM.
         filename : str
-            Absolute path where the script should be
-            saved.
+            Absolute path of the script, before the content
+            hash is added to it.
         log_filename : str, optional
             Absolute path to the SLURM log file. If
             not given, the default log file will be
@@ -45,12 +53,14 @@ class marvel_job:
         self.jobname = jobname
         self.jobid = jobid
         self.account = account
-        self.filename = filename
+        self.script_name = filename
         self.logfile = log_filename
 
         if type(self.args[0]) is not list:
             self.args = [self.args]
 
+        self.filename = self.script_filename()
+
     def commandline(self):
         """Generate a (possibly multiline) command line string.
 
@@ -65,56 +75,71 @@ class marvel_job:
                                   and len(str(x)) > 0))
         return '\n'.join(lines)
 
+    def script_filename(self, str_script=None):
+        """Get the content addressed path of the script.
+
+        Parameters
+        ----------
+        str_script : str, optional
+            The script, if it has already been generated.
+
+        Returns
+        -------
+        str
+            The path of the script, with the first 12 characters
+            of the md5 digest of its content added before the
+            file extension.
+        """
+        if str_script is None:
+            str_script = str(self)
+        digest = hashlib.md5(str_script.encode('utf8')).hexdigest()[:12]
+        root, ext = os.path.splitext(self.script_name)
+        return '{0}.{1}{2}'.format(root, digest, ext)
+
     def save_script(self):
         """Save the script on disk.
 
-        The script is saved in the following cases:
-            1. The file does not already exist.
-            2. The file exists and the content
-               differs from what will be written
-               (based on the md5 digest).
+        Since the file name depends on the content, a script only
+        has to be written if no file with its name exists, and an
+        existing script never has to be read. The script is written
+        to a temporary file that is then renamed, so concurrent
+        submissions never see a partially written script.
+
+        Returns
+        -------
+        str
+            The path of the script, also stored in `filename`.
         """
         str_script = str(self)
-        if os.path.isfile(self.filename):
-            with open(self.filename) as f:
-                file_md5 = hashlib.md5(f.read().encode('utf8')).digest()
-            str_md5 = hashlib.md5(str_script.encode('utf8')).digest()
-            if str_md5 != file_md5:
-                with open(self.filename, 'w') as f:
-                    f.write(str_script)
-        else:
-            with open(self.filename, 'w') as f:
+        self.filename = self.script_filename(str_script)
+        if not os.path.isfile(self.filename):
+            tmp_filename = '{0}.{1}.tmp'.format(self.filename, os.getpid())
+            with open(tmp_filename, 'w') as f:
                 f.write(str_script)
+            os.replace(tmp_filename, self.filename)
+        return self.filename
 
-    def start(self, dryrun=False, force_write=False, *args):
-        """Start the job.
+    def sbatch_command(self, force_write=False, *args):
+        """Generate the command line for submitting the job.
+
+        Subclasses that pass arguments to their script override this
+        method rather than `start`, so that synchronous and
+        asynchronous submissions use the same command line.
 
         Parameters
         ----------
-        dryrun : bool
-            If True, then return the command line for
-            submitting the script. If False, submit the
-            job.
         force_write : bool
-            If True, write the script to file, regardless
-            of whether the script already exists or not.
-            If False, only write the script if it doesn't
-            already exist.
+            Has no effect since scripts are content addressed, an
+            existing script always has the right content.
         *args
             Additional arguments to be passed to the script.
 
         Returns
         -------
-        int
-            The job ID of the submission.
-
-        Raises
-        ------
-        RuntimeError
-            If the job submission prints on stderr.
+        list of str
+            The sbatch command line.
         """
-        if not os.path.isfile(self.filename) or force_write:
-            self.save_script()
+        self.save_script()
         run_args = ['sbatch',
                     '--parsable',
                     '--array' if 'array' in self.sbatch_args else '',
@@ -128,16 +153,74 @@ class marvel_job:
                     '-o' if self.logfile is not None else '',
                     self.logfile if self.logfile is not None else '',
                     '-J', self.jobname,
+                    '--dependency' \
+                        if self.sbatch_args.get('dependency') is not None \
+                        else '',
+                    self.sbatch_args.get('dependency') \
+                        if self.sbatch_args.get('dependency') is not None \
+                        else '',
+                    '--kill-on-invalid-dep=yes' \
+                        if self.sbatch_args.get('kill_on_invalid_dep') \
+                        else '',
                     self.filename,
                     *args]
-        clean_args = [str(x) for x in run_args if len(str(x)) > 0]
+        return [str(x) for x in run_args if len(str(x)) > 0]
+
+    def start(self, dryrun=False, force_write=False):
+        """Start the job.
+
+        Parameters
+        ----------
+        dryrun : bool
+            If True, then return the command line for
+            submitting the script. If False, submit the
+            job.
+        force_write : bool
+            Has no effect, see `sbatch_command`.
+
+        Returns
+        -------
+        int
+            The job ID of the submission.
+
+        Raises
+        ------
+        RuntimeError
+            If the job submission prints on stderr.
+        """
+        clean_args = self.sbatch_command(force_write)
         if dryrun:
             return ' '.join(clean_args)
-        p = Popen(clean_args, shell=False, stdout=PIPE, stderr=PIPE)
-        output = p.communicate()
-        if len(output[1].strip()) > 0:
-            raise RuntimeError(output[1].decode('utf-8'))
-        self.jobid = int(output[0].decode('utf-8').split(';')[0])
+        self.jobid = mj.slurm_utils.sbatch(clean_args)
+        return self.jobid
+
+    async def start_async(self, submitter=None, force_write=False):
+        """Start the job without blocking the event loop.
+
+        Parameters
+        ----------
+        submitter : slurm_utils.sbatch_submitter, optional
+            Submitter that limits the number of concurrent
+            submissions. If not given, the job is submitted
+            directly.
+        force_write : bool
+            Has no effect, see `sbatch_command`.
+
+        Returns
+        -------
+        int
+            The job ID of the submission.
+
+        Raises
+        ------
+        RuntimeError
+            If the job submission prints on stderr.
+        """
+        clean_args = self.sbatch_command(force_write)
+        if submitter is None:
+            self.jobid = await mj.slurm_utils.sbatch_async(clean_args)
+        else:
+            self.jobid = await submitter.submit(clean_args)
         return self.jobid
 
     def cancel(self):
@@ -183,6 +266,266 @@ class marvel_job:
                      self.commandline()]
         return '\n'.join([x for x in cmd_lines if len(x) > 0])+'\n'
 
+def remove_scripts(filename):
+    """Remove all saved versions of a script.
+
+    Parameters
+    ----------
+    filename : str
+        Path of the script without content hash, e.g.
+        `scripts/daligner_array.sh`.
+
+    Returns
+    -------
+    int
+        The number of removed files.
+    """
+    root, ext = os.path.splitext(filename)
+    pattern = re.compile(r'^{0}\.[0-9a-f]{{12}}{1}$'.format(
+        re.escape(os.path.basename(root)), re.escape(ext)))
+    directory = os.path.dirname(filename) or '.'
+    n_removed = 0
+    with os.scandir(directory) as it:
+        for entry in it:
+            if entry.name == os.path.basename(filename) \
+                    or pattern.match(entry.name):
+                os.remove(entry.path)
+                n_removed += 1
+    return n_removed
+
+def start_jobs(jobs, max_concurrent=4, force_write=False):
+    """Submit several independent jobs concurrently.
+
+    Parameters
+    ----------
+    jobs : list of marvel_job
+        The jobs to submit.
+    max_concurrent : int
+        Maximum number of submissions running at the same time.
+    force_write : bool
+        Has no effect, see `marvel_job.sbatch_command`.
+
+    Returns
+    -------
+    list of int
+        The job IDs, in the same order as the jobs.
+
+    Raises
+    ------
+    RuntimeError
+        If any of the submissions fails. The error is raised once all
+        submissions have finished, and the `jobid` of the jobs that
+        were submitted is set, so callers can tell them apart from
+        the ones that failed.
+    """
+    async def submit_all():
+        submitter = mj.slurm_utils.sbatch_submitter(max_concurrent)
+        return await asyncio.gather(
+            *(job.start_async(submitter, force_write) for job in jobs),
+            return_exceptions=True)
+    jobids = asyncio.run(submit_all())
+    for jobid in jobids:
+        if isinstance(jobid, BaseException):
+            raise jobid
+    return jobids
+
+def split_array(items, max_array_size):
+    """Split a list into consecutive shards that each fit in a job array.
+
+    Parameters
+    ----------
+    items : list
+        Items to split, one per array task.
+    max_array_size : int
+        Maximum number of tasks in a job array.
+
+    Returns
+    -------
+    list of list
+        The shards, in order.
+    """
+    return [items[i:(i + max_array_size)]
+            for i in range(0, len(items), max_array_size)]
+
+def shard_simultaneous_tasks(max_simultaneous_tasks, n_shards, chain=False):
+    """Get the simultaneous task limit of each shard of a job array.
+
+    Shards that run side by side share the limit, so that together they
+    never run more tasks at a time than a single array would. Chained
+    shards run one after another, so they can each use the full limit.
+    If there are more shards than the limit, they cannot share it, and
+    the shards have to be chained.
+
+    Parameters
+    ----------
+    max_simultaneous_tasks : int or None
+        Limit for all shards together.
+    n_shards : int
+        Number of shards.
+    chain : bool
+        Whether the shards are chained.
+
+    Returns
+    -------
+    int or None
+        Limit for each shard.
+    bool
+        Whether the shards have to be chained.
+    """
+    if max_simultaneous_tasks is None or chain or n_shards <= 1:
+        return max_simultaneous_tasks, chain
+    if n_shards > max_simultaneous_tasks:
+        return max_simultaneous_tasks, True
+    return max_simultaneous_tasks // n_shards, False
+
+def start_job_arrays(jobs, chain=False, max_concurrent=4):
+    """Submit the shards of a job array.
+
+    Parameters
+    ----------
+    jobs : list of marvel_job
+        The shards to submit.
+    chain : bool
+        If True, each shard is submitted with a dependency on the
+        previous one, so that it only starts once the previous shard
+        has finished. If False, the shards are submitted concurrently
+        and are independent of each other.
+    max_concurrent : int
+        Maximum number of concurrent submissions.
+
+    Returns
+    -------
+    list of int
+        The job IDs, in the same order as the jobs.
+
+    Raises
+    ------
+    RuntimeError
+        If a submission fails. Only the `jobid` of the shards that were
+        submitted is set; chained shards after the failed one are not
+        submitted.
+    """
+    if not chain:
+        return start_jobs(jobs, max_concurrent)
+    jobids = []
+    for job in jobs:
+        if len(jobids) > 0:
+            # The command line dependency replaces the one in the
+            # script, so keep depending on whatever the script did
+            dependency = 'afterany:{0}'.format(jobids[-1])
+            if job.sbatch_args.get('after') is not None:
+                dependency = 'after:{0},{1}'.format(
+                    job.sbatch_args.get('after'), dependency)
+            if job.sbatch_args.get('dependency') is not None:
+                dependency = '{0},{1}'.format(
+                    job.sbatch_args.get('dependency'), dependency)
+            job.sbatch_args['dependency'] = dependency
+        jobids.append(job.start())
+    return jobids
+
+def block_array_indices(n_blocks, blocks_per_task=1,
+                        max_simultaneous_tasks=None):
+    """Get the array indices of a job array that processes blocks.
+
+    Parameters
+    ----------
+    n_blocks : int
+        Number of blocks.
+    blocks_per_task : int
+        Number of blocks that each array task processes.
+    max_simultaneous_tasks : int, optional
+        Maximum number of tasks allowed to run simultaneously.
+
+    Returns
+    -------
+    str
+        The array indices, as given to `sbatch --array`.
+    """
+    array_indices = '1-{}'.format(-(-n_blocks // blocks_per_task))
+    if max_simultaneous_tasks is not None:
+        array_indices += '%{}'.format(max_simultaneous_tasks)
+    return array_indices
+
+def for_each_block(commands, parallel=1):
+    """Generate script lines that run commands for every block in a
+    reservation file.
+
+    The reservation file is read from `${reservation_filename}`, one
+    block per line. The commands can refer to the current block as
+    `${block}`. Each block is run in a subshell, and a line saying
+    whether it finished or failed is written to the log. The script
+    exits with a non-zero status if any of the blocks failed.
+
+    Parameters
+    ----------
+    commands : list of list of str
+        Script lines to run for each block.
+    parallel : int
+        Maximum number of blocks to process at the same time.
+
+    Returns
+    -------
+    list of list of str
+        The script lines.
+    """
+    lines = [['process_block() {'],
+             ['\tlocal block=$1']]
+    for c in commands:
+        if len(c) > 0:
+            lines.append(['\t{}'.format(c[0])] + list(c[1:]))
+        else:
+            lines.append([])
+    lines += [
+        ['}'],
+        [],
+        ['run_block() {'],
+        ['\tset +e'],
+        ['\t(set -e; process_block $1)'],
+        ['\tlocal status=$?'],
+        ['\tset -e'],
+        ['\tif [ ${status} -eq 0 ]; then'],
+        ['\t\techo "[$(date "+%F %T")] Finished block $1"'],
+        ['\telse'],
+        ['\t\techo "[$(date "+%F %T")] Failed block $1"'],
+        ['\tfi'],
+        ['\treturn ${status}'],
+        ['}'],
+        [],
+        ['failed=0'],
+        ['running=0'],
+        ['pids=()'],
+        # Wait for whichever block is done first, so a slow block does
+        # not keep the other slots idle. wait -n would do this, but it
+        # needs bash 4.3 or later.
+        ['wait_any() {'],
+        ['\twhile true; do'],
+        ['\t\tfor i in "${!pids[@]}"; do'],
+        ['\t\t\tif ! kill -0 ${pids[$i]} 2> /dev/null; then'],
+        ['\t\t\t\twait ${pids[$i]} || failed=1'],
+        ['\t\t\t\tunset "pids[$i]"'],
+        ['\t\t\t\trunning=$((running - 1))'],
+        ['\t\t\t\treturn'],
+        ['\t\t\tfi'],
+        ['\t\tdone'],
+        ['\t\tsleep 1'],
+        ['\tdone'],
+        ['}'],
+        [],
+        ['while read -r block <&3; do'],
+        ['\trun_block ${block} &'],
+        ['\tpids+=($!)'],
+        ['\trunning=$((running + 1))'],
+        ['\tif [ ${{running}} -ge {} ]; then'.format(parallel)],
+        ['\t\twait_any'],
+        ['\tfi'],
+        ['done 3< ${reservation_filename}'],
+        ['while [ ${running} -gt 0 ]; do'],
+        ['\twait_any'],
+        ['done'],
+        ['exit ${failed}']
+    ]
+    return lines
+
 class prepare_job(marvel_job):
 
     filename = 'marvel_prepare.sh'
@@ -213,12 +556,13 @@ class prepare_job(marvel_job):
                          account=account,
                          timelimit='1-00:00:00')
 
-    def start(self, dryrun=False, *args):
-        return super().start(dryrun=dryrun, force_write=True, *args)
+    def sbatch_command(self, force_write=True, *args):
+        return super().sbatch_command(True, *args)
 
 class daligner_job_array(marvel_job):
 
     filename = 'daligner_array.sh'
+    pull_filename = 'daligner_pull_array.sh'
 
     def __init__(self, n_tasks, database_filename, script_directory=None,
                  run_directory=None, reservation_token=None,
@@ -227,12 +571,44 @@ class daligner_job_array(marvel_job):
                  masking_port=None, repeat_annotations=None,
                  account=None, timelimit='1-00:00:00',
                  verbose=True, identity=True, tuple_suppression_frequency=20,
-                 correlation_rate=0.7, threads=4):
+                 correlation_rate=0.7, threads=4, pull=False,
+                 jobs_per_claim=1, comparisons_per_job=1, time_budget=None,
+                 coordinator=None):
+        """Job array that runs daligner jobs.
+
+        By default, each task runs the jobs that were reserved for it
+        before submission, read from a reservation file in
+        `run_directory`. In pull mode, each task instead repeatedly
+        claims `jobs_per_claim` jobs from the database and runs them,
+        until there are no jobs left or its time budget is used up,
+        so fast tasks take over work that slow tasks would otherwise
+        have queued up.
+
+        Parameters
+        ----------
+        pull : bool
+            Claim jobs from the database while running.
+        jobs_per_claim : int
+            Number of jobs to claim at a time in pull mode.
+        comparisons_per_job : int
+            Maximum number of block comparisons per job in pull mode.
+        time_budget : int, optional
+            Seconds after which a task in pull mode stops claiming new
+            jobs. A task also stops if its longest batch so far would
+            not fit in the remaining budget. Defaults to 90% of
+            `timelimit`.
+        coordinator : str, optional
+            Address file of a coordinator started with `marvelous_jobs
+            serve`. If given, the tasks look up the project and claim
+            jobs through the coordinator instead of accessing the
+            database directly.
+        """
         self.n_tasks = n_tasks
         self.jobs_per_task = jobs_per_task
         self.array_indices = range(1, n_tasks + 1)
         self.use_masking_server = masking_jobid is not None
         self.max_simultaneous_tasks = max_simultaneous_tasks
+        self.pull = pull
 
         if reservation_token is None:
             raise ValueError('reservation token must not be None')
@@ -243,42 +619,77 @@ class daligner_job_array(marvel_job):
         else:
             self.run_directory = run_directory
 
+        script_name = daligner_job_array.pull_filename if pull \
+                else daligner_job_array.filename
         if script_directory is None:
-            self.filename = daligner_job_array.filename
+            self.filename = script_name
         else:
-            self.filename = os.path.join(script_directory,
-                                         daligner_job_array.filename)
+            self.filename = os.path.join(script_directory, script_name)
         if log_directory is None:
             self.logfile = '{0}_{1}_%a_%A_%a.log' \
-                    .format(os.path.splitext(daligner_job_array.filename)[0],
+                    .format(os.path.splitext(script_name)[0],
                             self.reservation_token)
         else:
             self.logfile = os.path.join(
                 log_directory, '{0}_{1}_%a_%A_%a.log' \
-                .format(os.path.splitext(daligner_job_array.filename)[0],
+                .format(os.path.splitext(script_name)[0],
                         self.reservation_token))
 
+        if pull and time_budget is None:
+            timelimit_seconds = mj.slurm_utils.parse_timelimit(timelimit)
+            if timelimit_seconds is not None:
+                time_budget = int(0.9 * timelimit_seconds)
+        self.time_budget = time_budget
+
         sqlite_timeout = '-init <(echo .timeout 30000)'
-        args = [
-            # Setup
-            ['reservation=$1'],
-            ['reservation_filename="{0}/daligner_task_${{reservation}}'
-             '_${{SLURM_ARRAY_TASK_ID}}.txt"' \
-             .format(run_directory)],
-            ['echo', '"Using reservation in $reservation_filename"'],
-            ['project=$(sqlite3 {0} {1} "SELECT name FROM project")' \
-                .format(sqlite_timeout, database_filename)],
+        if pull:
+            setup = [
+                ['reservation=$1'],
+                ['token="${reservation}_${SLURM_ARRAY_TASK_ID}"'],
+                ['echo', '"Claiming jobs from {0} as $token"' \
+                    .format(database_filename)],
+            ]
+        else:
+            setup = [
+                ['reservation=$1'],
+                ['reservation_filename="{0}/daligner_task_${{reservation}}'
+                 '_${{SLURM_ARRAY_TASK_ID}}.txt"' \
+                 .format(run_directory)],
+                ['echo', '"Using reservation in $reservation_filename"'],
+            ]
+        if coordinator is not None:
+            client = '{0} -m marvelous_jobs.client {1}' \
+                    .format(shlex.quote(sys.executable),
+                            shlex.quote(coordinator))
+            lookup_project = '{0} project name'.format(client)
+            lookup_maskip = '{0} project masking_ip'.format(client)
+        else:
+            lookup_project = 'sqlite3 -readonly {0} {1} ' \
+                    '"SELECT name FROM project"' \
+                    .format(sqlite_timeout, database_filename)
+            lookup_maskip = 'sqlite3 -readonly {0} {1} ' \
+                    '"SELECT ip FROM masking_job"' \
+                    .format(sqlite_timeout, database_filename)
+        args = setup + [
+            ['project=$({0})'.format(lookup_project)],
+            *([['if [[ -z $project ]]; then'],
+               ['\techo >&2 "error: could not look up the project"'],
+               ['\texit 1'],
+               ['fi']] if coordinator is not None else []),
             [],
             # Masking server
-            ['maskip=$(sqlite3 {0} {1} "SELECT ip FROM masking_job")' \
-                .format(sqlite_timeout, database_filename)],
+            ['maskip=$({0})'.format(lookup_maskip)],
             ['if [[ {0} = true ]] && [[ -z $maskip ]]; then' \
                 .format('true' if self.use_masking_server else 'false')],
             ['\techo >&2 "error: no masking server available"'],
             ['\texit 1'],
             ['fi'],
             [],
-            # daligner
+        ]
+
+        # daligner, run for each line of a reservation
+        indent = '\t' if pull else ''
+        run_jobs = [
             ['while', 'IFS=$\'\\t\'', 'read', '-ra', 'line;', 'do'],
             ['\tsource_block=${line[0]}'],
             ['\tn=$(expr ${#line[@]} - 1)'],
@@ -303,12 +714,71 @@ class daligner_job_array(marvel_job):
              '"${blocks[@]/#/${project}.}"; then'],
             ['\t\techo "[$(date "+%F %T")] Finished job(s) ${rowids[@]}: '
              '${source_block} vs ${blocks[@]}"'],
+            *([['\t\tcompleted+=(${rowids[@]})']] if pull else []),
             ['\telse'],
             ['\t\techo "[$(date "+%F %T")] Failed job(s) ${rowids[@]}: '
              '${source_block} vs ${blocks[@]}"'],
+            *([['\t\tfailed+=(${rowids[@]})']] if pull else []),
             ['\tfi'],
-            ['done', '<', '$reservation_filename']
+            ['done', '<<<', '"$batch"'] if pull \
+                else ['done', '<', '$reservation_filename'],
         ]
+        run_jobs = [[indent + str(a[0])] + a[1:] if len(a) > 0 else a
+                    for a in run_jobs]
+
+        if pull:
+            # Each claim also reports the outcome of the previous batch
+            claim = 'claim "$token" "$SLURM_ARRAY_JOB_ID" -n $1 -c {0} ' \
+                    '--completed "${{completed[*]:-}}" ' \
+                    '--failed "${{failed[*]:-}}"'.format(comparisons_per_job)
+            if coordinator is not None:
+                claim = '\t{0} {1}'.format(client, claim)
+            else:
+                claim = '\t(cd {0} && {1} -m marvelous_jobs daligner {2})' \
+                        .format(shlex.quote(os.path.dirname(
+                                    os.path.abspath(database_filename))),
+                                shlex.quote(sys.executable), claim)
+            args += [
+                ['claim() {'],
+                [claim],
+                ['}'],
+                [],
+                ['completed=()'],
+                ['failed=()'],
+                ['longest=0'],
+                ['while true; do'],
+                ['\tn_claim={0}'.format(jobs_per_claim)],
+            ]
+            if time_budget is not None:
+                args += [
+                    ['\tif [[ $(expr $SECONDS + $longest) -gt {0} ]]; then' \
+                        .format(time_budget)],
+                    ['\t\techo "[$(date "+%F %T")] Time budget used up"'],
+                    ['\t\tn_claim=0'],
+                    ['\tfi'],
+                ]
+            args += [
+                ['\tif ! batch=$(claim $n_claim); then'],
+                ['\t\techo >&2 "error: could not claim jobs"'],
+                ['\t\texit 1'],
+                ['\tfi'],
+                ['\tcompleted=()'],
+                ['\tfailed=()'],
+                ['\tif [[ -z $batch ]]; then'],
+                ['\t\tbreak'],
+                ['\tfi'],
+                ['\tbatch_start=$SECONDS'],
+                *run_jobs,
+                ['\tif [[ $(expr $SECONDS - $batch_start) -gt $longest ]]; '
+                 'then'],
+                ['\t\tlongest=$(expr $SECONDS - $batch_start)'],
+                ['\tfi'],
+                ['done'],
+            ]
+        else:
+            args += run_jobs
+        args.append(['echo "[$(date "+%F %T")] Finished task '
+                     '${SLURM_ARRAY_TASK_ID}"'])
 
         super().__init__(args, 'daligner_array',
                          self.filename,
@@ -335,8 +805,8 @@ class daligner_job_array(marvel_job):
             array_str += '%{0}'.format(self.max_simultaneous_tasks)
         return array_str
 
-    def start(self, dryrun=False, force_write=False):
-        return super().start(dryrun, force_write, self.reservation_token)
+    def sbatch_command(self, force_write=False):
+        return super().sbatch_command(force_write, self.reservation_token)
 
 class masking_server_job(marvel_job):
 
@@ -345,7 +815,8 @@ class masking_server_job(marvel_job):
     def __init__(self, name, coverage, checkpoint_file,
                  script_directory=None, log_directory=None,
                  jobid=None, port=12345, threads=4, constraint=None,
-                 cluster=None, account=None, timelimit='10-00:00:00'):
+                 cluster=None, account=None, timelimit='10-00:00:00',
+                 ip=None):
         jobname = 'marvel_masking'
         self.port = port
         self.threads = threads
@@ -368,8 +839,10 @@ class masking_server_job(marvel_job):
         ]
         self.constraint = constraint
         self.cluster = cluster
-        self.ip = None
-        if jobid is not None:
+        # Use the address stored in the database if there is one,
+        # otherwise ask SLURM where the server is running.
+        self.ip = ip
+        if jobid is not None and ip is None:
             node = mj.slurm_utils.get_job_node(jobid)
             if node is not None:
                 self.ip = mj.slurm_utils.get_node_ip(node)
@@ -385,8 +858,8 @@ class masking_server_job(marvel_job):
                          constraint=self.constraint,
                          cluster=self.cluster)
 
-    def start(self, dryrun=False, *args):
-        return super().start(dryrun=dryrun, force_write=True, *args)
+    def sbatch_command(self, force_write=True, *args):
+        return super().sbatch_command(True, *args)
 
     def stop(self):
         dmctl = os.path.join(marvel.config.PATH_BIN, 'DMctl')
@@ -405,7 +878,8 @@ class merge_job_array(marvel_job):
                  max_simultaneous_tasks=None, script_directory=None,
                  log_directory=None, reservation_token=None,
                  run_directory=None, account=None,
-                 timelimit='1-00:00:00', verbose=True):
+                 timelimit='1-00:00:00', verbose=True,
+                 blocks_per_task=1, cores=None):
         jobname = 'las_merge'
 
         if reservation_token is None:
@@ -433,13 +907,9 @@ class merge_job_array(marvel_job):
                 .format(os.path.splitext(merge_job_array.filename)[0],
                         self.reservation_token))
 
-        if len(blocks) > 1000:
-            raise ValueError('maximum 1000 blocks can be merged, tried to '
-                             'merge {}'.format(len(blocks)))
 
-        self.array_indices = '1-{}'.format(len(blocks))
-        if max_simultaneous_tasks is not None:
-            self.array_indices += '%{}'.format(max_simultaneous_tasks)
+        self.array_indices = block_array_indices(len(blocks), blocks_per_task,
+                                                 max_simultaneous_tasks)
 
         sqlite_timeout = '-init <(echo .timeout 30000)'
         args = [
@@ -448,12 +918,12 @@ class merge_job_array(marvel_job):
              '${{SLURM_ARRAY_TASK_ID}}.txt"' \
              .format(run_directory)],
             ['echo', '"Using reservation in $reservation_filename"'],
-            ['block=$(cat ${reservation_filename})'],
+            ['db="{}"'.format(project)],
+            []
+        ] + for_each_block([
             ['echo',
              '"Merging block ${block} in job ${SLURM_JOB_ID}',
              '(array ${SLURM_ARRAY_JOB_ID})"'],
-            ['db="{}"'.format(project)],
-            [],
             ['LAmerge',
              '-v' if verbose else '',
              '-s',
@@ -465,7 +935,7 @@ class merge_job_array(marvel_job):
             [],
             ['echo', '"Deleting input files..."'],
             ['rm', '-r', '$(printf "d001_%05d" ${block})']
-        ]
+        ], parallel=max(1, (cores or 2) // 2))
 
         super().__init__(args,
                          jobname,
@@ -474,10 +944,10 @@ class merge_job_array(marvel_job):
                          timelimit=timelimit,
                          account=account,
                          array=self.array_indices,
-                         cores=2)
+                         cores=cores or 2)
 
-    def start(self, dryrun=False, force_write=False):
-        return super().start(dryrun, force_write, self.reservation_token)
+    def sbatch_command(self, force_write=False):
+        return super().sbatch_command(force_write, self.reservation_token)
 
 class annotate_job_array(marvel_job):
 
@@ -487,7 +957,7 @@ class annotate_job_array(marvel_job):
                  max_simultaneous_tasks=None, script_directory=None,
                  log_directory=None, reservation_token=None,
                  run_directory=None, account=None,
-                 timelimit='1-00:00:00'):
+                 timelimit='1-00:00:00', blocks_per_task=1, cores=None):
         jobname = 'annotation'
 
         if reservation_token is None:
@@ -515,13 +985,9 @@ class annotate_job_array(marvel_job):
                 .format(os.path.splitext(annotate_job_array.filename)[0],
                         self.reservation_token))
 
-        if len(blocks) > 1000:
-            raise ValueError('maximum 1000 blocks can be run, tried to '
-                             'merge {}'.format(len(blocks)))
 
-        self.array_indices = '1-{}'.format(len(blocks))
-        if max_simultaneous_tasks is not None:
-            self.array_indices += '%{}'.format(max_simultaneous_tasks)
+        self.array_indices = block_array_indices(len(blocks), blocks_per_task,
+                                                 max_simultaneous_tasks)
 
         sqlite_timeout = '-init <(echo .timeout 30000)'
         args = [
@@ -530,15 +996,15 @@ class annotate_job_array(marvel_job):
              '_${{SLURM_ARRAY_TASK_ID}}.txt"' \
              .format(run_directory)],
             ['echo', '"Using reservation in $reservation_filename"'],
-            ['block=$(cat ${reservation_filename})'],
-            ['echo', '"Annotating block ${block}"'],
             ['db="{}"'.format(project)],
-            [],
+            []
+        ] + for_each_block([
+            ['echo', '"Annotating block ${block}"'],
             ['LAq',
              '-b', '${block}',
              '${db}',
              '${db}.${block}.las']
-        ]
+        ], parallel=max(1, (cores or 2) // 2))
 
         super().__init__(args,
                          jobname,
@@ -547,10 +1013,10 @@ class annotate_job_array(marvel_job):
                          timelimit=timelimit,
                          account=account,
                          array=self.array_indices,
-                         cores=2)
+                         cores=cores or 2)
 
-    def start(self, dryrun=False, force_write=False):
-        return super().start(dryrun, force_write, self.reservation_token)
+    def sbatch_command(self, force_write=False):
+        return super().sbatch_command(force_write, self.reservation_token)
 
 class patch_job_array(marvel_job):
 
@@ -562,7 +1028,9 @@ class patch_job_array(marvel_job):
                  max_simultaneous_tasks,
                  update_repeat_annotations,
                  config,
-                 reservation_token=None):
+                 reservation_token=None,
+                 blocks_per_task=1,
+                 cores=None):
 
         jobname = 'patching'
 
@@ -589,13 +1057,9 @@ class patch_job_array(marvel_job):
             .format(os.path.splitext(patch_job_array.filename)[0],
                     self.reservation_token))
 
-        if len(blocks) > 1000:
-            raise ValueError('maximum 1000 blocks can be run, tried to '
-                             'merge {}'.format(len(blocks)))
 
-        self.array_indices = '1-{}'.format(len(blocks))
-        if max_simultaneous_tasks is not None:
-            self.array_indices += '%{}'.format(max_simultaneous_tasks)
+        self.array_indices = block_array_indices(len(blocks), blocks_per_task,
+                                                 max_simultaneous_tasks)
 
         args = [
             ['reservation=$1'],
@@ -605,10 +1069,10 @@ class patch_job_array(marvel_job):
              '_${{SLURM_ARRAY_TASK_ID}}.txt"' \
              .format(run_directory)],
             ['echo', '"Using reservation in $reservation_filename"'],
-            ['block=$(cat ${reservation_filename})'],
-            ['echo', '"Patching block ${block}"'],
             ['db="{}"'.format(project)],
-            [],
+            []
+        ] + for_each_block([
+            ['echo', '"Patching block ${block}"'],
             ['if [[ ${trim} == "True"  ]]; then'],
             ['\tLAfix',
              '-g', '-1',
@@ -637,7 +1101,7 @@ class patch_job_array(marvel_job):
              format(db='${db}', block='${block}',
                     trim='')],
             ['fi']
-        ]
+        ], parallel=max(1, (cores or 6) // 6))
 
         super().__init__(args,
                          jobname,
@@ -646,12 +1110,12 @@ class patch_job_array(marvel_job):
                          timelimit=timelimit,
                          account=account,
                          array=self.array_indices,
-                         cores=6)
+                         cores=cores or 6)
 
-    def start(self, dryrun=False):
-        return super().start(dryrun, True,
-                             self.reservation_token,
-                             self.trim)
+    def sbatch_command(self, force_write=True):
+        return super().sbatch_command(True,
+                                      self.reservation_token,
+                                      self.trim)
 
 class stats_job_array(marvel_job):
 
@@ -667,7 +1131,9 @@ class stats_job_array(marvel_job):
                  reservation_token=None,
                  run_directory=None,
                  account=None,
-                 timelimit='1-00:00:00'):
+                 timelimit='1-00:00:00',
+                 blocks_per_task=1,
+                 cores=None):
 
         jobname = 'stats'
 
@@ -696,13 +1162,9 @@ class stats_job_array(marvel_job):
                 .format(os.path.splitext(stats_job_array.filename)[0],
                         self.reservation_token))
 
-        if len(blocks) > 1000:
-            raise ValueError('maximum 1000 blocks can be run, tried to '
-                             'merge {}'.format(len(blocks)))
 
-        self.array_indices = '1-{}'.format(len(blocks))
-        if max_simultaneous_tasks is not None:
-            self.array_indices += '%{}'.format(max_simultaneous_tasks)
+        self.array_indices = block_array_indices(len(blocks), blocks_per_task,
+                                                 max_simultaneous_tasks)
 
         args = [
             ['reservation=$1'],
@@ -710,15 +1172,15 @@ class stats_job_array(marvel_job):
              '${{SLURM_ARRAY_TASK_ID}}.txt"' \
              .format(run_directory)],
             ['echo', '"# Using reservation in $reservation_filename"'],
-            ['block=$(cat ${reservation_filename})'],
-            ['echo', '"# Getting stats for ${block}"'],
             ['db="{}"'.format(project)],
-            [],
+            []
+        ] + for_each_block([
+            ['echo', '"# Getting stats for ${block}"'],
             ['LAstats',
              '${db}',
              '${db}.${block}.las',
              '>', out_filename_template.format('${db}', '${block}')]
-        ]
+        ], parallel=cores or 1)
 
         super().__init__(args,
                          jobname,
@@ -727,10 +1189,10 @@ class stats_job_array(marvel_job):
                          timelimit=timelimit,
                          account=account,
                          array=self.array_indices,
-                         cores=1)
+                         cores=cores or 1)
 
-    def start(self, dryrun=False, force_write=False):
-        return super().start(dryrun, force_write, self.reservation_token)
+    def sbatch_command(self, force_write=False):
+        return super().sbatch_command(force_write, self.reservation_token)
 
 class check_job(marvel_job):
 
@@ -786,12 +1248,11 @@ class check_job(marvel_job):
                          timelimit=timelimit,
                          cores=cores)
 
-    def start(self, dryrun=False, force_write=False):
-        return super().start(dryrun,
-                             force_write,
-                             self.project,
-                             self.block,
-                             self.run)
+    def sbatch_command(self, force_write=False):
+        return super().sbatch_command(force_write,
+                                      self.project,
+                                      self.block,
+                                      self.run)
 
 class annotation_merge_job(marvel_job):
 
@@ -835,7 +1296,9 @@ class repeat_annotation_array(marvel_job):
                  blocks,
                  max_simultaneous_tasks,
                  config,
-                 reservation_token):
+                 reservation_token,
+                 blocks_per_task=1,
+                 cores=None):
 
         jobname = 'annotate_repeats'
 
@@ -861,13 +1324,9 @@ class repeat_annotation_array(marvel_job):
                                '{}_{}_%a_%A_%a.log' \
                                .format(jobname, self.reservation_token))
 
-        if len(blocks) > 1000:
-            raise ValueError('maximum 1000 blocks can be run, tried to '
-                             'annotate {}'.format(len(blocks)))
 
-        self.array_indices = '1-{}'.format(len(blocks))
-        if max_simultaneous_tasks is not None:
-            self.array_indices += '%{}'.format(max_simultaneous_tasks)
+        self.array_indices = block_array_indices(len(blocks), blocks_per_task,
+                                                 max_simultaneous_tasks)
 
         args = [
             ['reservation=$1'],
@@ -876,16 +1335,16 @@ class repeat_annotation_array(marvel_job):
              '_${{SLURM_ARRAY_TASK_ID}}.txt"' \
              .format(rundir=run_directory, jobname=jobname)],
             ['echo', '"# Using reservation in ${reservation_filename}"'],
-            ['block=$(cat ${reservation_filename})'],
-            ['echo', '"# Annotating block ${block}"'],
             ['db="{}"'.format(project)],
-            [],
+            []
+        ] + for_each_block([
+            ['echo', '"# Annotating block ${block}"'],
             ['LArepeat',
              '-c', coverage,
              '-b', '${block}',
              '${db}',
              '${db}.${block}.las']
-        ]
+        ], parallel=cores or 1)
 
         super().__init__(args,
                          jobname,
@@ -894,8 +1353,8 @@ class repeat_annotation_array(marvel_job):
                          timelimit=timelimit,
                          account=account,
                          array=self.array_indices,
-                         cores=1)
+                         cores=cores or 1)
 
-    def start(self, dryrun=False):
-        return super().start(dryrun, True,
-                             self.reservation_token)
+    def sbatch_command(self, force_write=True):
+        return super().sbatch_command(True,
+                                      self.reservation_token)
@@ -0,0 +1,149 @@
+import json
+import os
+import secrets
+import socket
+import socketserver
+
+from marvelous_jobs import slurm_utils
+from marvelous_jobs.database import marvel_db
+
+# Name of the address file in the project directory
+address_filename = 'coordinator.json'
+
+class coordinator_handler(socketserver.StreamRequestHandler):
+    """Handle a single request, sent as one line of JSON.
+
+    Requests are served one at a time, so a client that stalls would
+    hold up all others. The connection is therefore dropped if the
+    request line does not arrive within `timeout` seconds, well below
+    the timeout of the clients.
+    """
+
+    timeout = 2
+
+    def handle(self):
+        try:
+            line = self.rfile.readline()
+        except socket.timeout:
+            return
+        if len(line) == 0:
+            return
+        try:
+            request = json.loads(line.decode('utf8'))
+            if request.get('key') != self.server.key:
+                raise PermissionError('invalid key')
+            result = self.server.dispatch(request['method'],
+                                          request.get('params', {}))
+            response = {'ok': True, 'result': result}
+        except Exception as e:
+            response = {'ok': False,
+                        'error': '{0}: {1}'.format(type(e).__name__, e)}
+        self.wfile.write(json.dumps(response).encode('utf8') + b'\n')
+
+class coordinator(socketserver.TCPServer):
+    """Coordinator that owns the project database.
+
+    Job scripts on the compute nodes talk to the coordinator, see
+    `marvelous_jobs.client`, instead of opening the database over the
+    shared file system. Requests are handled one at a time, so all
+    database access happens in this process.
+
+    Parameters
+    ----------
+    db_filename : str
+        Path to the project database.
+    address : tuple
+        Host and port to listen on. Port 0 picks a free port.
+    key : str, optional
+        Key that clients have to send with each request. A random
+        key is generated if not given.
+    **db_settings
+        Connection settings passed on to `marvel_db.from_file`.
+    """
+
+    allow_reuse_address = True
+    methods = ('ping', 'project', 'claim', 'complete', 'fail')
+
+    def __init__(self, db_filename, address=('', 0), key=None,
+                 **db_settings):
+        super().__init__(address, coordinator_handler)
+        self.db_filename = db_filename
+        self.db_settings = db_settings
+        self.key = key if key is not None else secrets.token_hex(16)
+        self._db = None
+
+    @property
+    def db(self):
+        # Opened on first use, so that it belongs to the thread that
+        # serves the requests.
+        if self._db is None:
+            self._db = marvel_db.from_file(self.db_filename,
+                                           **self.db_settings)
+        return self._db
+
+    def address(self, host=None):
+        """Get the address clients should connect to.
+
+        Parameters
+        ----------
+        host : str, optional
+            Host name to advertise. Defaults to the host the
+            coordinator is bound to, or the fully qualified name of
+            this host if it is bound to all interfaces.
+        """
+        bound_host, port = self.server_address[:2]
+        if host is None:
+            host = bound_host if bound_host not in ('', '0.0.0.0') \
+                    else socket.getfqdn()
+        return {'host': host, 'port': port, 'key': self.key}
+
+    def write_address(self, filename, host=None):
+        """Write the address to a file that only the owner can read."""
+        tmp_filename = '{0}.tmp'.format(filename)
+        fd = os.open(tmp_filename, os.O_WRONLY | os.O_CREAT | os.O_TRUNC,
+                     0o600)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.address(host), f)
+        os.replace(tmp_filename, filename)
+
+    def dispatch(self, method, params):
+        if method not in self.methods:
+            raise ValueError('unknown method {0}'.format(method))
+        try:
+            return getattr(self, method)(**params)
+        except Exception:
+            # Do not leave the connection in a failed transaction, that
+            # would block all other requests
+            if self._db is not None and self._db._db.in_transaction:
+                self._db._db.rollback()
+            raise
+
+    def ping(self):
+        return 'pong'
+
+    def project(self):
+        return {'name': self.db.get_project_name(),
+                'masking_ip': self.db.get_masking_ip()}
+
+    def claim(self, token, jobid, n=1, comparisons_per_job=1,
+              completed=(), failed=()):
+        return self.db.claim_daligner_jobs(token, jobid, n,
+                                           comparisons_per_job,
+                                           completed=completed,
+                                           failed=failed)
+
+    def complete(self, rowids):
+        return self.db.set_daligner_statuses(
+            {ri: slurm_utils.status.completed for ri in rowids})
+
+    def fail(self, rowids):
+        return self.db.set_daligner_statuses(
+            {ri: slurm_utils.status.failed for ri in rowids})
+
+    def serve_forever(self, poll_interval=0.5):
+        try:
+            super().serve_forever(poll_interval)
+        finally:
+            if self._db is not None:
+                self._db._db.close()
+                self._db = None
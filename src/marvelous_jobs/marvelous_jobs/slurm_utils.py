@@ -1,6 +1,9 @@
+import asyncio
 import pyslurm
+import re
 import socket
 from subprocess import Popen,PIPE
+import time
 
 class status:
     pending = 'PENDING'
@@ -13,6 +16,17 @@ class status:
     reserved = 'RESERVED' # not a slurm job state
     timeout = 'TIMEOUT'
     cancelled = 'CANCELLED'
+    out_of_memory = 'OUT_OF_MEMORY'
+    node_fail = 'NODE_FAIL'
+    preempted = 'PREEMPTED'
+
+# Terminal SLURM states of jobs that did not finish their work
+failed_states = (status.failed, status.timeout, status.cancelled,
+                 status.out_of_memory, status.node_fail, status.preempted)
+
+# States of jobs that are still in the queue
+live_states = (status.pending, status.configuring, status.running,
+               status.completing)
 
 def is_node(n):
     try:
@@ -22,11 +36,233 @@ def is_node(n):
 
     return True
 
+def _run(args):
+    p = Popen(args, shell=False, stdout=PIPE, stderr=PIPE,
+              encoding='utf8')
+    (output, err) = p.communicate()
+    return output.splitlines()
+
+def expand_array_jobid(str_jobid):
+    """Expand the task ranges of an array job ID.
+
+    Parameters
+    ----------
+    str_jobid : str
+        A job ID as reported by SLURM, e.g. 123, 123_4 or
+        123_[5-7,9%2].
+
+    Returns
+    -------
+    list
+        The job IDs of the individual tasks, or only the job ID
+        itself if it does not contain any task ranges.
+    """
+    m = re.match(r'^(\d+)_\[([^\]]*)\]$', str_jobid)
+    if m is None:
+        return [str_jobid]
+    jobid, ranges = m.groups()
+    ranges = ranges.split('%')[0]
+    task_ids = []
+    for r in ranges.split(','):
+        if '-' in r:
+            start, stop = r.split('-')
+            task_ids.extend(range(int(start), int(stop) + 1))
+        else:
+            task_ids.append(int(r))
+    return ['{0}_{1}'.format(jobid, i) for i in task_ids]
+
+def get_accounting_states(jobids):
+    """Get the state of jobs from the SLURM accounting database.
+
+    All jobs are fetched with a single `sacct` call. Tasks of array
+    jobs are reported individually, also when `sacct` reports a range
+    of tasks, e.g. for pending or cancelled arrays.
+
+    Parameters
+    ----------
+    jobids : iterable
+        Job IDs, on the form <job_id> or <job_id>_<task_id>. For
+        array jobs given as <job_id>, the states of all tasks are
+        returned.
+
+    Returns
+    -------
+    dict
+        Dictionary with job IDs as keys and dictionaries with the keys
+        `job_state` and `nodes` as values.
+    """
+    jobids = sorted(set(str(x) for x in jobids if x is not None))
+    jobs = {}
+    if len(jobids) == 0:
+        return jobs
+    for line in _run(['sacct', '--jobs', ','.join(jobids),
+                      '--allocations',
+                      '--format', 'JobID,State,NodeList',
+                      '--noheader', '--parsable2']):
+        str_jobid, job_status, nodes = line.strip().split('|')
+        job = {'job_state': job_status.split()[0],
+               'nodes': nodes if nodes not in ('', 'None assigned') \
+                       else None}
+        for task_jobid in expand_array_jobid(str_jobid):
+            jobs[task_jobid] = job
+    return jobs
+
+class job_snapshot:
+    """The state of a set of SLURM jobs at one point in time.
+
+    All jobs are fetched with a single `squeue` call, and the jobs
+    that are no longer in the queue with a single `sacct` call.
+    Array tasks are keyed on the form <job_id>_<task_id>.
+
+    Parameters
+    ----------
+    jobids : iterable
+        Job IDs to fetch the state for.
+    """
+
+    def __init__(self, jobids):
+        self.jobids = set(str(x) for x in jobids if x is not None)
+        self.jobs = {}
+        self.created = time.time()
+        if len(self.jobids) > 0:
+            self._load()
+
+    def _load(self):
+        jobids = ','.join(sorted(self.jobids))
+        for line in _run(['squeue', '--noheader', '--array',
+                          '--jobs', jobids,
+                          '--format', '%i|%T|%N']):
+            str_jobid, job_status, nodes = line.strip().split('|')
+            self.jobs[str_jobid] = {'job_state': job_status,
+                                    'nodes': nodes if nodes else None}
+
+        missing = [x for x in self.jobids if x not in self.jobs]
+        if len(missing) == 0:
+            return
+        for str_jobid, job in get_accounting_states(missing).items():
+            if str_jobid not in self.jobs:
+                self.jobs[str_jobid] = job
+
+    def age(self):
+        return time.time() - self.created
+
+    def covers(self, jobids):
+        return all(str(x) in self.jobids for x in jobids if x is not None)
+
+    def get(self, jobid):
+        """Get the state and nodes of a job, or None if the job is not
+        known to SLURM."""
+        return self.jobs.get(str(jobid))
+
+    def array_tasks(self, jobid):
+        """Get the state and nodes of all known tasks of an array job,
+        keyed by <job_id>_<task_id>."""
+        prefix = '{0}_'.format(jobid)
+        return {k: v for k, v in self.jobs.items() if k.startswith(prefix)}
+
+_snapshot = None
+
+def get_snapshot(jobids=(), ttl=10.0):
+    """Get a snapshot of the state of SLURM jobs.
+
+    The last snapshot is reused as long as it is younger than `ttl`
+    seconds and contains all the requested jobs, so repeated lookups
+    within a command do not have to contact SLURM again.
+
+    Parameters
+    ----------
+    jobids : iterable
+        Job IDs that should be in the snapshot.
+    ttl : float
+        Maximum age of a reused snapshot in seconds.
+
+    Returns
+    -------
+    job_snapshot
+        A snapshot containing at least the requested jobs.
+    """
+    global _snapshot
+    jobids = [str(x) for x in jobids if x is not None]
+    if _snapshot is None or _snapshot.age() > ttl \
+            or not _snapshot.covers(jobids):
+        if _snapshot is not None and _snapshot.age() <= ttl:
+            jobids.extend(_snapshot.jobids)
+        _snapshot = job_snapshot(jobids)
+    return _snapshot
+
+def clear_snapshot():
+    """Make the next lookup fetch the job states from SLURM again."""
+    global _snapshot
+    _snapshot = None
+
 def get_job_node(jobid):
+    job = get_snapshot([jobid]).get(jobid)
+    if job is None:
+        raise ValueError('job {0} not found'.format(jobid))
+    return job['nodes']
+
+def get_max_array_size(default=1001):
+    """Get the MaxArraySize of the cluster.
+
+    Array task IDs must be smaller than this value.
+
+    Parameters
+    ----------
+    default : int
+        Value to use if it can not be read from the SLURM config.
+
+    Returns
+    -------
+    int
+        The maximum array size.
+    """
     try:
-        return pyslurm.job().find_id(str(jobid))[0]['nodes']
-    except ValueError:
-        raise
+        lines = _run(['scontrol', 'show', 'config'])
+    except OSError:
+        return default
+    for line in lines:
+        m = re.match(r'^\s*MaxArraySize\s*=\s*(\d+)', line)
+        if m is not None:
+            return int(m.group(1))
+    return default
+
+def parse_timelimit(timelimit):
+    """Convert a SLURM time limit to seconds.
+
+    Parameters
+    ----------
+    timelimit : str
+        Time limit in one of the formats accepted by SLURM, i.e.
+        "minutes", "minutes:seconds", "hours:minutes:seconds",
+        "days-hours", "days-hours:minutes" or
+        "days-hours:minutes:seconds".
+
+    Returns
+    -------
+    int
+        The time limit in seconds, or None if there is no limit.
+    """
+    if timelimit is None or str(timelimit).lower() in ('', 'unlimited',
+                                                         'infinite'):
+        return None
+    days = 0
+    rest = str(timelimit)
+    if '-' in rest:
+        d, rest = rest.split('-', 1)
+        days = int(d)
+        # With days, the first field is hours
+        parts = [int(x) for x in rest.split(':')]
+        parts += [0] * (3 - len(parts))
+        hours, minutes, seconds = parts
+    else:
+        parts = [int(x) for x in rest.split(':')]
+        if len(parts) == 1:
+            hours, minutes, seconds = 0, parts[0], 0
+        elif len(parts) == 2:
+            hours, minutes, seconds = 0, parts[0], parts[1]
+        else:
+            hours, minutes, seconds = parts
+    return ((days * 24 + hours) * 60 + minutes) * 60 + seconds
 
 def get_node_ip(n):
     return socket.gethostbyname(n)
@@ -44,33 +280,114 @@ def get_job_status(jobid):
     Returns
     -------
     str
-        Job state associated with the job ID.
+        Job state associated with the job ID, or None if the job
+        is not known to SLURM.
     """
     global status
 
-
     if jobid is None:
         return status.notstarted
 
-    try:
-        jobs = pyslurm.job().find_id(str(jobid))
-        if len(jobs) > 1:
-            raise ValueError('job is an array job, but the id '
-                             'does not imply this')
-        return jobs[0]['job_state']
-    except ValueError:
-        p = Popen(['sacct', '-j', str(jobid),
-                   '--format', 'JobID,State',
-                   '--noheader', '--parsable2'],
-                  shell=False, stdout=PIPE, stderr=PIPE,
-                  encoding='utf8')
-        (output, err) = p.communicate()
-        for line in output.splitlines():
-            str_jobid, job_status = line.strip().split('|')
-            if str_jobid == str(jobid):
-                return job_status.split()[0]
+    job = get_snapshot([jobid]).get(jobid)
+    if job is None:
+        return None
+    return job['job_state']
+
+# Errors printed by sbatch when slurmctld is temporarily overloaded
+transient_sbatch_errors = ('Socket timed out',
+                           'Resource temporarily unavailable')
+
+async def sbatch_async(args, retries=5, backoff=1.0):
+    """Submit a job with sbatch.
+
+    Submissions that fail with one of `transient_sbatch_errors` are
+    retried, waiting `backoff` seconds before the first retry and
+    doubling the wait for every following retry.
+
+    Parameters
+    ----------
+    args : list of str
+        The sbatch command line, including `--parsable`.
+    retries : int
+        Maximum number of retries.
+    backoff : float
+        Seconds to wait before the first retry.
+
+    Returns
+    -------
+    int
+        The job ID of the submission.
+
+    Raises
+    ------
+    RuntimeError
+        If sbatch prints on stderr, and the error is not transient or
+        there are no retries left.
+    """
+    for attempt in range(retries + 1):
+        p = await asyncio.create_subprocess_exec(
+            *args, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE)
+        output, err = await p.communicate()
+        err = err.decode('utf-8')
+        if len(err.strip()) == 0:
+            return int(output.decode('utf-8').split(';')[0])
+        if attempt == retries \
+                or not any(e in err for e in transient_sbatch_errors):
+            raise RuntimeError(err)
+        await asyncio.sleep(backoff * 2 ** attempt)
+
+def sbatch(args, retries=5, backoff=1.0):
+    """Submit a job with sbatch and wait for the job ID.
+
+    See `sbatch_async` for a description of the parameters.
+    """
+    return asyncio.run(sbatch_async(args, retries, backoff))
+
+class sbatch_submitter:
+    """Submit several jobs concurrently.
+
+    Must be used from within a running event loop.
+
+    Parameters
+    ----------
+    max_concurrent : int
+        Maximum number of sbatch processes running at the same time.
+    retries : int
+        Maximum number of retries of each submission.
+    backoff : float
+        Seconds to wait before the first retry of a submission.
+    """
+
+    def __init__(self, max_concurrent=4, retries=5, backoff=1.0):
+        self.max_concurrent = max_concurrent
+        self.retries = retries
+        self.backoff = backoff
+        self._semaphore = None
+
+    async def _submit(self, args):
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrent)
+        async with self._semaphore:
+            return await sbatch_async(args, self.retries, self.backoff)
+
+    def submit(self, args):
+        """Queue a submission.
+
+        Parameters
+        ----------
+        args : list of str
+            The sbatch command line, including `--parsable`.
+
+        Returns
+        -------
+        asyncio.Task
+            A task whose result is the job ID of the submission.
+        """
+        return asyncio.ensure_future(self._submit(args))
 
 def cancel_jobs(jobids):
     args = ['scancel', *map(str, jobids)]
     p = Popen(args, shell=False, encoding='utf8')
     p.wait()
+    clear_snapshot()
@@ -1,9 +1,11 @@
 import os
+import stat
 import sys
 import tempfile
 import shutil
 
 import marvelous_jobs as mj
+from marvelous_jobs import slurm_utils
 
 testdir = os.path.join(tempfile.gettempdir(), 'marvelous_test')
 if os.path.isdir(testdir):
@@ -52,6 +54,30 @@ config = mj.marvelous_config(
         'timelimit': '10-00:00:00'
     }
 })
+config.save()
+
+def fake_slurm(bin_dir, **commands):
+    """Write fake SLURM commands into `bin_dir` and put it first in PATH.
+
+    Each keyword is the name of a command and its value the body of the
+    shell script. Calling it again with the same directory overwrites
+    the given commands.
+    """
+    if not os.path.isdir(bin_dir):
+        os.makedirs(bin_dir)
+    for name, body in commands.items():
+        filename = os.path.join(bin_dir, name)
+        with open(filename, 'w') as f:
+            f.write('#!/bin/sh\n' + body)
+        os.chmod(filename, os.stat(filename).st_mode | stat.S_IEXEC)
+    if os.environ['PATH'].split(':', 1)[0] != bin_dir:
+        os.environ['PATH'] = '{0}:{1}'.format(bin_dir, os.environ['PATH'])
+    slurm_utils.clear_snapshot()
+
+def restore_slurm():
+    """Remove the fake SLURM commands of `fake_slurm` from PATH."""
+    os.environ['PATH'] = os.environ['PATH'].split(':', 1)[1]
+    slurm_utils.clear_snapshot()
 
 def setup():
     global db, n_blocks, config, config_filename
@@ -0,0 +1,86 @@
+from nose.tools import assert_equals
+from nose.tools import assert_in
+from nose.tools import assert_true
+import os
+import stat
+import subprocess
+
+import marvelous_jobs as mj
+from marvelous_jobs.tests import testdir
+
+run_dir = os.path.join(testdir, 'block_array')
+
+def get_stats_job(blocks_per_task, cores=None):
+    if not os.path.isdir(run_dir):
+        os.mkdir(run_dir)
+    return mj.stats_job_array(list(range(1, 6)), 'test',
+                              os.path.join(run_dir, '{}.{}.stats.txt'),
+                              max_simultaneous_tasks=2,
+                              script_directory=run_dir,
+                              log_directory=run_dir,
+                              reservation_token='token',
+                              run_directory=run_dir,
+                              blocks_per_task=blocks_per_task,
+                              cores=cores)
+
+def run_task(job, task_id, blocks,
+             lastats='[ "$2" = "test.3.las" ] && exit 1\n'):
+    """Run one array task with a fake LAstats that by default fails for
+    block 3."""
+    with open(os.path.join(run_dir, 'LAstats'), 'w') as f:
+        f.write('#!/bin/sh\n' + lastats + 'echo "stats for $2"\n')
+    os.chmod(os.path.join(run_dir, 'LAstats'),
+             stat.S_IRWXU | stat.S_IRGRP | stat.S_IROTH)
+    with open(os.path.join(run_dir, 'stats_task_token_{}.txt'
+                           .format(task_id)), 'w') as f:
+        for b in blocks:
+            f.write('{}\n'.format(b))
+    job.save_script()
+    env = dict(os.environ,
+               PATH='{}:{}'.format(run_dir, os.environ['PATH']),
+               SLURM_ARRAY_TASK_ID=str(task_id))
+    p = subprocess.run(['bash', job.filename, 'token'], env=env,
+                       stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                       encoding='utf8')
+    return p.returncode, p.stdout
+
+def test_array_indices():
+    assert_equals(get_stats_job(1).array_indices, '1-5%2')
+    assert_equals(get_stats_job(2).array_indices, '1-3%2')
+    assert_equals(get_stats_job(5).array_indices, '1-1%2')
+    assert_equals(get_stats_job(1).sbatch_args['cores'], 1)
+    assert_equals(get_stats_job(1, cores=4).sbatch_args['cores'], 4)
+
+def test_blocks_in_task():
+    for cores in (None, 2):
+        job = get_stats_job(3, cores)
+        returncode, output = run_task(job, 1, [1, 2, 3])
+        assert_equals(returncode, 1)
+        for b in (1, 2):
+            assert_in('Finished block {}'.format(b), output)
+            with open(os.path.join(run_dir, 'test.{}.stats.txt'
+                                   .format(b))) as f:
+                assert_equals(f.read(), 'stats for test.{}.las\n'.format(b))
+        assert_in('Failed block 3', output)
+
+        returncode, output = run_task(job, 2, [4, 5])
+        assert_equals(returncode, 0)
+        assert_true('Failed' not in output)
+        assert_equals(output.count('Finished block'), 2)
+
+def test_slow_block():
+    # The other blocks use the free core while block 1 is running
+    job = get_stats_job(5, 2)
+    returncode, output = run_task(
+        job, 1, [1, 2, 3, 4, 5],
+        lastats='[ "$2" = "test.1.las" ] && sleep 6\n'
+                '[ "$2" = "test.3.las" ] && exit 1\n')
+    assert_equals(returncode, 1)
+    finished = [line.split()[-1] for line in output.splitlines()
+                if 'Finished block' in line or 'Failed block' in line]
+    assert_equals(finished, ['2', '3', '4', '5', '1'])
+
+def test_bash_42():
+    # wait -n needs bash 4.3, and the nodes may run bash 4.2
+    script = str(get_stats_job(2, 2))
+    assert_true('wait -n' not in script)
@@ -0,0 +1,113 @@
+from nose.tools import assert_equals
+from nose.tools import assert_false
+from nose.tools import assert_true
+from nose.tools import with_setup
+import os
+import re
+import shutil
+
+import marvelous_jobs as mj
+from marvelous_jobs import slurm_utils
+from marvelous_jobs.tests import fake_slurm, restore_slurm, testdir
+
+run_dir = os.path.join(testdir, 'block_stage')
+db_filename = os.path.join(run_dir, 'marveldb')
+log_filename = os.path.join(run_dir, 'las_merge_token_%a_%A_%a.log')
+
+squeue_output = '''42_1|RUNNING|node1
+42_2|PENDING|
+'''
+
+sacct_output = '''42_3|COMPLETED|node3
+'''
+
+def setup_project():
+    global db
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    os.mkdir(run_dir)
+    db = mj.marvel_db(db_filename, 'stagetest', 20)
+    db.add_blocks((i, 'stagetest.{0}'.format(i)) for i in range(1, 6))
+
+    fake_slurm(run_dir,
+               squeue="cat << 'EOF'\n{0}EOF\n".format(squeue_output),
+               sacct="cat << 'EOF'\n{0}EOF\n".format(sacct_output))
+
+def teardown_project():
+    restore_slurm()
+    db._db.close()
+
+def get_statuses(stage):
+    db._c.execute('SELECT block_id, status FROM block_stage WHERE stage = ?',
+                  (stage,))
+    return dict(db._c.fetchall())
+
+@with_setup(setup_project, teardown_project)
+def test_reserve_block_stage():
+    blocks = [5, 4, 3, 2, 1]
+    assert_equals(db.reserve_block_stage('merge', blocks, 't1', 3),
+                  [5, 4, 3])
+    assert_equals(db.reserve_block_stage('merge', blocks, 't2', 3), [2, 1])
+    assert_equals(db.reserve_block_stage('merge', blocks, 't3'), [])
+    # Stages are independent of each other
+    assert_equals(db.reserve_block_stage('stats', blocks, 't4', 1), [5])
+
+    db.release_block_stage('merge', 't2')
+    db.set_block_stage_statuses('merge', {
+        5: slurm_utils.status.completed,
+        4: slurm_utils.status.failed})
+    assert_equals(db.get_block_stage('merge'), [5])
+    assert_equals(db.reserve_block_stage('merge', blocks, 't5'), [4, 2, 1])
+    assert_equals(db.reserve_block_stage('merge', blocks, 't6', force=True),
+                  [5])
+    assert_equals(set(get_statuses('merge').values()),
+                  set([slurm_utils.status.reserved]))
+
+@with_setup(setup_project, teardown_project)
+def test_update_block_stages():
+    db.reserve_block_stage('merge', [1, 2, 3, 4, 5], 'token')
+    # Task 1 has finished block 1 and failed block 2, task 2 is still
+    # queued, task 3 left the queue without finishing block 4.
+    db.set_block_stage_tasks('merge', [
+        (1, 'token', 42, 1, log_filename),
+        (2, 'token', 42, 1, log_filename),
+        (3, 'token', 42, 2, log_filename),
+        (4, 'token', 42, 3, log_filename)])
+    with open(log_filename.replace('%A', '42').replace('%a', '1'), 'w') as f:
+        f.write('Using reservation in merge_task_token_1.txt\n'
+                '[2020-01-01 10:00:00] Finished block 1\n'
+                '[2020-01-01 10:00:01] Failed block 2\n')
+
+    db.update_block_stages()
+    assert_equals(get_statuses('merge'), {
+        1: slurm_utils.status.completed,
+        2: slurm_utils.status.failed,
+        3: slurm_utils.status.pending,
+        4: slurm_utils.status.failed,
+        5: slurm_utils.status.reserved})
+    assert_equals(db.get_block_stage('merge'), [1])
+    assert_equals(db.block_stage_counts()['merge'], {
+        slurm_utils.status.completed: 1,
+        slurm_utils.status.failed: 2,
+        slurm_utils.status.pending: 1,
+        slurm_utils.status.reserved: 1})
+
+@with_setup(setup_project, teardown_project)
+def test_block_stage_query_plans():
+    statements = []
+    db._db.set_trace_callback(statements.append)
+    try:
+        db.get_block_stage('merge')
+        db.reserve_block_stage('merge', [1, 2], 'token')
+    finally:
+        db._db.set_trace_callback(None)
+
+    statements = [x for x in statements
+                  if re.match(r'\s*SELECT', x, re.I) and 'block_stage' in x]
+    assert_true(len(statements) > 0)
+    for statement in statements:
+        plan = [x[-1] for x in
+                db._c.execute('EXPLAIN QUERY PLAN {0}'.format(statement))]
+        assert_false(any(re.match(r'^SCAN (TABLE )?block_stage\b', x)
+                         for x in plan),
+                     'full table scan in "{0}": {1}'.format(statement, plan))
@@ -0,0 +1,77 @@
+from nose.tools import assert_equals
+from nose.tools import assert_false
+from nose.tools import assert_is
+from nose.tools import assert_is_not
+from nose.tools import assert_true
+import os
+
+import marvelous_jobs as mj
+from marvelous_jobs.config import save_configs
+from marvelous_jobs.tests import testdir
+
+config_dir = os.path.join(testdir, 'config')
+
+def get_filename(name):
+    if not os.path.isdir(config_dir):
+        os.mkdir(config_dir)
+    filename = os.path.join(config_dir, name)
+    if os.path.isfile(filename):
+        os.remove(filename)
+    return filename
+
+def test_dirty_tracking():
+    filename = get_filename('dirty.ini')
+    config = mj.marvelous_config(filename, {'general': {'name': 'test'}})
+    assert_true(config.dirty)
+    assert_false(os.path.isfile(filename))
+
+    config.save()
+    assert_false(config.dirty)
+    assert_true(os.path.isfile(filename))
+
+    config.update('general', 'name', 'test')
+    assert_false(config.dirty)
+    config.set('general', 'blocksize', 20)
+    assert_true(config.dirty)
+    assert_equals(config.getint('general', 'blocksize'), 20)
+
+    config.save()
+    assert_equals(mj.marvelous_config(filename).getint('general',
+                                                       'blocksize'), 20)
+
+def test_save_merges_changes():
+    filename = get_filename('merge.ini')
+    mj.marvelous_config(filename, {'general': {'name': 'test'}}).save()
+
+    config1 = mj.marvelous_config(filename)
+    config2 = mj.marvelous_config(filename)
+    config1.set('general', 'blocksize', 20)
+    config2.set('daligner', 'threads', 4)
+    config2.set('general', 'name', 'other')
+    config1.save()
+    config2.save()
+
+    config = mj.marvelous_config(filename)
+    assert_equals(config.get('general', 'name'), 'other')
+    assert_equals(config.getint('general', 'blocksize'), 20)
+    assert_equals(config.getint('daligner', 'threads'), 4)
+    assert_equals(config2.getint('general', 'blocksize'), 20)
+
+    leftovers = [f for f in os.listdir(config_dir) if f.endswith('.tmp')]
+    assert_equals(leftovers, [])
+
+def test_shared_config():
+    filename = get_filename('shared.ini')
+    config = mj.get_config(filename, {'general': {'name': 'test'}})
+    assert_is(mj.get_config(filename), config)
+    assert_is(mj.get_config(os.path.join(config_dir, '.', 'shared.ini')),
+              config)
+    assert_is_not(mj.marvelous_config(filename), config)
+
+    mj.get_config(filename, {'general': {'blocksize': 20}})
+    assert_equals(config.getint('general', 'blocksize'), 20)
+
+    save_configs()
+    assert_false(config.dirty)
+    assert_equals(mj.marvelous_config(filename).get('general', 'name'),
+                  'test')
@@ -0,0 +1,112 @@
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import with_setup
+import os
+import shutil
+
+import marvelous_jobs as mj
+from marvelous_jobs import __main__ as cli
+from marvelous_jobs import slurm_utils
+from marvelous_jobs.tests import fake_slurm, restore_slurm, testdir
+
+run_dir = os.path.join(testdir, 'daemon')
+bin_dir = os.path.join(run_dir, 'bin')
+sbatch_log = os.path.join(run_dir, 'sbatch.log')
+n_blocks = 4
+
+def setup_project():
+    global cwd
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    os.mkdir(run_dir)
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+
+    cli.init('daemontest', 20, account='test', n_jobs=4)
+    for d in ('bin', 'scripts', 'logs', 'daligner_runs'):
+        os.mkdir(d)
+    cli.mc().set_dict({
+        'general': {'script_directory': os.path.join(run_dir, 'scripts'),
+                    'log_directory': os.path.join(run_dir, 'logs')},
+        'daligner': {'jobs_per_task': 2,
+                     'comparisons_per_job': 1,
+                     'max_simultaneous_tasks': None,
+                     'repeats': None,
+                     'pull': False,
+                     'run_directory': os.path.join(run_dir,
+                                                   'daligner_runs')}})
+    db = mj.marvel_db.from_file('marveldb')
+    db.add_blocks((i, 'daemontest.{0}'.format(i))
+                  for i in range(1, n_blocks + 1))
+    db.add_daligner_job_matrix(n_blocks, use_masking_server=False)
+    db._db.close()
+
+    # The jobs are submitted, but never seen by squeue or sacct
+    commands = {
+        'sbatch': 'echo "$@" >> {0}\necho 101\n'.format(sbatch_log),
+        'squeue': '',
+        'sacct': ''}
+    fake_slurm(bin_dir, **commands)
+
+def teardown_project():
+    cli.mc().save()
+    os.chdir(cwd)
+    restore_slurm()
+
+def n_submissions():
+    if not os.path.exists(sbatch_log):
+        return 0
+    with open(sbatch_log) as f:
+        return len(f.readlines())
+
+def test_next_poll_interval():
+    # Wake up when the queue has drained to the watermark
+    assert_equals(cli.next_poll_interval(60, 0.5, 100, 60, 900), 200)
+    assert_equals(cli.next_poll_interval(60, 0.5, 1000, 60, 900), 900)
+    assert_equals(cli.next_poll_interval(200, 0.5, -5, 60, 900), 60)
+    # Back off while nothing finishes
+    assert_equals(cli.next_poll_interval(60, 0, 100, 60, 900), 120)
+    assert_equals(cli.next_poll_interval(600, 0, 100, 60, 900), 900)
+
+@with_setup(setup_project, teardown_project)
+def test_daemon():
+    cli.daemon(max_iterations=1)
+    assert_equals(cli.mc().getint('daemon', 'low_watermark'), 2)
+    db = mj.marvel_db.from_file('marveldb')
+    assert_equals(db.n_daligner_jobs(slurm_utils.status.reserved), 8)
+    assert_equals(cli.get_queued_daligner_tasks(db), 4)
+    assert_equals(n_submissions(), 1)
+
+    # The queue is above the low watermark
+    cli.daemon(max_iterations=1)
+    assert_equals(n_submissions(), 1)
+
+    # Once it drops below, the queue is filled up again
+    cli.mc().set('general', 'max_number_of_jobs', 6)
+    cli.daemon(low_watermark=5, max_iterations=1)
+    assert_equals(n_submissions(), 2)
+    assert_equals(db.n_daligner_jobs(slurm_utils.status.notstarted), 0)
+
+@with_setup(setup_project, teardown_project)
+def test_partial_submission():
+    # One task per array, and the array of the second task fails
+    fake_slurm(bin_dir,
+               scontrol='echo "MaxArraySize = 2"\n',
+               sbatch='case "$*" in *-2_%a*)\n'
+                      '\techo "sbatch: error: Invalid account" >&2\n'
+                      '\texit 1;;\n'
+                      'esac\n'
+                      'echo "$@" >> {0}\n'
+                      'echo 101\n'.format(sbatch_log))
+    db = mj.marvel_db.from_file('marveldb')
+    with assert_raises(RuntimeError):
+        cli.queue_daligner_tasks(db, cli.mc(), n_tasks=3)
+    assert_equals(n_submissions(), 2)
+
+    # The jobs of the submitted arrays have a job ID, the others are
+    # released
+    reserved = db.get_daligner_jobs(status=slurm_utils.status.reserved)
+    assert_equals(len(reserved), 4)
+    assert_equals(set(db.get_daligner_jobids(reserved).values()),
+                  set(['101']))
+    assert_equals(db.n_daligner_jobs(slurm_utils.status.notstarted), 6)
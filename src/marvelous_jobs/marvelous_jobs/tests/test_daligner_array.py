@@ -3,6 +3,7 @@ from nose.tools import assert_true
 from nose.tools import assert_false
 from nose.tools import assert_count_equal
 import os
+import re
 import time
 
 import marvelous_jobs as mj
@@ -13,9 +14,13 @@ def test_array_script():
                                 config.get('general', 'database'),
                                 config.get('general', 'script_directory'),
                                 reservation_token='test-token')
-    assert_equals(job.filename,
+    assert_equals(job.script_name,
                   os.path.join(config.get('general', 'script_directory'),
                                'daligner_array.sh'))
+    assert_equals(os.path.dirname(job.filename),
+                  config.get('general', 'script_directory'))
+    assert_true(re.match(r'^daligner_array\.[0-9a-f]{12}\.sh$',
+                         os.path.basename(job.filename)))
     assert_false(os.path.isfile(job.filename))
     job.save_script()
     assert_true(os.path.isfile(job.filename))
@@ -97,3 +102,26 @@ def test_file_creation():
 
     os.remove(job2.filename)
     assert_false(os.path.exists(job1.filename))
+
+def test_content_addressed_scripts():
+    script_directory = config.get('general', 'script_directory')
+    jobs = [mj.daligner_job_array(10, config.get('general', 'database'),
+                                  script_directory,
+                                  reservation_token='test-token',
+                                  threads=threads)
+            for threads in (4, 4, 8)]
+    filenames = [job.save_script() for job in jobs]
+    assert_equals(filenames, [job.filename for job in jobs])
+    assert_equals(filenames[0], filenames[1])
+    assert_true(filenames[0] != filenames[2])
+    assert_true(all(os.path.isfile(f) for f in filenames))
+    with open(filenames[2]) as f:
+        assert_equals(f.read(), str(jobs[2]))
+
+    # Settings that change after the job is created are picked up
+    jobs[1].sbatch_args['after'] = 42
+    assert_true(jobs[1].save_script() not in filenames)
+
+    assert_equals(mj.remove_scripts(os.path.join(script_directory,
+                                                 'daligner_array.sh')), 3)
+    assert_false(any(os.path.exists(f) for f in filenames))
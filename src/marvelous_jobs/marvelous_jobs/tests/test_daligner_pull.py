@@ -0,0 +1,151 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import with_setup
+import os
+import shutil
+import stat
+import subprocess
+import threading
+
+import marvel
+import marvelous_jobs as mj
+from marvelous_jobs import server
+from marvelous_jobs import slurm_utils
+from marvelous_jobs.tests import testdir
+
+run_dir = os.path.join(testdir, 'daligner_pull')
+db_filename = os.path.join(run_dir, 'marveldb')
+n_blocks = 4
+n_jobs = n_blocks + n_blocks * (n_blocks - 1) // 2
+
+def setup_project():
+    """Project with a fake daligner that takes a second and fails for
+    block 1 against itself."""
+    global path_bin
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    os.mkdir(run_dir)
+    db = mj.marvel_db(db_filename, 'pulltest', 20)
+    db.add_blocks((i, 'pulltest.{0}'.format(i))
+                  for i in range(1, n_blocks + 1))
+    db.add_daligner_job_matrix(n_blocks, use_masking_server=False)
+    mj.marvelous_config(os.path.join(run_dir, 'config.ini'),
+                        {'general': {'database': db_filename}}).save()
+
+    filename = os.path.join(run_dir, 'daligner')
+    with open(filename, 'w') as f:
+        f.write('#!/bin/sh\n'
+                'sleep 1\n'
+                'case "$*" in *"pulltest.1 pulltest.1") exit 1;; esac\n')
+    os.chmod(filename, stat.S_IRWXU | stat.S_IRGRP | stat.S_IROTH)
+    path_bin = marvel.config.PATH_BIN
+    marvel.config.PATH_BIN = run_dir
+
+def teardown_project():
+    marvel.config.PATH_BIN = path_bin
+
+def get_pull_job(**kwargs):
+    return mj.daligner_job_array(2, db_filename,
+                                 script_directory=run_dir,
+                                 log_directory=run_dir,
+                                 run_directory=run_dir,
+                                 reservation_token='token',
+                                 pull=True, **kwargs)
+
+def start_task(job, task_id):
+    env = dict(os.environ,
+               SLURM_ARRAY_JOB_ID='77',
+               SLURM_ARRAY_TASK_ID=str(task_id))
+    return subprocess.Popen(['bash', job.filename, 'token'], env=env,
+                            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                            encoding='utf8')
+
+def get_jobs():
+    db = mj.marvel_db.from_file(db_filename)
+    db._c.execute('''SELECT rowid, block_id1, block_id2, status, jobid,
+                     reservation_token FROM daligner_job''')
+    return [tuple(x) for x in db._c.fetchall()]
+
+def test_pull_script():
+    job = mj.daligner_job_array(2, db_filename, reservation_token='token',
+                                pull=True, timelimit='1:00:00')
+    assert_equals(job.script_name, 'daligner_pull_array.sh')
+    assert_equals(job.time_budget, 3240)
+    script = str(job)
+    assert_true('daligner claim' in script)
+    assert_true('daligner_task_' not in script)
+    # Empty arrays are unbound under set -u before bash 4.4
+    assert_true('"${completed[*]:-}"' in script)
+    assert_true('"${failed[*]:-}"' in script)
+
+def test_parse_timelimit():
+    assert_equals(slurm_utils.parse_timelimit('30'), 1800)
+    assert_equals(slurm_utils.parse_timelimit('30:15'), 1815)
+    assert_equals(slurm_utils.parse_timelimit('2:00:10'), 7210)
+    assert_equals(slurm_utils.parse_timelimit('1-00:00:00'), 86400)
+    assert_equals(slurm_utils.parse_timelimit('1-2'), 93600)
+    assert_equals(slurm_utils.parse_timelimit('1-2:30'), 95400)
+    assert_equals(slurm_utils.parse_timelimit('UNLIMITED'), None)
+
+@with_setup(setup_project, teardown_project)
+def test_pull_tasks():
+    job = get_pull_job()
+    job.save_script()
+    tasks = [start_task(job, i) for i in (1, 2)]
+    outputs = []
+    for p in tasks:
+        stdout, stderr = p.communicate()
+        assert_equals(p.returncode, 0, stderr)
+        outputs.append(stdout)
+
+    # Both tasks got work, and every job was run exactly once
+    started = [line.split('Starting job(s) ')[1].split(':')[0]
+               for output in outputs
+               for line in output.splitlines() if 'Starting job(s)' in line]
+    assert_true(all('Starting job(s)' in output for output in outputs))
+    assert_equals(sorted(int(x) for x in started), list(range(1, n_jobs + 1)))
+
+    for rowid, block1, block2, status, jobid, token in get_jobs():
+        if block1 == block2 == 1:
+            assert_equals(status, slurm_utils.status.failed)
+        else:
+            assert_equals(status, slurm_utils.status.completed)
+        assert_equals(jobid, '77')
+        assert_true(token in ('token_1', 'token_2'))
+
+@with_setup(setup_project, teardown_project)
+def test_pull_time_budget():
+    job = get_pull_job(jobs_per_claim=2, time_budget=0)
+    job.save_script()
+    p = start_task(job, 1)
+    stdout, stderr = p.communicate()
+    assert_equals(p.returncode, 0, stderr)
+    assert_true('Time budget used up' in stdout)
+
+    statuses = [x[3] for x in get_jobs()]
+    assert_equals(statuses.count(slurm_utils.status.notstarted), n_jobs - 2)
+    assert_equals(statuses.count(slurm_utils.status.running), 0)
+
+@with_setup(setup_project, teardown_project)
+def test_pull_through_coordinator():
+    coordinator = server.coordinator(db_filename, ('127.0.0.1', 0))
+    address_file = os.path.join(run_dir, server.address_filename)
+    coordinator.write_address(address_file)
+    thread = threading.Thread(target=coordinator.serve_forever)
+    thread.start()
+    try:
+        job = get_pull_job(jobs_per_claim=n_jobs, coordinator=address_file)
+        job.save_script()
+        with open(job.filename) as f:
+            assert_true('sqlite3' not in f.read())
+        p = start_task(job, 1)
+        stdout, stderr = p.communicate()
+    finally:
+        coordinator.shutdown()
+        thread.join()
+        coordinator.server_close()
+    assert_equals(p.returncode, 0, stderr)
+
+    statuses = [x[3] for x in get_jobs()]
+    assert_equals(statuses.count(slurm_utils.status.completed), n_jobs - 1)
+    assert_equals(statuses.count(slurm_utils.status.failed), 1)
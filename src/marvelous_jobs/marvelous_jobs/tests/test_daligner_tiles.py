@@ -0,0 +1,119 @@
+from nose.tools import assert_equals
+from nose.tools import assert_true
+from nose.tools import with_setup
+import os
+import shutil
+import stat
+import subprocess
+
+import marvel
+import marvelous_jobs as mj
+from marvelous_jobs import __main__ as cli
+from marvelous_jobs.tests import testdir
+
+run_dir = os.path.join(testdir, 'daligner_tiles')
+db_filename = os.path.join(run_dir, 'marveldb')
+daligner_log = os.path.join(run_dir, 'daligner.log')
+n_blocks = 4
+
+def setup_project():
+    """Project with a fake daligner that logs its arguments and fails
+    if the database of a block is missing."""
+    global path_bin
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    for d in (run_dir, os.path.join(run_dir, 'daligner_runs')):
+        os.mkdir(d)
+    db = mj.marvel_db(db_filename, 'tiletest', 20)
+    db.add_blocks((i, 'tiletest.{0}'.format(i))
+                  for i in range(1, n_blocks + 1))
+    db.add_daligner_job_matrix(n_blocks, use_masking_server=False)
+    for filename in ('tiletest.db', '.tiletest.idx', '.tiletest.bps'):
+        with open(os.path.join(run_dir, filename), 'w') as f:
+            f.write(filename)
+
+    filename = os.path.join(run_dir, 'daligner')
+    with open(filename, 'w') as f:
+        f.write('#!/bin/sh\n'
+                'echo "$@" >> {0}\n'
+                'for arg in "$@"; do\n'
+                '\tcase $arg in *tiletest.*)\n'
+                '\t\ttest -f "${{arg%.*}}.db" || exit 1;;\n'
+                '\tesac\n'
+                'done\n'.format(daligner_log))
+    os.chmod(filename, stat.S_IRWXU | stat.S_IRGRP | stat.S_IROTH)
+    path_bin = marvel.config.PATH_BIN
+    marvel.config.PATH_BIN = run_dir
+
+def teardown_project():
+    marvel.config.PATH_BIN = path_bin
+
+def get_config(tile_size=2):
+    return mj.marvelous_config(
+        filename=os.path.join(run_dir, 'config.ini'),
+        cdict={
+            'general': {
+                'account': 'test',
+                'database': db_filename,
+                'directory': run_dir,
+                'script_directory': run_dir,
+                'log_directory': run_dir
+            },
+            'daligner': {
+                'run_directory': os.path.join(run_dir, 'daligner_runs'),
+                'jobs_per_task': 100,
+                'comparisons_per_job': 2,
+                'max_simultaneous_tasks': None,
+                'repeats': None,
+                'verbose': True,
+                'identity': True,
+                'tuple_suppression_frequency': 20,
+                'correlation_rate': 0.7,
+                'threads': 4,
+                'timelimit': '1:00:00',
+                'tile_size': tile_size
+            },
+            'DMserver': {
+                'port': 12345
+            }
+        })
+
+def run_task(job, task_id):
+    env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task_id))
+    return subprocess.run(['bash', job.filename, job.reservation_token],
+                          cwd=run_dir, env=env, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, encoding='utf8')
+
+def get_daligner_calls():
+    """Get the blocks that daligner was called with."""
+    with open(daligner_log) as f:
+        calls = [[x for x in line.split() if 'tiletest.' in x]
+                 for line in f]
+    os.remove(daligner_log)
+    return calls
+
+@with_setup(setup_project, teardown_project)
+def test_tiles():
+    db = mj.marvel_db.from_file(db_filename)
+    job, n_jobs, rowids = cli.get_daligner_array(3, get_config(), db)
+    job.save_script()
+    assert_equals(n_jobs, 10)
+
+    reservation_filename = os.path.join(
+        run_dir, 'daligner_runs',
+        'daligner_task_{0}_2.txt'.format(job.reservation_token))
+    with open(reservation_filename) as f:
+        lines = [line.rstrip('\n').split('\t') for line in f]
+    assert_equals(len(lines), 2)
+
+    for task_id, calls in ((1, [['tiletest.1', 'tiletest.1',
+                                 'tiletest.2'],
+                                ['tiletest.2', 'tiletest.2']]),
+                           (2, [['tiletest.1', 'tiletest.3',
+                                 'tiletest.4'],
+                                ['tiletest.2', 'tiletest.3',
+                                 'tiletest.4']])):
+        task = run_task(job, task_id)
+        assert_equals(task.returncode, 0, task.stderr)
+        assert_true('Failed' not in task.stdout)
+        assert_equals(get_daligner_calls(), calls)
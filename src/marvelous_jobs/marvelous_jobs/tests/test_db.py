@@ -1,18 +1,23 @@
 from functools import reduce
 from nose.tools import assert_dict_equal
 from nose.tools import assert_equals
+from nose.tools import assert_false
 from nose.tools import assert_is_instance
 from nose.tools import assert_raises
 from nose.tools import assert_true
 from nose.tools import raises
 from nose.tools import with_setup
+import multiprocessing
 import os
+import re
 import sqlite3
 import subprocess
 import threading
+import time
 
 import marvelous_jobs as mj
 from marvelous_jobs.tests import config, db, n_blocks, n_daligner_jobs
+from marvelous_jobs.tests import testdir
 
 def set_dummy_jobs():
     query1 = '''UPDATE daligner_job
@@ -48,12 +53,133 @@ def set_two_blocks_completed():
 def test_completed_blocks_count():
     completed_blocks = db.get_completed_blocks()
     assert_equals(len(completed_blocks), 2)
+    assert_equals(completed_blocks, db.get_completed_blocks(recompute=True))
+
+def test_block_progress():
+    def check_progress():
+        assert_equals(db.get_block_progress(),
+                      db._count_completed_comparisons())
+        assert_equals(db.get_completed_blocks(),
+                      db.get_completed_blocks(recompute=True))
+
+    rowids = list(range(1, 1701))
+    db.set_daligner_statuses(
+        {rowid: mj.slurm_utils.status.completed for rowid in rowids})
+    check_progress()
+    assert_equals(len(db.get_completed_blocks()), 2)
+
+    db.set_daligner_statuses(
+        {rowid: mj.slurm_utils.status.failed for rowid in rowids[::3]})
+    check_progress()
+
+    db._c.execute('DELETE FROM block_progress')
+    db.recompute_block_progress()
+    check_progress()
+
+    reset_dummy_jobs()
+    assert_equals(db.get_block_progress(), {})
+    assert_equals(db.get_completed_blocks(), [])
+
+def test_journal_mode():
+    # New databases use a rollback journal, since the array tasks may
+    # open them from other nodes
+    filename = os.path.join(testdir, 'journal_db')
+    if os.path.exists(filename):
+        os.remove(filename)
+    new_db = mj.marvel_db(filename, 'test', 20)
+    new_db._c.execute('PRAGMA journal_mode')
+    assert_equals(new_db._c.fetchone()[0], 'delete')
+    # WAL is kept once it has been enabled
+    mj.marvel_db.from_file(filename, journal_mode='WAL')
+    other = mj.marvel_db.from_file(filename)
+    other._c.execute('PRAGMA journal_mode')
+    assert_equals(other._c.fetchone()[0], 'wal')
+
+def test_read_only_migration():
+    # A database from before the block_progress and block_stage tables
+    filename = os.path.join(testdir, 'old_db')
+    if os.path.exists(filename):
+        os.remove(filename)
+    old_db = mj.marvel_db(filename, 'test', 20)
+    old_db.add_blocks([(1, 'test.1')])
+    old_db.add_daligner_job_matrix(1, use_masking_server=False)
+    for table in ('block_progress', 'block_stage'):
+        old_db._c.execute('DROP TABLE {0}'.format(table))
+    old_db._c.execute('PRAGMA user_version = 0')
+    old_db._db.commit()
+    old_db._db.close()
+
+    ro_db = mj.marvel_db.from_file(filename, read_only=True)
+    assert_equals(ro_db.get_completed_blocks(), [])
+    assert_true(ro_db.block_stage_created)
+    assert_equals(mj.marvel_db._schema_version(filename),
+                  mj.marvel_db.schema_version)
+
+def test_daligner_job_matrix():
+    matrix_db = mj.marvel_db(os.path.join(testdir, 'matrix_db'), 'test', 20)
+    n = 20
+    matrix_db.add_blocks((i, 'test.{0}'.format(i)) for i in range(1, n + 1))
+    with assert_raises(RuntimeError):
+        matrix_db.add_blocks([(n + 1, 'test.new'), (1, 'test.1')])
+    assert_equals(matrix_db.get_n_blocks(), n)
+
+    progress = []
+    matrix_db.add_daligner_job_matrix(n, use_masking_server=False,
+                                      progress=lambda *x: progress.append(x))
+    assert_equals(progress[-1], (n + n * (n - 1) // 2,) * 2)
+
+    expected = [(i, i, 1) for i in range(1, n + 1)] + \
+        [(i, j, i + 1) for i in range(1, n + 1) for j in range(i + 1, n + 1)]
+    matrix_db._c.execute('''SELECT rowid, block_id1, block_id2, priority,
+                                use_masking
+                            FROM daligner_job ORDER BY rowid''')
+    jobs = [tuple(x) for x in matrix_db._c.fetchall()]
+    assert_equals([x[0] for x in jobs], list(range(1, len(expected) + 1)))
+    assert_equals([x[1:4] for x in jobs], expected)
+    assert_true(all(x[4] == 0 for x in jobs))
 
 def test_number_of_daligner_jobs():
     expected_number_of_jobs = n_blocks + n_blocks * (n_blocks - 1) / 2
     number_of_jobs = db.n_daligner_jobs()
     assert_equals(number_of_jobs, expected_number_of_jobs)
 
+@with_setup(None, reset_dummy_jobs)
+def test_daligner_status_counts():
+    notstarted = mj.slurm_utils.status.notstarted
+    completed = mj.slurm_utils.status.completed
+    assert_dict_equal(db.daligner_status_counts(),
+                      {notstarted: n_daligner_jobs})
+
+    db.set_daligner_statuses({rowid: completed for rowid in range(1, 11)})
+    assert_dict_equal(db.daligner_status_counts(),
+                      {notstarted: n_daligner_jobs - 10, completed: 10})
+
+    # Writes by another connection also invalidate the cached counts
+    other = sqlite3.connect(db.filename)
+    other.execute('''UPDATE daligner_job SET status = ?
+                     WHERE rowid <= 20''', (completed,))
+    other.commit()
+    other.close()
+    counts = db.daligner_status_counts()
+    assert_dict_equal(counts,
+                      {notstarted: n_daligner_jobs - 20, completed: 20})
+
+    info = db.info()
+    assert_equals(info['daligner jobs'], n_daligner_jobs)
+    assert_equals(info['daligner jobs finished'], 20)
+    assert_equals(info['daligner jobs not started'], n_daligner_jobs - 20)
+    assert_equals(info['daligner jobs failed'], 0)
+
+    # Jobs that failed in any way are counted as failed
+    db.set_daligner_statuses({1: mj.slurm_utils.status.timeout,
+                              2: mj.slurm_utils.status.out_of_memory,
+                              3: mj.slurm_utils.status.node_fail})
+    info = db.info()
+    assert_equals(info['daligner jobs failed'], 3)
+    assert_equals(sum(v for k, v in info.items()
+                      if k.startswith('daligner jobs ')),
+                  info['daligner jobs'])
+
 def test_rowid():
     db._c.execute('SELECT min(rowid), max(rowid) FROM daligner_job')
     min_rowid, max_rowid = db._c.fetchone()
@@ -67,8 +193,29 @@ def test_database_integrity():
 @with_setup(set_dummy_jobs, reset_dummy_jobs)
 def test_database_backup():
     backup_filename = '{0}.backup'.format(config.get('general', 'database'))
-    db.backup(backup_filename)
+    progress = []
+    assert_true(db.backup(backup_filename,
+                          progress=lambda *x: progress.append(x)))
     assert_true(os.path.isfile(backup_filename))
+    assert_equals(progress[-1][1], 0)
+
+    backup_db = sqlite3.connect(backup_filename)
+    backup_db.execute('PRAGMA quick_check')
+    n_jobs = backup_db.execute('SELECT COUNT(*) FROM daligner_job') \
+        .fetchone()[0]
+    backup_db.close()
+    assert_equals(n_jobs, db.n_daligner_jobs())
+
+    # Nothing changed since the last backup
+    assert_false(db.backup(backup_filename, min_interval=0))
+    assert_true(db.integrity_check(quick=True))
+
+    # Recent enough, even though the database changed
+    db.set_daligner_statuses({1: mj.slurm_utils.status.failed})
+    backup_time = time.time() - 60
+    os.utime(backup_filename, (backup_time, backup_time))
+    assert_false(db.backup(backup_filename, min_interval=3600))
+    assert_true(db.backup(backup_filename, min_interval=0))
 
 @with_setup(set_dummy_jobs, reset_dummy_jobs)
 def test_getting_daligner_jobs():
@@ -97,6 +244,60 @@ def test_update_daligner_jobs():
     jobs = db.get_daligner_jobs(status=mj.slurm_utils.status.completed)
     assert_equals(len(jobs), 100)
 
+def get_statuses(rowids):
+    db._c.execute('SELECT rowid, status FROM daligner_job WHERE rowid IN ({0})' \
+                  .format(','.join('?' for x in rowids)), tuple(rowids))
+    return {x[0]: x[1] for x in db._c.fetchall()}
+
+@with_setup(None, reset_dummy_jobs)
+def test_update_daligner_jobs_incremental():
+    jobs = db.reserve_daligner_jobs(token='log-token_1', max_jobs=3)
+    rowids = [x for j in jobs for x in j['rowids']]
+    log_directory = config.get('general', 'log_directory')
+    logfile = os.path.join(log_directory,
+                           'daligner_array_log-token_1_1000_1.log')
+
+    with open(logfile, 'w') as f:
+        f.write('Starting job(s) {0}: 1 vs 1\n'.format(rowids[0]))
+        f.write('Finished job(s) {0}: 1 vs 1\n'.format(rowids[0]))
+        f.write('Starting job(s) {0}: 2 vs 2\n'.format(rowids[1]))
+        f.write('slurmstepd: error: *** JOB 1000 ON x')
+    db.update_daligner_jobs(rowids, log_directory)
+    assert_dict_equal(get_statuses(rowids),
+                      {rowids[0]: mj.slurm_utils.status.completed,
+                       rowids[1]: mj.slurm_utils.status.running,
+                       rowids[2]: mj.slurm_utils.status.reserved})
+
+    # The incomplete line is parsed once it has been completed, and the
+    # SLURM failure is attributed to the job that was started before
+    # the previous update.
+    with open(logfile, 'a') as f:
+        f.write(' CANCELLED DUE TO TIME LIMIT ***\n')
+    db.update_daligner_jobs(rowids, log_directory)
+    assert_dict_equal(get_statuses(rowids),
+                      {rowids[0]: mj.slurm_utils.status.completed,
+                       rowids[1]: mj.slurm_utils.status.failed,
+                       rowids[2]: mj.slurm_utils.status.reserved})
+
+    db._c.execute('SELECT offset, status FROM daligner_log '
+                  'WHERE filename = ?', (os.path.basename(logfile),))
+    offset, log_status = db._c.fetchone()
+    assert_equals(offset, os.path.getsize(logfile))
+    assert_equals(log_status, mj.slurm_utils.status.failed)
+
+    os.remove(logfile)
+
+@with_setup(set_dummy_jobs, reset_dummy_jobs)
+def test_set_daligner_statuses():
+    statuses = {ri: mj.slurm_utils.status.completed for ri in range(1, 151)}
+    statuses[1000] = mj.slurm_utils.status.failed
+    # The first 100 jobs are already completed.
+    assert_equals(db.set_daligner_statuses(statuses), 51)
+    assert_equals(db.set_daligner_statuses(statuses), 0)
+    assert_equals(get_statuses([150, 1000]),
+                  {150: mj.slurm_utils.status.completed,
+                   1000: mj.slurm_utils.status.failed})
+
 @with_setup(set_dummy_jobs, reset_dummy_jobs)
 def test_daligner_jobids():
     jobs = db.get_daligner_jobs(5, status=mj.slurm_utils.status.running)
@@ -149,6 +350,69 @@ def test_reserving_multiblocks():
     # And then it should again be full jobs.
     assert_equals(len(jobs[n_full_jobs+1]['target_blocks']), 16)
 
+def test_grouping_daligner_jobs():
+    # Three blocks, ordered by priority as in the database.
+    jobs = [(1, 1, 1), (2, 2, 2), (3, 3, 3), (4, 1, 2), (5, 1, 3), (6, 2, 3)]
+    groups = mj.marvel_db._group_daligner_jobs(jobs, 10, 16)
+    assert_equals([x['rowids'] for x in groups], [[1, 4, 5], [2, 6], [3]])
+    assert_equals([x['source_block'] for x in groups], [1, 2, 3])
+    assert_equals([x['target_blocks'] for x in groups],
+                  [[1, 2, 3], [2, 3], [3]])
+
+    groups = mj.marvel_db._group_daligner_jobs(jobs, 10, 2)
+    assert_equals([x['rowids'] for x in groups],
+                  [[1], [2], [3], [4, 5], [6]])
+    groups = mj.marvel_db._group_daligner_jobs(jobs, 2, 2)
+    assert_equals([x['rowids'] for x in groups], [[1], [2]])
+
+@with_setup(None, reset_dummy_jobs)
+def test_reserving_tasks():
+    tokens = ['task-token_1', 'task-token_2', 'task-token_3']
+    tasks = db.reserve_daligner_tasks(tokens, jobs_per_task=200,
+                                      comparisons_per_job=16)
+    assert_equals(len(tasks), 3)
+    assert_true(all(len(x) == 200 for x in tasks))
+
+    # The diagonal comes first, followed by the first column.
+    assert_true(all(len(x['rowids']) == 1 for x in tasks[0] + tasks[1]))
+    assert_true(all(len(x['rowids']) == 1 for x in tasks[2][:100]))
+    assert_equals(tasks[2][100]['source_block'], 1)
+    assert_equals(len(tasks[2][100]['rowids']), 16)
+
+    all_rowids = [ri for t in tasks for x in t for ri in x['rowids']]
+    assert_equals(len(set(all_rowids)), len(all_rowids))
+    reserved_jobs = db.get_daligner_jobs(status=mj.slurm_utils.status.reserved)
+    assert_equals(len(reserved_jobs), len(all_rowids))
+
+    for token, task in zip(tokens, tasks):
+        rowids = [ri for x in task for ri in x['rowids']]
+        assert_equals(set(db.get_daligner_tokens(rowids).values()), {token})
+
+@with_setup(None, reset_dummy_jobs)
+def test_reserving_tiles():
+    n_tiles = (n_blocks + 7) // 8 * ((n_blocks + 7) // 8 + 1) // 2
+    assert_equals(db.n_daligner_tiles(8), n_tiles)
+
+    tokens = ['tile-token_1', 'tile-token_2', 'tile-token_3']
+    tasks = db.reserve_daligner_tasks(tokens, comparisons_per_job=4,
+                                      tile_size=8)
+    assert_equals(len(tasks), 3)
+
+    # The tiles of the first 8 source blocks come first, starting
+    # with the one on the diagonal.
+    blocks = [set(x['source_block'] for x in t) |
+              set(b for x in t for b in x['target_blocks']) for t in tasks]
+    assert_equals(blocks, [set(range(1, 9)),
+                           set(range(1, 17)),
+                           set(range(1, 9)) | set(range(17, 25))])
+    assert_equals([sum(len(x['rowids']) for x in t) for t in tasks],
+                  [36, 64, 64])
+    assert_true(all(len(x['target_blocks']) <= 4 for t in tasks for x in t))
+
+    reserved_jobs = db.get_daligner_jobs(status=mj.slurm_utils.status.reserved)
+    assert_equals(len(reserved_jobs), 164)
+    assert_equals(db.n_daligner_tiles(8), n_tiles - 3)
+
 @with_setup(set_dummy_jobs, reset_dummy_jobs)
 def test_reserving_jobs_in_parallel():
     class dbworker(threading.Thread):
@@ -218,3 +482,133 @@ def test_exclusive():
 
     assert_true(len(rowids1), len(rowids2))
     assert_true(len(set(rowids1 + rowids2)), len(rowids1) + len(rowids2))
+
+def get_wal_db():
+    """Create a database in WAL mode."""
+    filename = os.path.join(testdir, 'wal_db')
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(filename + suffix):
+            os.remove(filename + suffix)
+    wal_db = mj.marvel_db(filename, 'test', 20, journal_mode='WAL')
+    wal_db.add_blocks((i, 'test.{0}'.format(i)) for i in range(1, 51))
+    wal_db.add_daligner_job_matrix(50, use_masking_server=False)
+    return wal_db
+
+def test_exclusive_wal():
+    wal_db = get_wal_db()
+    db1 = sqlite3.connect(wal_db.filename, timeout=0)
+    c1 = db1.cursor()
+    db2 = sqlite3.connect(wal_db.filename, timeout=0)
+    c2 = db2.cursor()
+
+    select_query = '''SELECT rowid FROM daligner_job
+        WHERE status = "NOTSTARTED" LIMIT 10'''
+
+    # In WAL mode, readers are not blocked by the exclusive lock, but
+    # they do not see uncommitted changes and cannot start writing.
+    c1.execute('BEGIN EXCLUSIVE');
+    c1.execute(select_query)
+    rowids1 = [x[0] for x in c1.fetchall()]
+    c2.execute(select_query)
+    assert_equals([x[0] for x in c2.fetchall()], rowids1)
+    c1.execute('UPDATE daligner_job SET status = "RESERVED" WHERE rowid IN({0})' \
+              .format(','.join('?' for x in rowids1)), tuple(rowids1))
+    c2.execute(select_query)
+    assert_equals([x[0] for x in c2.fetchall()], rowids1)
+    with assert_raises(sqlite3.OperationalError) as oe:
+        c2.execute('BEGIN EXCLUSIVE')
+    db1.commit()
+    c2.execute(select_query)
+    rowids2 = [x[0] for x in c2.fetchall()]
+
+    assert_equals(len(rowids1), len(rowids2))
+    assert_equals(len(set(rowids1 + rowids2)), len(rowids1) + len(rowids2))
+
+@with_setup(set_dummy_jobs, reset_dummy_jobs)
+def test_daligner_query_plans():
+    statements = []
+    db._db.set_trace_callback(statements.append)
+    try:
+        db.get_daligner_jobs(5, status=mj.slurm_utils.status.notstarted)
+        db.get_daligner_jobs(status=(mj.slurm_utils.status.running,
+                                     mj.slurm_utils.status.reserved))
+        db.n_daligner_jobs(mj.slurm_utils.status.running)
+        db.n_daligner_jobs(mj.slurm_utils.status.running,
+                           mj.slurm_utils.status.pending)
+        db.get_n_running_tasks()
+        db.get_completed_blocks()
+        db.n_daligner_tiles(8)
+        db._select_daligner_tiles(2, 8)
+        db.cancel_daligner_reservation()
+    finally:
+        db._db.set_trace_callback(None)
+
+    scan_regex = re.compile(r'^SCAN (TABLE )?daligner_job\b')
+    statements = [x for x in statements
+                  if re.match(r'\s*(SELECT|UPDATE|DELETE)', x, re.I) \
+                  and 'daligner_job' in x]
+    assert_true(len(statements) > 0)
+    for statement in statements:
+        plan = [x[-1] for x in
+                db._c.execute('EXPLAIN QUERY PLAN {0}'.format(statement))]
+        assert_false(any(scan_regex.match(x) for x in plan),
+                     'full table scan in "{0}": {1}'.format(statement, plan))
+
+def read_database(filename, duration):
+    reader_db = mj.marvel_db.from_file(filename, read_only=True)
+    n_reads = 0
+    end = time.time() + duration
+    while time.time() < end:
+        reader_db.n_daligner_jobs(mj.slurm_utils.status.reserved)
+        reader_db.get_daligner_jobs(10, status=mj.slurm_utils.status.notstarted)
+        n_reads += 1
+    return n_reads
+
+def test_concurrent_readers_and_writer():
+    n_readers = 8
+    filename = get_wal_db().filename
+    with multiprocessing.Pool(n_readers) as pool:
+        readers = [pool.apply_async(read_database, (filename, 2.0))
+                   for i in range(n_readers)]
+        writer_db = mj.marvel_db.from_file(filename)
+        writer_db._db.execute('PRAGMA busy_timeout = 100')
+        n_writes = 0
+        while not all(x.ready() for x in readers):
+            writer_db.reserve_daligner_jobs(token='stress-token',
+                                            max_jobs=10)
+            writer_db.cancel_daligner_reservation()
+            n_writes += 1
+        # Raises any exception that happened in a reader.
+        n_reads = [x.get() for x in readers]
+
+    assert_true(n_writes > 0)
+    assert_true(all(x > 0 for x in n_reads))
+
+    reader_db = mj.marvel_db.from_file(filename, read_only=True)
+    reader_db._c.execute('PRAGMA journal_mode')
+    assert_equals(reader_db._c.fetchone()[0], 'wal')
+    with assert_raises(sqlite3.OperationalError) as oe:
+        reader_db.cancel_daligner_reservation()
+
+def test_node_ip_cache():
+    resolved = []
+    def get_node_ip(node):
+        resolved.append(node)
+        return '10.0.0.{0}'.format(len(resolved))
+
+    original_get_node_ip = mj.slurm_utils.get_node_ip
+    mj.slurm_utils.get_node_ip = get_node_ip
+    try:
+        assert_equals(db.get_node_ip('node1'), '10.0.0.1')
+        assert_equals(db.get_node_ip('node1'), '10.0.0.1')
+        assert_equals(db.get_node_ip('node2'), '10.0.0.2')
+        assert_equals(resolved, ['node1', 'node2'])
+
+        # Expired addresses are resolved again
+        assert_equals(db.get_node_ip('node1', max_age=0), '10.0.0.3')
+        assert_equals(db.get_node_ip('node1'), '10.0.0.3')
+        assert_equals(resolved, ['node1', 'node2', 'node1'])
+    finally:
+        mj.slurm_utils.get_node_ip = original_get_node_ip
+        db._c.execute('DELETE FROM node_ip')
+        db._db.commit()
@@ -0,0 +1,51 @@
+from nose.tools import assert_equals
+from nose.tools import assert_false
+from nose.tools import assert_is_none
+from nose.tools import assert_true
+from nose.tools import with_setup
+import os
+import shutil
+
+from marvelous_jobs import fs_utils
+from marvelous_jobs.tests import testdir
+
+scan_dir = os.path.join(testdir, 'fs_utils')
+
+def create_files():
+    if os.path.isdir(scan_dir):
+        shutil.rmtree(scan_dir)
+    for d in ('a', 'b', os.path.join('a', 'sub')):
+        os.makedirs(os.path.join(scan_dir, d))
+    for i in range(10):
+        for d in ('a', 'b'):
+            with open(os.path.join(scan_dir, d, 'f{0}.txt'.format(i)),
+                      'w') as f:
+                f.write('x' * i)
+
+@with_setup(create_files)
+def test_scan_directory():
+    stats = fs_utils.scan_directory(os.path.join(scan_dir, 'a'))
+    # Subdirectories are not included
+    assert_equals(sorted(stats), ['f{0}.txt'.format(i) for i in range(10)])
+    assert_equals(stats['f3.txt'].st_size, 3)
+
+    stats = fs_utils.scan_directory(os.path.join(scan_dir, 'a'),
+                                    match=lambda x: x.startswith('f1'))
+    assert_equals(list(stats), ['f1.txt'])
+    assert_equals(fs_utils.scan_directory(os.path.join(scan_dir, 'c')), {})
+
+@with_setup(create_files)
+def test_directory_snapshot():
+    for threads in (None, 4):
+        snapshot = fs_utils.directory_snapshot(
+            [os.path.join(scan_dir, d) for d in ('a', 'b', 'c')],
+            threads=threads)
+        assert_equals(snapshot.size(os.path.join(scan_dir, 'b', 'f7.txt')),
+                      7)
+        assert_true(snapshot.exists(os.path.join(scan_dir, 'a', 'f0.txt')))
+        assert_equals(snapshot.size(os.path.join(scan_dir, 'a', 'f0.txt')),
+                      0)
+        assert_false(snapshot.exists(os.path.join(scan_dir, 'a', 'sub')))
+        assert_false(snapshot.exists(os.path.join(scan_dir, 'c', 'f0.txt')))
+        # Files in directories that were not scanned are not known
+        assert_is_none(snapshot.stat(os.path.join(scan_dir, 'f0.txt')))
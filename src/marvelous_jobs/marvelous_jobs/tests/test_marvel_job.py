@@ -9,10 +9,10 @@ def test_marvel_job_single_line():
                                    'single_line_script.sh')
     job = mj.job.marvel_job(['executable', '-o', 'test_output'], 'testjob',
                             script_filename)
-    assert_equal(job.filename, script_filename)
-    assert_false(os.path.isfile(script_filename))
+    assert_equal(job.script_name, script_filename)
+    assert_false(os.path.isfile(job.filename))
     job.save_script()
-    assert_true(os.path.isfile(script_filename))
+    assert_true(os.path.isfile(job.filename))
     # Should have shebang, set statement, and the call to the executable
     assert_equal(len(str(job).splitlines()), 3)
 
@@ -23,7 +23,7 @@ def test_marvel_job_multiple_lines():
                              ['executable', '-o', 'test_output'],
                              ['postprocess', '--for-real']],
                             'multiline_test', script_filename)
-    assert_equal(job.filename, script_filename)
+    assert_equal(job.script_name, script_filename)
     assert_false(os.path.isfile(job.filename))
     job.save_script()
     assert_true(os.path.isfile(job.filename))
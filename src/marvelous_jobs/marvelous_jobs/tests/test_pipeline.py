@@ -0,0 +1,174 @@
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+import glob
+import os
+import shutil
+
+import marvelous_jobs as mj
+from marvelous_jobs import __main__ as cli
+from marvelous_jobs import slurm_utils
+from marvelous_jobs.tests import fake_slurm, restore_slurm, testdir
+
+run_dir = os.path.join(testdir, 'pipeline')
+bin_dir = os.path.join(run_dir, 'bin')
+sbatch_log = os.path.join(run_dir, 'sbatch.log')
+n_blocks = 3
+
+def setup_project():
+    global cwd
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    for d in (run_dir, bin_dir, os.path.join(run_dir, 'scripts'),
+              os.path.join(run_dir, 'logs')):
+        os.mkdir(d)
+
+    db = mj.marvel_db(os.path.join(run_dir, 'marveldb'), 'pipetest', 20)
+    db.add_blocks((i, 'pipetest.{0}'.format(i))
+                  for i in range(1, n_blocks + 1))
+    db.add_daligner_job_matrix(n_blocks, use_masking_server=False)
+    db._c.execute('UPDATE daligner_job SET status = ?',
+                  (slurm_utils.status.completed,))
+    db._db.commit()
+    db._db.close()
+    mj.get_config(os.path.join(run_dir, 'config.ini'), {
+        'general': {'name': 'pipetest',
+                    'directory': run_dir,
+                    'script_directory': os.path.join(run_dir, 'scripts'),
+                    'log_directory': os.path.join(run_dir, 'logs'),
+                    'account': 'test',
+                    'coverage': 20}}).save()
+
+    # sbatch logs its arguments and numbers the jobs from 101, the
+    # jobs are never seen by squeue or sacct.
+    counter = os.path.join(bin_dir, 'counter')
+    with open(counter, 'w') as f:
+        f.write('100\n')
+    commands = {
+        'sbatch': 'echo "$@" >> {0}\n'
+                  'n=$(($(cat {1}) + 1))\n'
+                  'echo $n > {1}\n'
+                  'echo $n\n'.format(sbatch_log, counter),
+        'squeue': '',
+        'sacct': ''}
+    fake_slurm(bin_dir, **commands)
+
+    cwd = os.getcwd()
+    os.chdir(run_dir)
+
+def teardown_project():
+    cli.mc().save()
+    os.chdir(cwd)
+    restore_slurm()
+
+def get_submissions():
+    """Get the job name and dependency of each submission."""
+    submissions = []
+    with open(sbatch_log) as f:
+        for line in f:
+            args = line.split()
+            dependency = args[args.index('--dependency') + 1] \
+                    if '--dependency' in args else None
+            submissions.append((args[args.index('-J') + 1], dependency))
+    return submissions
+
+@with_setup(setup_project, teardown_project)
+def test_pipeline_run():
+    # Each task waits only for the merge task of its own block
+    cli.pipeline_run({'merge': 2})
+    assert_equals(get_submissions(), [
+        ('las_merge', None),
+        ('annotation', 'aftercorr:101'),
+        ('annotate_repeats', 'aftercorr:101'),
+        ('stats', 'aftercorr:101')])
+
+    db = mj.marvel_db.from_file('marveldb')
+    assert_equals(db.get_block_stage_tasks('annotate'), {
+        1: (slurm_utils.status.pending, '102', 1),
+        2: (slurm_utils.status.pending, '102', 2)})
+
+    # The budget of the merge stage is saved, and once the last block
+    # has been submitted, TKmerge and patching can be queued as well.
+    cli.pipeline_run({'merge': 3})
+    submissions = get_submissions()[4:]
+    assert_equals(submissions[:4], [
+        ('las_merge', None),
+        ('annotation', 'aftercorr:105'),
+        ('annotate_repeats', 'aftercorr:105'),
+        ('stats', 'aftercorr:105')])
+    assert_equals(submissions[4],
+                  ('merge_annotations', 'afterok:102:103:106:107'))
+    # The blocks are patched in one array per merge array
+    assert_equals(submissions[5:], [
+        ('patching', 'aftercorr:101,afterok:109'),
+        ('patching', 'aftercorr:105,afterok:109')])
+    assert_equals(cli.mc().getint('pipeline', 'merge'), 3)
+
+    # Nothing is left to submit
+    cli.pipeline_run()
+    assert_equals(len(get_submissions()), 11)
+
+def test_shard_dependency():
+    dependencies = {1: ['101_2'], 2: ['101_1', '109'], 3: ['101_3'],
+                    4: ['102_1'], 5: []}
+    assert_equals(cli.group_dependent_blocks([3, 1, 2, 4, 5], dependencies),
+                  [[2, 1, 3], [4], [5]])
+    assert_equals(cli.get_shard_dependency([[2], [1], [3]], dependencies),
+                  'aftercorr:101,afterok:109')
+    # The tasks do not line up with the tasks of the input
+    assert_equals(cli.get_shard_dependency([[1], [3]], dependencies),
+                  'afterok:101_2:101_3')
+    assert_equals(cli.get_shard_dependency([[2, 1]], dependencies),
+                  'afterok:101_1:101_2:109')
+    assert_equals(cli.get_shard_dependency([[5]], dependencies), None)
+
+@with_setup(setup_project, teardown_project)
+def test_partial_submission():
+    # One block per array, and the array of the second block fails
+    fake_slurm(bin_dir,
+               scontrol='echo "MaxArraySize = 2"\n',
+               sbatch='case "$*" in *-2_%a*)\n'
+                      '\techo "sbatch: error: Invalid account" >&2\n'
+                      '\texit 1;;\n'
+                      'esac\n'
+                      'echo "$@" >> {0}\n'
+                      'echo $$\n'.format(sbatch_log))
+    with assert_raises(RuntimeError):
+        cli.merge_blocks(3, 1, blocks=[1, 2, 3])
+
+    # The blocks of the submitted arrays are recorded, the others are
+    # released
+    db = mj.marvel_db.from_file('marveldb')
+    tasks = db.get_block_stage_tasks('merge')
+    assert_equals(sorted(tasks), [1, 3])
+    assert_equals(set(status for status, _, _ in tasks.values()),
+                  set([slurm_utils.status.pending]))
+    assert_equals(len(get_submissions()), 2)
+
+    # Chained arrays after the failed one are not submitted
+    db._c.execute('DELETE FROM block_stage')
+    db._db.commit()
+    os.remove(sbatch_log)
+    with assert_raises(RuntimeError):
+        cli.merge_blocks(3, 1, chain=True, blocks=[1, 2, 3])
+    assert_equals(sorted(db.get_block_stage_tasks('merge')), [1])
+
+@with_setup(setup_project, teardown_project)
+def test_merge_and_patch_options():
+    cli.pipeline_run({'merge': 3}, merge_files=8, trim=True)
+    assert_equals(cli.mc().getint('pipeline', 'merge_files'), 8)
+    assert_equals(cli.mc().getboolean('pipeline', 'trim'), True)
+    merge_script, = glob.glob(os.path.join(run_dir, 'scripts',
+                                           'las_merge.*.sh'))
+    with open(merge_script) as f:
+        assert_true('-n 8' in f.read())
+    with open(sbatch_log) as f:
+        patching = [line for line in f if '-J patching' in line]
+    assert_equals(len(patching), 1)
+    assert_equals(patching[0].split()[-1], 'True')
+
+    # The options are kept when they are not given again
+    cli.pipeline_run(trim=False)
+    assert_equals(cli.mc().getint('pipeline', 'merge_files'), 8)
+    assert_equals(cli.mc().getboolean('pipeline', 'trim'), False)
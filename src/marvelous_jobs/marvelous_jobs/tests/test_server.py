@@ -0,0 +1,127 @@
+from nose.tools import assert_equals
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+import os
+import shutil
+import socket
+import stat
+import subprocess
+import sys
+import threading
+import time
+
+import marvelous_jobs as mj
+from marvelous_jobs import client
+from marvelous_jobs import server
+from marvelous_jobs import slurm_utils
+from marvelous_jobs.tests import testdir
+
+run_dir = os.path.join(testdir, 'server')
+db_filename = os.path.join(run_dir, 'marveldb')
+address_file = os.path.join(run_dir, server.address_filename)
+
+def start_coordinator():
+    global coordinator, thread
+    if os.path.isdir(run_dir):
+        shutil.rmtree(run_dir)
+    os.mkdir(run_dir)
+    db = mj.marvel_db(db_filename, 'servertest', 20)
+    db.add_blocks((i, 'servertest.{0}'.format(i)) for i in range(1, 4))
+    db.add_daligner_job_matrix(3, use_masking_server=False)
+    db._db.close()
+
+    coordinator = server.coordinator(db_filename, ('127.0.0.1', 0))
+    coordinator.write_address(address_file)
+    thread = threading.Thread(target=coordinator.serve_forever)
+    thread.start()
+
+def stop_coordinator():
+    coordinator.shutdown()
+    thread.join()
+    coordinator.server_close()
+
+def get_statuses():
+    db = mj.marvel_db.from_file(db_filename)
+    db._c.execute('SELECT rowid, status FROM daligner_job')
+    return dict(db._c.fetchall())
+
+@with_setup(start_coordinator, stop_coordinator)
+def test_address_file():
+    assert_equals(stat.S_IMODE(os.stat(address_file).st_mode), 0o600)
+    address = client.read_address(address_file)
+    assert_equals(address['host'], '127.0.0.1')
+    assert_equals(address['port'], coordinator.server_address[1])
+    assert_equals(address['key'], coordinator.key)
+
+@with_setup(start_coordinator, stop_coordinator)
+def test_requests():
+    assert_equals(client.request(address_file, 'ping'), 'pong')
+    assert_equals(client.request(address_file, 'project'),
+                  {'name': 'servertest', 'masking_ip': None})
+
+    claimed = client.request(address_file, 'claim', token='t_1',
+                             jobid='77', n=2)
+    assert_equals(len(claimed), 2)
+    rowids = [ri for d in claimed for ri in d['rowids']]
+    claimed = client.request(address_file, 'claim', token='t_2',
+                             jobid='77', n=1, completed=rowids[:1],
+                             failed=rowids[1:])
+    assert_true(claimed[0]['rowids'][0] not in rowids)
+
+    statuses = get_statuses()
+    assert_equals(statuses[rowids[0]], slurm_utils.status.completed)
+    assert_equals(statuses[rowids[1]], slurm_utils.status.failed)
+    assert_equals(statuses[claimed[0]['rowids'][0]],
+                  slurm_utils.status.running)
+
+    client.request(address_file, 'complete', rowids=rowids[1:])
+    assert_equals(get_statuses()[rowids[1]], slurm_utils.status.completed)
+
+@with_setup(start_coordinator, stop_coordinator)
+def test_invalid_requests():
+    with assert_raises(RuntimeError):
+        client.request(address_file, 'remove_daligner_jobs')
+    address = client.read_address(address_file)
+    address['key'] = 'wrong'
+    with assert_raises(RuntimeError):
+        client.request(address, 'ping')
+    address['port'] = 1
+    with assert_raises(RuntimeError):
+        client.request(address, 'ping', retries=1, backoff=0)
+    # Fails inside the claim transaction
+    with assert_raises(RuntimeError):
+        client.request(address_file, 'claim', token='t_1', jobid='77',
+                       completed=['x'])
+    # The coordinator survives bad requests
+    assert_equals(client.request(address_file, 'ping'), 'pong')
+    assert_equals(len(client.request(address_file, 'claim', token='t_1',
+                                     jobid='77')), 1)
+
+@with_setup(start_coordinator, stop_coordinator)
+def test_stalled_client():
+    # A client that connects but never sends its request only holds
+    # up the others for the handler timeout
+    stalled = socket.create_connection(coordinator.server_address)
+    try:
+        start = time.time()
+        assert_equals(client.request(address_file, 'ping', retries=0,
+                                     timeout=10), 'pong')
+        assert_true(time.time() - start
+                    < server.coordinator_handler.timeout + 1)
+    finally:
+        stalled.close()
+
+@with_setup(start_coordinator, stop_coordinator)
+def test_client_command():
+    p = subprocess.run([sys.executable, '-m', 'marvelous_jobs.client',
+                        address_file, 'project', 'name'],
+                       stdout=subprocess.PIPE, encoding='utf8')
+    assert_equals(p.returncode, 0)
+    assert_equals(p.stdout, 'servertest\n')
+
+    p = subprocess.run([sys.executable, '-m', 'marvelous_jobs.client',
+                        address_file, 'claim', 't_1', '77', '-n', '2'],
+                       stdout=subprocess.PIPE, encoding='utf8')
+    assert_equals(p.returncode, 0)
+    assert_equals(len(p.stdout.splitlines()), 2)
@@ -0,0 +1,230 @@
+from nose.tools import assert_equals
+from nose.tools import assert_is_none
+from nose.tools import assert_raises
+from nose.tools import assert_true
+from nose.tools import with_setup
+import os
+
+import marvelous_jobs as mj
+from marvelous_jobs import slurm_utils
+from marvelous_jobs.tests import config, db, testdir
+from marvelous_jobs.tests import fake_slurm, restore_slurm
+
+bin_dir = os.path.join(testdir, 'fake_slurm')
+call_log = os.path.join(bin_dir, 'calls.log')
+
+squeue_output = '''100|RUNNING|node1
+101_1|RUNNING|node2
+101_2|PENDING|
+'''
+
+sacct_output = '''102|COMPLETED|node3
+103|CANCELLED by 1234|node4
+'''
+
+def write_command(name, output):
+    fake_slurm(bin_dir, **{name: 'echo "{0} $@" >> {1}\n'
+                                 "cat << 'EOF'\n{2}EOF\n" \
+                                 .format(name, call_log, output)})
+
+def setup_fake_slurm():
+    for f in (call_log, call_log + '.args'):
+        if os.path.isfile(f):
+            os.remove(f)
+    write_command('squeue', squeue_output)
+    write_command('sacct', sacct_output)
+
+def teardown_fake_slurm():
+    restore_slurm()
+
+def get_calls():
+    if not os.path.isfile(call_log):
+        return []
+    with open(call_log) as f:
+        return [line.split()[0] for line in f]
+
+@with_setup(setup_fake_slurm, teardown_fake_slurm)
+def test_snapshot():
+    snapshot = slurm_utils.get_snapshot([100, '101_1', '101_2', 102, 103])
+    assert_equals(get_calls(), ['squeue', 'sacct'])
+    assert_equals(snapshot.get(100),
+                  {'job_state': 'RUNNING', 'nodes': 'node1'})
+    assert_equals(snapshot.get('101_2'),
+                  {'job_state': 'PENDING', 'nodes': None})
+    assert_equals(snapshot.get('103')['job_state'], 'CANCELLED')
+
+    # All lookups are served from the snapshot
+    assert_equals(slurm_utils.get_job_status(100), 'RUNNING')
+    assert_equals(slurm_utils.get_job_status('101_1'), 'RUNNING')
+    assert_equals(slurm_utils.get_job_status(102), 'COMPLETED')
+    assert_equals(slurm_utils.get_job_node('101_1'), 'node2')
+    assert_equals(get_calls(), ['squeue', 'sacct'])
+
+@with_setup(setup_fake_slurm, teardown_fake_slurm)
+def test_snapshot_refresh():
+    assert_equals(slurm_utils.get_job_status(100), 'RUNNING')
+    assert_equals(get_calls(), ['squeue'])
+
+    # A job that is not in the snapshot triggers a new one
+    assert_is_none(slurm_utils.get_job_status(999))
+    assert_equals(get_calls(), ['squeue', 'squeue', 'sacct'])
+    with assert_raises(ValueError):
+        slurm_utils.get_job_node(999)
+    assert_equals(len(get_calls()), 3)
+
+    # Expired snapshots are fetched again
+    slurm_utils.get_snapshot([100], ttl=0)
+    assert_equals(get_calls()[3:], ['squeue'])
+
+    assert_equals(slurm_utils.get_job_status(None),
+                  slurm_utils.status.notstarted)
+
+def test_expand_array_jobid():
+    assert_equals(slurm_utils.expand_array_jobid('100'), ['100'])
+    assert_equals(slurm_utils.expand_array_jobid('100_3'), ['100_3'])
+    assert_equals(slurm_utils.expand_array_jobid('100_[1-3,7%2]'),
+                  ['100_1', '100_2', '100_3', '100_7'])
+
+def reset_reconciled_jobs():
+    db._c.execute('''UPDATE daligner_job
+                     SET status = ?, jobid = NULL, reservation_token = NULL
+                     WHERE jobid = 500''', (slurm_utils.status.notstarted,))
+    db._db.commit()
+    teardown_fake_slurm()
+
+@with_setup(setup_fake_slurm, reset_reconciled_jobs)
+def test_reconcile_daligner_jobs():
+    write_command('sacct', '''500_1|OUT_OF_MEMORY|node1
+500_2|COMPLETED|node2
+500_[3-4]|CANCELLED by 1234|None assigned
+''')
+    for task_id in range(1, 6):
+        db._c.execute('''UPDATE daligner_job
+                         SET status = ?, jobid = 500, reservation_token = ?
+                         WHERE rowid IN (?, ?)''',
+                      (slurm_utils.status.reserved,
+                       'token_{0}'.format(task_id),
+                       2 * task_id - 1, 2 * task_id))
+    db._c.execute('''UPDATE daligner_job SET status = ?
+                     WHERE rowid = 8''', (slurm_utils.status.completed,))
+    db._db.commit()
+
+    assert_equals(db.reconcile_daligner_jobs(), 5)
+    assert_equals(get_calls(), ['sacct'])
+
+    db._c.execute('''SELECT rowid, status FROM daligner_job
+                     WHERE jobid = 500 ORDER BY rowid''')
+    statuses = dict(db._c.fetchall())
+    assert_equals(statuses, {
+        1: slurm_utils.status.out_of_memory,
+        2: slurm_utils.status.out_of_memory,
+        3: slurm_utils.status.reserved,
+        4: slurm_utils.status.reserved,
+        5: slurm_utils.status.cancelled,
+        6: slurm_utils.status.cancelled,
+        7: slurm_utils.status.cancelled,
+        8: slurm_utils.status.completed,
+        9: slurm_utils.status.reserved,
+        10: slurm_utils.status.reserved})
+
+def write_sbatch(fail_first=None):
+    """Fake sbatch that fails once with `fail_first` on stderr, and then
+    uses its process ID as job ID."""
+    counter = os.path.join(bin_dir, 'sbatch_counter')
+    with open(counter, 'w') as f:
+        f.write('0\n')
+    fake_slurm(bin_dir, sbatch='''echo "start" >> {log}
+echo "$@" >> {log}.args
+n=$(($(cat {counter}) + 1))
+echo $n > {counter}
+if [ $n -eq 1 ] && [ -n "{fail_first}" ]; then
+    echo "sbatch: error: {fail_first}" >&2
+    exit 1
+fi
+sleep 0.2
+echo "end" >> {log}
+echo "$$;cluster"
+'''.format(log=call_log, counter=counter, fail_first=fail_first or ''))
+
+@with_setup(setup_fake_slurm, teardown_fake_slurm)
+def test_sbatch_retry():
+    write_sbatch('Socket timed out on send/recv operation')
+    jobid = slurm_utils.sbatch(['sbatch', '--parsable', 'x.sh'], backoff=0)
+    assert_true(jobid > 0)
+    assert_equals(get_calls(), ['start', 'start', 'end'])
+
+    write_sbatch('Invalid account or account/partition combination')
+    with assert_raises(RuntimeError):
+        slurm_utils.sbatch(['sbatch', '--parsable', 'x.sh'], backoff=0)
+
+    write_sbatch('Resource temporarily unavailable')
+    with assert_raises(RuntimeError):
+        slurm_utils.sbatch(['sbatch', '--parsable', 'x.sh'], retries=0)
+
+@with_setup(setup_fake_slurm, teardown_fake_slurm)
+def test_start_jobs():
+    write_sbatch()
+    jobs = [mj.prepare_job('test',
+                           config.get('general', 'fasta'),
+                           config.getint('general', 'blocksize'),
+                           script_directory=config.get('general',
+                                                       'script_directory'),
+                           log_directory=config.get('general',
+                                                    'log_directory'))
+            for i in range(5)]
+    jobids = mj.start_jobs(jobs, max_concurrent=2)
+    assert_equals(len(set(jobids)), len(jobs))
+    assert_equals([job.jobid for job in jobs], jobids)
+
+    running = 0
+    max_running = 0
+    for call in get_calls():
+        running += 1 if call == 'start' else -1
+        max_running = max(max_running, running)
+    assert_equals(max_running, 2)
+
+def test_split_array():
+    assert_equals(mj.split_array(list(range(5)), 2), [[0, 1], [2, 3], [4]])
+    assert_equals(mj.split_array(list(range(4)), 4), [[0, 1, 2, 3]])
+    assert_equals(mj.split_array([], 4), [])
+    assert_equals(mj.shard_simultaneous_tasks(10, 4), (2, False))
+    assert_equals(mj.shard_simultaneous_tasks(4, 4), (1, False))
+    # More shards than the limit allows to run side by side
+    assert_equals(mj.shard_simultaneous_tasks(2, 4), (2, True))
+    assert_equals(mj.shard_simultaneous_tasks(10, 4, chain=True),
+                  (10, True))
+    assert_equals(mj.shard_simultaneous_tasks(None, 4), (None, False))
+
+@with_setup(setup_fake_slurm, teardown_fake_slurm)
+def test_max_array_size():
+    write_command('scontrol', '''MaxArraySize            = 4001
+MaxJobCount             = 10000
+''')
+    assert_equals(slurm_utils.get_max_array_size(), 4001)
+    write_command('scontrol', '')
+    assert_equals(slurm_utils.get_max_array_size(), 1001)
+
+@with_setup(setup_fake_slurm, teardown_fake_slurm)
+def test_start_chained_job_arrays():
+    write_sbatch()
+    jobs = [mj.stats_job_array(blocks, 'test', 'stats_{}_{}.txt',
+                               script_directory=config.get(
+                                   'general', 'script_directory'),
+                               reservation_token='token-{0}'.format(i))
+            for i, blocks in enumerate(mj.split_array(list(range(1, 6)), 2),
+                                       start=1)]
+    jobs[0].sbatch_args['after'] = 42
+    jobs[2].sbatch_args['after'] = 42
+    jobids = mj.start_job_arrays(jobs, chain=True)
+    assert_equals([job.jobid for job in jobs], jobids)
+
+    with open(call_log + '.args') as f:
+        args = [line.split() for line in f]
+    assert_equals(len(args), 3)
+    assert_true('--dependency' not in args[0])
+    assert_equals(args[1][args[1].index('--dependency') + 1],
+                  'afterany:{0}'.format(jobids[0]))
+    assert_equals(args[2][args[2].index('--dependency') + 1],
+                  'after:42,afterany:{0}'.format(jobids[1]))
+    assert_equals([a[a.index('--array') + 1] for a in args],
+                  ['1-2', '1-2', '1-1'])